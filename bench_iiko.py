@@ -0,0 +1,142 @@
+""" Замер пропускной способности и задержек IikoCardAPI на локальной замене API (iiko_mock).
+Режимы: sync - последовательные вызовы, threaded - пул потоков, async - AsyncIikoCardAPI.
+Результаты дописываются в файл JSONL; с --compare запуск завершается с кодом 1,
+если p95 вырос относительно предыдущего запуска с теми же параметрами больше допустимого.
+
+    python bench_iiko.py --requests 500 --concurrency 16 --latency 0.01 --compare
+"""
+import argparse, asyncio, contextlib, io, json, os, platform, sys, time
+from concurrent.futures import ThreadPoolExecutor
+
+from iiko import IikoCardAPI, AsyncIikoCardAPI, httpx
+from iiko_mock import IikoMockServer
+
+
+def percentile(samples: list, q: float) -> float:
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(q * len(samples)))] if samples else 0.0
+
+
+def summarize(mode: str, latencies: list, elapsed: float) -> dict:
+    return {
+        "mode": mode,
+        "requests": len(latencies),
+        "throughput": round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+        "p50": round(percentile(latencies, 0.50) * 1000, 2),
+        "p95": round(percentile(latencies, 0.95) * 1000, 2),
+        "p99": round(percentile(latencies, 0.99) * 1000, 2),
+    }
+
+
+def run_sync(server: IikoMockServer, phones: list, concurrency: int) -> dict:
+    api = IikoCardAPI(server.apiLogin)
+    api.apiURL = server.url
+    api.set_token()
+    latencies = []
+    started = time.perf_counter()
+    for phone in phones:
+        call_started = time.perf_counter()
+        api.get_customer_by_phone(phone)
+        latencies.append(time.perf_counter() - call_started)
+    return summarize("sync", latencies, time.perf_counter() - started)
+
+
+def run_threaded(server: IikoMockServer, phones: list, concurrency: int) -> dict:
+    api = IikoCardAPI(server.apiLogin)
+    api.apiURL = server.url
+    api.set_token()
+
+    def call(phone):
+        call_started = time.perf_counter()
+        api.get_customer_by_phone(phone)
+        return time.perf_counter() - call_started
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        latencies = list(executor.map(call, phones))
+    return summarize("threaded", latencies, time.perf_counter() - started)
+
+
+def run_async(server: IikoMockServer, phones: list, concurrency: int) -> dict:
+    async def bench():
+        async with AsyncIikoCardAPI(server.apiLogin, max_connections=concurrency) as api:
+            api.apiURL = server.url
+            await api.set_token()
+            semaphore = asyncio.Semaphore(concurrency)
+
+            async def call(phone):
+                async with semaphore:
+                    call_started = time.perf_counter()
+                    await api.get_customer_by_phone(phone)
+                    return time.perf_counter() - call_started
+
+            started = time.perf_counter()
+            latencies = await asyncio.gather(*(call(phone) for phone in phones))
+            return summarize("async", latencies, time.perf_counter() - started)
+
+    return asyncio.run(bench())
+
+
+MODES = {"sync": run_sync, "threaded": run_threaded, "async": run_async}
+
+
+def previous_results(path: str, params: dict) -> dict:
+    """ Последний результат каждого режима с теми же параметрами"""
+    results = {}
+    if not os.path.exists(path):
+        return results
+    with open(path, encoding='utf-8') as file:
+        for line in file:
+            if line.strip():
+                record = json.loads(line)
+                if record.get("params") == params:
+                    results[record["mode"]] = record
+    return results
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Бенчмарк IikoCardAPI на локальной замене API iiko")
+    parser.add_argument('--requests', type=int, default=200, help="число запросов в каждом режиме")
+    parser.add_argument('--concurrency', type=int, default=16, help="параллельность для threaded и async")
+    parser.add_argument('--customers', type=int, default=100, help="число клиентов на сервере")
+    parser.add_argument('--latency', type=float, default=0.005, help="задержка ответа сервера, с")
+    parser.add_argument('--jitter', type=float, default=0.0, help="случайная добавка к задержке, с")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="доля ответов с ошибкой 503")
+    parser.add_argument('--modes', default='sync,threaded,async', help="режимы через запятую")
+    parser.add_argument('--output', default='bench_results.jsonl', help="файл для накопления результатов")
+    parser.add_argument('--compare', action='store_true', help="сравнить с предыдущим запуском")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="допустимый рост p95, доля")
+    args = parser.parse_args(argv)
+
+    params = {"requests": args.requests, "concurrency": args.concurrency, "customers": args.customers,
+              "latency": args.latency, "jitter": args.jitter, "error_rate": args.error_rate}
+    previous = previous_results(args.output, params)
+    modes = [mode for mode in args.modes.split(',') if mode]
+    if 'async' in modes and httpx is None:
+        print("httpx не установлен, режим async пропущен")
+        modes.remove('async')
+
+    regressions = []
+    with IikoMockServer(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate, error_status=503,
+                        seed=0) as server:
+        phones = [server.add_customer(phone=f"+7000000{index:04d}")["phone"] for index in range(args.customers)]
+        phones = [phones[index % len(phones)] for index in range(args.requests)]
+        print(f"{'mode':<10}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+        for mode in modes:
+            with contextlib.redirect_stdout(io.StringIO()):
+                result = MODES[mode](server, phones, args.concurrency)
+            print(f"{mode:<10}{result['throughput']:>10}{result['p50']:>10}{result['p95']:>10}{result['p99']:>10}")
+            result.update(params=params, time=time.strftime('%Y-%m-%dT%H:%M:%S'),
+                          python=platform.python_version())
+            with open(args.output, 'a', encoding='utf-8') as file:
+                file.write(json.dumps(result, ensure_ascii=False) + '\n')
+            before = previous.get(mode)
+            if args.compare and before and result['p95'] > before['p95'] * (1 + args.tolerance):
+                regressions.append(f"{mode}: p95 {before['p95']} -> {result['p95']} ms")
+    for regression in regressions:
+        print(f"Регрессия {regression}")
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,393 +1,3670 @@
-import requests, datetime
+import requests, datetime, asyncio, threading, time, json, os, tempfile, csv, random, gzip, codecs, re
+import abc, bisect, contextlib, contextvars, email.utils, functools, hashlib, heapq, http.cookiejar, inspect, socket
+import sqlite3, urllib3, weakref
+from concurrent.futures import ThreadPoolExecutor, Future, wait, as_completed, FIRST_COMPLETED
+from concurrent.futures import TimeoutError as FutureTimeoutError, CancelledError as FutureCancelledError
+from collections import OrderedDict, deque
 
+try:
+    import httpx
+except ImportError:  # httpx нужен только для AsyncIikoCardAPI
+    httpx = None
 
-class IikoCardAPI:
-    """ Класс для работы с API iiko"""
+try:
+    import orjson
+except ImportError:  # без orjson ответы разбираются стандартным json
+    orjson = None
 
-    def __init__(self, apiLogin, timeout=180):
+json_loads = orjson.loads if orjson is not None else json.loads
+
+
+class IikoError(Exception):
+    """ Ошибка при обращении к API iiko"""
+
+
+class IikoConnectionError(IikoError):
+    """ API iiko недоступно"""
+
+
+class NotAuthorizedError(IikoError):
+    """ API iiko отклонило токен доступа"""
+
+
+class IikoHTTPError(IikoError):
+    """ API iiko ответило ошибкой 429 или 5xx (у потоковых методов - любой ошибкой HTTP)"""
+
+    def __init__(self, path: str, status: int, text: str = ''):
+        super().__init__(path, status, text)
+        self.path = path
+        self.status = status
+        self.text = text
+
+
+class CircuitOpenError(IikoError):
+    """ Запрос не отправлен: API iiko считается недоступным (цепь разомкнута)"""
+
+
+class DeadlineExceeded(IikoError):
+    """ Истекло общее время, отведённое на вызов (см. deadline)"""
+
+
+_deadline = contextvars.ContextVar('iiko_deadline', default=None)
+
+
+@contextlib.contextmanager
+def deadline(seconds: float):
+    """
+    Общий лимит времени на вызовы API внутри блока with, включая повторы и ожидание перед ними.
+    Вложенный deadline не может продлить внешний.
+        with iiko.deadline(2.0):
+            api.get_customer_by_phone(phone)
+    :param seconds: лимит времени в секундах
+    """
+    moment = time.monotonic() + seconds
+    current = _deadline.get()
+    token = _deadline.set(moment if current is None else min(current, moment))
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def time_left(path: str = ''):
+    """
+    :return: сколько секунд осталось до истечения текущего deadline, None - deadline не задан
+    :raises DeadlineExceeded: время истекло
+    """
+    moment = _deadline.get()
+    if moment is None:
+        return None
+    left = moment - time.monotonic()
+    if left <= 0:
+        raise DeadlineExceeded(path)
+    return left
+
+
+def limit_timeout(timeout, left: float = None):
+    """ Ограничивает таймаут (число или пара (connect, read)) оставшимся временем"""
+    if left is None:
+        return timeout
+    if isinstance(timeout, tuple):
+        return tuple(min(value, left) for value in timeout)
+    return min(timeout, left)
+
+
+def backoff_pause(delay: float, path: str = '') -> float:
+    """ Пауза перед повтором с учётом deadline
+    :raises DeadlineExceeded: повтор не успеет до истечения deadline
+    """
+    left = time_left(path)
+    if left is not None and delay >= left:
+        raise DeadlineExceeded(path)
+    return delay
+
+
+def report_error(exc: IikoError, error_message: str):
+    """ Вывод сообщения об ошибке запроса для методов, возвращающих None вместо исключения"""
+    if isinstance(exc, NotAuthorizedError):
+        print("Not authorized")
+    elif isinstance(exc, CircuitOpenError):
+        print(f"{error_message}: API iiko недоступно, запрос не отправлен")
+    elif isinstance(exc, IikoHTTPError):
+        print(f"{error_message}: HTTP {exc.status}")
+    else:
+        print(error_message)
+
+
+def write_json_atomic(path: str, obj):
+    """ Записывает obj в json-файл через временный файл, чтобы при сбое не остался недописанный файл"""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix='.iiko-')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as file:
+            json.dump(obj, file, ensure_ascii=False)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+class RateLimiter:
+    """ Ограничитель частоты запросов (token bucket), общий для всех потоков"""
+
+    def __init__(self, rate: float, burst: int = None):
+        """
+        :param rate: допустимое число запросов в секунду
+        :param burst (optional): размер корзины, по умолчанию равен rate
+        """
+        self.rate = rate
+        self.burst = burst if burst else max(1, int(rate))
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self) -> float:
+        """ Резервирует запрос и возвращает, сколько секунд нужно подождать перед его отправкой"""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            return -self._tokens / self.rate if self._tokens < 0 else 0.0
+
+    def acquire(self):
+        """ Ожидает разрешения на отправку запроса"""
+        delay = self.reserve()
+        if delay:
+            time.sleep(delay)
+
+
+class RetryPolicy:
+    """ Повтор запросов с экспоненциальной задержкой со случайным разбросом (full jitter).
+    Ответ 429 и ошибки соединения до отправки запроса повторяются для любых методов,
+    ответы 5xx и обрывы во время запроса - только для идемпотентных (поиск, справочники).
+    """
+
+    def __init__(self, attempts: int = 3, backoff: float = 0.5, max_backoff: float = 10,
+                 max_retry_after: float = 60, statuses=(429, 500, 502, 503, 504)):
+        """
+        :param attempts (optional): общее число попыток
+        :param backoff (optional): базовая задержка в секундах
+        :param max_backoff (optional): максимальная задержка в секундах
+        :param max_retry_after (optional): максимальное ожидание по заголовку Retry-After
+        :param statuses (optional): коды ответа, после которых запрос повторяется
+        """
+        self.attempts = attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_retry_after = max_retry_after
+        self.statuses = statuses
+
+    def delay(self, attempt: int, retry_after: str = None) -> float:
+        """
+        :param attempt: номер неудачной попытки, начиная с 0
+        :param retry_after: значение заголовка Retry-After
+        :return: пауза перед следующей попыткой в секундах
+        """
+        if retry_after:
+            try:
+                return min(float(retry_after), self.max_retry_after)
+            except ValueError:
+                try:
+                    moment = email.utils.parsedate_to_datetime(retry_after)
+                    return min(max(moment.timestamp() - time.time(), 0), self.max_retry_after)
+                except (TypeError, ValueError):
+                    pass
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+
+class CircuitBreaker:
+    """ Размыкает цепь после серии отказов API, чтобы запросы сразу завершались ошибкой, а не ждали таймаута.
+    По истечении reset_timeout пропускается один пробный запрос: успех замыкает цепь, отказ размыкает снова.
+    Пробный запрос, завершившийся без ответа об успехе или отказе (429, deadline, отмена), освобождается
+    через release, и следующий запрос становится пробным.
+    """
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30):
+        """
+        :param failure_threshold (optional): число отказов подряд для размыкания
+        :param reset_timeout (optional): через сколько секунд пропустить пробный запрос
+        """
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened = None
+        self._probe = None
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        if self.opened is None:
+            return 'closed'
+        return 'half-open' if time.monotonic() - self.opened >= self.reset_timeout else 'open'
+
+    def before_request(self, path: str = '', probe=None):
+        """
+        :param probe (optional): пробный запрос, полученный этим вызовом ранее; повторы пробного запроса
+            (после 429 или 401) проходят без новой проверки, пока цепь ждёт его результата
+        :return: пробный запрос, который нужно передать в release по завершении, или None
+        :raises CircuitOpenError: цепь разомкнута
+        """
+        with self._lock:
+            if self.opened is None:
+                return None
+            if probe is not None and probe is self._probe:
+                return probe
+            if time.monotonic() - self.opened >= self.reset_timeout and self._probe is None:
+                self._probe = object()
+                return self._probe
+        raise CircuitOpenError(path)
+
+    def release(self, probe):
+        """ Освобождает пробный запрос, не получивший ответа об успехе или отказе"""
+        if probe is None:
+            return
+        with self._lock:
+            if probe is self._probe:
+                self._probe = None
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened = None
+            self._probe = None
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._probe is not None or self.failures >= self.failure_threshold:
+                self.opened = time.monotonic()
+                self._probe = None
+
+
+class LatencyTracker:
+    """ Скользящее окно длительностей успешных запросов по каждому методу API для расчёта перцентилей"""
+
+    def __init__(self, window: int = 500):
+        self.window = window
+        self._samples = {}
+        self._lock = threading.Lock()
+
+    def add(self, path: str, seconds: float):
+        with self._lock:
+            samples = self._samples.get(path)
+            if samples is None:
+                samples = self._samples[path] = deque(maxlen=self.window)
+            samples.append(seconds)
+
+    def percentile(self, path: str, q: float = 0.95, min_samples: int = 20):
+        """ :return: перцентиль q в секундах или None, если данных недостаточно"""
+        with self._lock:
+            samples = sorted(self._samples.get(path, ()))
+        if len(samples) < min_samples:
+            return None
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+
+class Metrics:
+    """ Метрики клиента: гистограммы задержек, коды ответов, повторы, обновления токена,
+    попадания в кэши и объём переданных данных по каждому методу API.
+    Экспортируются в текстовом формате Prometheus (render_prometheus) и передаются в on_event
+    для структурированного логирования, например:
+        Metrics(on_event=lambda event: logging.getLogger('iiko').info(event['event'], extra=event))
+    Один экземпляр можно использовать в нескольких клиентах.
+    """
+    buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self, on_event=None, buckets: tuple = None):
+        """
+        :param on_event (optional): функция, получающая каждое событие в виде dict; её исключения не прерывают
+            запросы
+        :param buckets (optional): границы корзин гистограммы задержек в секундах
+        """
+        self.on_event = on_event
+        if buckets:
+            self.buckets = tuple(sorted(buckets))
+        self.durations = {}  # path -> [счётчики по корзинам, сумма, количество]
+        self.responses = {}  # (path, status) -> count
+        self.retries = {}  # (path, reason) -> count
+        self.bytes_sent = {}
+        self.bytes_received = {}
+        self.token_refreshes = {}  # result -> count
+        self.cache_lookups = {}  # (cache, result) -> count
+        self.coalesced_requests = {}  # path -> count
+        self._lock = threading.Lock()
+
+    def _emit(self, event: dict):
+        if self.on_event is not None:
+            try:
+                self.on_event(event)
+            except Exception as exc:
+                # ошибка обработчика событий не должна прерывать запрос к API
+                print(f"Ошибка обработчика событий метрик: {exc!r}")
+
+    def request(self, path: str, status, seconds: float, sent: int = 0, received: int = 0):
+        """ Завершённая попытка запроса; status - код ответа или 'error' при ошибке соединения"""
+        with self._lock:
+            histogram = self.durations.get(path)
+            if histogram is None:
+                histogram = self.durations[path] = [[0] * len(self.buckets), 0.0, 0]
+            index = bisect.bisect_left(self.buckets, seconds)
+            if index < len(self.buckets):
+                histogram[0][index] += 1
+            histogram[1] += seconds
+            histogram[2] += 1
+            self.responses[(path, str(status))] = self.responses.get((path, str(status)), 0) + 1
+            self.bytes_sent[path] = self.bytes_sent.get(path, 0) + sent
+            self.bytes_received[path] = self.bytes_received.get(path, 0) + received
+        self._emit({'event': 'request', 'path': path, 'status': status, 'seconds': seconds,
+                    'bytes_sent': sent, 'bytes_received': received})
+
+    def retry(self, path: str, reason):
+        with self._lock:
+            self.retries[(path, str(reason))] = self.retries.get((path, str(reason)), 0) + 1
+        self._emit({'event': 'retry', 'path': path, 'reason': reason})
+
+    def token_refresh(self, success: bool):
+        result = 'success' if success else 'failure'
+        with self._lock:
+            self.token_refreshes[result] = self.token_refreshes.get(result, 0) + 1
+        self._emit({'event': 'token_refresh', 'result': result})
+
+    def cache(self, name: str, hit: bool):
+        result = 'hit' if hit else 'miss'
+        with self._lock:
+            self.cache_lookups[(name, result)] = self.cache_lookups.get((name, result), 0) + 1
+        self._emit({'event': 'cache', 'cache': name, 'result': result})
+
+    def coalesced(self, path: str):
+        """ Запрос не отправлен, ответ получен от такого же выполняющегося запроса"""
+        with self._lock:
+            self.coalesced_requests[path] = self.coalesced_requests.get(path, 0) + 1
+        self._emit({'event': 'coalesced', 'path': path})
+
+    def render_prometheus(self) -> str:
+        """ Метрики в текстовом формате Prometheus"""
+        lines = []
+
+        def counter(name: str, help_text: str, values: dict, labels: tuple):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} counter")
+            for key, value in sorted(values.items()):
+                key = key if isinstance(key, tuple) else (key,)
+                label_text = ','.join(f'{label}="{_escape_label(item)}"' for label, item in zip(labels, key))
+                lines.append(f"{name}{{{label_text}}} {value}")
+
+        with self._lock:
+            lines.append("# HELP iiko_request_duration_seconds Длительность запросов к API iiko")
+            lines.append("# TYPE iiko_request_duration_seconds histogram")
+            for path, (counts, total, count) in sorted(self.durations.items()):
+                label = f'path="{_escape_label(path)}"'
+                cumulative = 0
+                for bound, bucket in zip(self.buckets, counts):
+                    cumulative += bucket
+                    lines.append(f'iiko_request_duration_seconds_bucket{{{label},le="{bound}"}} {cumulative}')
+                lines.append(f'iiko_request_duration_seconds_bucket{{{label},le="+Inf"}} {count}')
+                lines.append(f'iiko_request_duration_seconds_sum{{{label}}} {total}')
+                lines.append(f'iiko_request_duration_seconds_count{{{label}}} {count}')
+            counter("iiko_responses_total", "Ответы API iiko по кодам", self.responses, ('path', 'status'))
+            counter("iiko_retries_total", "Повторы запросов", self.retries, ('path', 'reason'))
+            counter("iiko_bytes_sent_total", "Отправлено байт", self.bytes_sent, ('path',))
+            counter("iiko_bytes_received_total", "Получено байт", self.bytes_received, ('path',))
+            counter("iiko_token_refreshes_total", "Запросы токена", self.token_refreshes, ('result',))
+            counter("iiko_cache_lookups_total", "Обращения к кэшам", self.cache_lookups, ('cache', 'result'))
+            counter("iiko_coalesced_requests_total", "Запросы, объединённые с выполняющимися", self.coalesced_requests,
+                    ('path',))
+        return '\n'.join(lines) + '\n'
+
+
+def _escape_label(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def flight_key(path: str, data: dict) -> tuple:
+    """ Ключ одинаковых запросов: путь и тело запроса в каноническом виде"""
+    return path, json.dumps(data, sort_keys=True, ensure_ascii=False)
+
+
+class SingleFlight:
+    """ Объединение одинаковых одновременных запросов из разных потоков:
+    пока первый запрос выполняется, остальные ждут его результата и новых запросов не отправляют.
+    Все ожидающие получают один и тот же объект ответа.
+    Запрос выполняется в потоке первого вызова и с его deadline, каждый из остальных ограничивает своим deadline
+    только ожидание. Если deadline первого вызова истёк раньше, чем у ожидающего, тот отправляет запрос заново.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, function, *args):
+        """
+        Выполняет function(*args), если запрос с ключом key ещё не выполняется, иначе ждёт его результата
+        :raises DeadlineExceeded: результат не получен до истечения deadline
+        """
+        while True:
+            left = time_left(key[0])
+            with self._lock:
+                call = self._calls.get(key)
+                leader = call is None
+                if leader:
+                    call = self._calls[key] = Future()
+            if leader:
+                self._run(key, call, function, args)
+                return call.result()
+            try:
+                return call.result(timeout=left)
+            except FutureTimeoutError:
+                raise DeadlineExceeded(key[0]) from None
+            except DeadlineExceeded:
+                # истёк deadline первого вызова; если своё время осталось, запрос отправляется заново
+                time_left(key[0])
+
+    def _run(self, key, call: Future, function, args: tuple):
+        try:
+            result = function(*args)
+        except BaseException as exc:
+            self._finish(key)
+            call.set_exception(exc)
+        else:
+            self._finish(key)
+            call.set_result(result)
+
+    def _finish(self, key):
+        """ Новые вызовы с ключом key отправляют свой запрос; ключ снимается до того, как ожидающие получат ответ"""
+        with self._lock:
+            del self._calls[key]
+
+    def __contains__(self, key):
+        return key in self._calls
+
+    def __len__(self):
+        return len(self._calls)
+
+
+class AsyncSingleFlight:
+    """ Вариант SingleFlight для asyncio. Запрос выполняется отдельной задачей с deadline первого вызова,
+    поэтому отмена вызвавшей его корутины не прерывает ожидание остальных.
+    """
+
+    def __init__(self):
+        self._calls = {}
+
+    async def do(self, key, function, *args):
+        while True:
+            left = time_left(key[0])
+            task = self._calls.get(key)
+            if task is None:
+                task = self._calls[key] = asyncio.ensure_future(function(*args))
+                task.add_done_callback(functools.partial(self._finish, key))
+            try:
+                return await asyncio.wait_for(asyncio.shield(task), left)
+            except asyncio.TimeoutError:
+                raise DeadlineExceeded(key[0]) from None
+            except DeadlineExceeded:
+                time_left(key[0])
+
+    def _finish(self, key, task: asyncio.Future):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+
+    def __contains__(self, key):
+        return key in self._calls
+
+    def __len__(self):
+        return len(self._calls)
+
+
+class SharedBackend(abc.ABC):
+    """ Общее хранилище процессов: токены доступа и кэшированные ответы API.
+    Значения - строки; ttl в секундах, None - без срока жизни.
+    Блокировка с ключом name захватывается без ожидания и освобождается сама через ttl,
+    если захвативший процесс завершился, не освободив её.
+    Хранилище без какого-либо из абстрактных методов нельзя создать.
+    """
+
+    @abc.abstractmethod
+    def get(self, key: str):
+        """ Значение по ключу или None"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def set(self, key: str, value: str, ttl: float = None):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def delete(self, key: str):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def lock(self, name: str, ttl: float):
+        """ Захватывает блокировку
+        :return: метка владельца для unlock или None, если блокировка занята
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def unlock(self, name: str, owner: str):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class SQLiteBackend(SharedBackend):
+    """ Общее хранилище в файле SQLite для процессов одного хоста"""
+
+    def __init__(self, path: str, timeout: float = 10):
+        """
+        :param path: путь к файлу базы
+        :param timeout (optional): сколько секунд ждать, пока база занята другим процессом
+        """
+        self.path = path
+        self._db = sqlite3.connect(path, timeout=timeout, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS shared (key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+                         "expires REAL) WITHOUT ROWID")
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        with self._lock:
+            row = self._db.execute("SELECT value FROM shared WHERE key = ? AND (expires IS NULL OR expires > ?)",
+                                   (key, time.time())).fetchone()
+        return row[0] if row else None
+
+    def set(self, key: str, value: str, ttl: float = None):
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO shared VALUES (?, ?, ?)",
+                             (key, value, time.time() + ttl if ttl is not None else None))
+
+    def delete(self, key: str):
+        with self._lock:
+            self._db.execute("DELETE FROM shared WHERE key = ?", (key,))
+
+    def lock(self, name: str, ttl: float):
+        owner = os.urandom(16).hex()
+        now = time.time()
+        with self._lock:
+            # вставка проходит, только если блокировки нет или её срок истёк
+            changed = self._db.execute("INSERT INTO shared VALUES (?, ?, ?) ON CONFLICT (key) DO UPDATE "
+                                       "SET value = excluded.value, expires = excluded.expires "
+                                       "WHERE shared.expires <= ?", (name, owner, now + ttl, now)).rowcount
+        return owner if changed else None
+
+    def unlock(self, name: str, owner: str):
+        with self._lock:
+            self._db.execute("DELETE FROM shared WHERE key = ? AND value = ?", (name, owner))
+
+    def close(self):
+        self._db.close()
+
+
+class RedisError(Exception):
+    """ Ошибка, которую вернул сервер Redis"""
+
+
+BACKEND_ERRORS = (OSError, RedisError, sqlite3.Error)
+
+
+class RedisBackend(SharedBackend):
+    """ Общее хранилище в Redis (или совместимом сервере) для процессов на разных хостах.
+    Протокол RESP реализован поверх сокета, отдельный клиент Redis не нужен.
+    """
+
+    def __init__(self, host: str = 'localhost', port: int = 6379, db: int = 0, password: str = None,
+                 prefix: str = 'iiko:', timeout: float = 5):
+        """
+        :param host (optional): адрес сервера
+        :param port (optional): порт сервера
+        :param db (optional): номер базы
+        :param password (optional): пароль (AUTH)
+        :param prefix (optional): префикс всех ключей
+        :param timeout (optional): таймаут соединения и ответа в секундах
+        """
+        self.host = host
+        self.port = port
+        self.db = db
+        self.password = password
+        self.prefix = prefix
+        self.timeout = timeout
+        self._sock = None
+        self._file = None
+        self._lock = threading.Lock()
+
+    def command(self, *args):
+        """ Выполняет команду Redis; при обрыве соединения переподключается и повторяет её один раз"""
+        with self._lock:
+            for attempt in range(2):
+                try:
+                    if self._sock is None:
+                        self._connect()
+                    return self._call(args)
+                except OSError:
+                    self._disconnect()
+                    if attempt:
+                        raise
+
+    def get(self, key: str):
+        value = self.command("GET", self.prefix + key)
+        return value.decode('utf-8') if value is not None else None
+
+    def set(self, key: str, value: str, ttl: float = None):
+        if ttl is None:
+            self.command("SET", self.prefix + key, value)
+        else:
+            self.command("SET", self.prefix + key, value, "PX", max(1, int(ttl * 1000)))
+
+    def delete(self, key: str):
+        self.command("DEL", self.prefix + key)
+
+    def lock(self, name: str, ttl: float):
+        owner = os.urandom(16).hex()
+        if self.command("SET", self.prefix + name, owner, "NX", "PX", max(1, int(ttl * 1000))) is None:
+            return None
+        return owner
+
+    # удаление ключа, только если в нём метка владельца: проверка и удаление выполняются сервером атомарно
+    unlock_script = 'if redis.call("GET", KEYS[1]) == ARGV[1] then return redis.call("DEL", KEYS[1]) end return 0'
+
+    def unlock(self, name: str, owner: str):
+        """ Освобождает блокировку, если она ещё принадлежит owner: истёкшую и захваченную другим процессом
+        блокировку не трогает"""
+        self.command("EVAL", self.unlock_script, 1, self.prefix + name, owner)
+
+    def close(self):
+        with self._lock:
+            self._disconnect()
+
+    def _connect(self):
+        self._sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._file = self._sock.makefile('rb')
+        if self.password:
+            self._call(("AUTH", self.password))
+        if self.db:
+            self._call(("SELECT", self.db))
+
+    def _disconnect(self):
+        if self._sock is not None:
+            self._file.close()
+            self._sock.close()
+        self._sock = self._file = None
+
+    def _call(self, args):
+        parts = [b'*%d\r\n' % len(args)]
+        for arg in args:
+            arg = arg if isinstance(arg, bytes) else str(arg).encode('utf-8')
+            parts.append(b'$%d\r\n%s\r\n' % (len(arg), arg))
+        self._sock.sendall(b''.join(parts))
+        return self._reply()
+
+    def _reply(self):
+        line = self._file.readline()
+        if not line.endswith(b'\r\n'):
+            raise ConnectionError("Соединение с Redis закрыто")
+        kind, payload = line[:1], line[1:-2]
+        if kind == b'+':
+            return payload.decode('utf-8')
+        if kind == b'-':
+            raise RedisError(payload.decode('utf-8'))
+        if kind == b':':
+            return int(payload)
+        if kind == b'$':
+            length = int(payload)
+            if length < 0:
+                return None
+            data = self._file.read(length + 2)
+            return data[:-2]
+        if kind == b'*':
+            length = int(payload)
+            return None if length < 0 else [self._reply() for _ in range(length)]
+        raise RedisError(f"Неизвестный ответ Redis: {line!r}")
+
+
+def _login_digest(apiLogin: str) -> str:
+    """ Отпечаток логина API для ключей кэшей и общего хранилища: сам логин туда не попадает"""
+    return hashlib.sha256(apiLogin.encode('utf-8')).hexdigest()[:32]
+
+
+def token_key(apiLogin: str) -> str:
+    """ Ключ токена в общем хранилище"""
+    return "token:" + _login_digest(apiLogin)
+
+
+class _RefreshScheduler:
+    """ Отложенное обновление токенов всех TokenManager процесса в одном фоновом потоке.
+    Задание хранит слабую ссылку на TokenManager, поэтому не удерживает брошенный клиент,
+    а само обновление выполняется в отдельном коротком потоке и не задерживает остальные задания.
+    """
+
+    def __init__(self):
+        self._queue = []  # куча [момент, номер, слабая ссылка или None после отмены]
+        self._count = 0
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def schedule(self, delay: float, manager) -> list:
+        """ Планирует manager._background_refresh() через delay секунд
+        :return: задание для cancel
+        """
+        with self._condition:
+            self._count += 1
+            entry = [time.monotonic() + delay, self._count, weakref.ref(manager)]
+            heapq.heappush(self._queue, entry)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='iiko-token-refresh', daemon=True)
+                self._thread.start()
+            self._condition.notify()
+        return entry
+
+    def cancel(self, entry: list):
+        with self._condition:
+            entry[2] = None
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._queue or self._queue[0][0] > time.monotonic():
+                    self._condition.wait(self._queue[0][0] - time.monotonic() if self._queue else None)
+                entry = heapq.heappop(self._queue)
+                manager = entry[2]() if entry[2] is not None else None
+            if manager is not None:
+                threading.Thread(target=manager._background_refresh, daemon=True).start()
+
+
+_scheduler = _RefreshScheduler()
+
+
+class TokenManager:
+    """ Хранит токен доступа и обновляет его заранее, в фоне, незадолго до истечения срока жизни.
+    Одновременно выполняется только одно обновление, остальные вызовы ожидают его результата.
+    С общим хранилищем (backend) токен делят все процессы: его запрашивает у API только процесс,
+    захвативший блокировку, остальные ждут и берут токен из хранилища.
+    """
+    lifetime = 3600  # The standard token lifetime is 1 hour.
+    lock_poll = 0.05  # как часто проверять общее хранилище, пока токен обновляет другой процесс
+
+    def __init__(self, fetch, refresh_margin: float = 300, retry_interval: float = 30, background: bool = True,
+                 backend: SharedBackend = None, key: str = 'token', lock_ttl: float = 30):
+        """
+        :param fetch: функция без аргументов, возвращающая новый токен или None
+        :param refresh_margin (optional): за сколько секунд до истечения обновлять токен
+        :param retry_interval (optional): пауза перед повтором неудачного фонового обновления
+        :param background (optional): True - обновлять токен в фоновом потоке
+        :param backend (optional): SharedBackend для общего токена процессов
+        :param key (optional): ключ токена в общем хранилище
+        :param lock_ttl (optional): срок блокировки обновления. Остальные процессы ждут токен, пока блокировка
+            занята; если захвативший её процесс завершился, через lock_ttl её захватывает другой процесс.
+            Запрос токена при общем хранилище ограничен fetch_timeout, чтобы блокировка не истекла во время него
+        """
+        self.backend = backend
+        self.key = key
+        self.lock_ttl = lock_ttl
+        self.fetch = fetch
+        self.refresh_margin = refresh_margin
+        self.retry_interval = retry_interval
+        self.background = background
+        self.token = None
+        self.issued = None
+        self._expires = 0.0
+        self._lock = threading.Lock()
+        self._refreshing = None
+        self._timer = None
+
+    @property
+    def fetch_timeout(self):
+        """ Ограничение таймаута запроса токена: половина lock_ttl при общем хранилище, иначе None"""
+        return self.lock_ttl / 2 if self.backend is not None else None
+
+    def is_fresh(self) -> bool:
+        return bool(self.token) and time.monotonic() < self._expires
+
+    def get(self) -> str:
+        """ Возвращает действующий токен, при необходимости дожидаясь его обновления"""
+        token = self.token
+        if token and time.monotonic() < self._expires:
+            return token
+        return self.refresh(stale=token)
+
+    def refresh(self, stale: str = None) -> str:
+        """
+        Обновляет токен. Если обновление уже выполняется, ожидает его результата.
+        Ожидание и запрос токена ограничены текущим deadline.
+        :param stale: токен, который считается устаревшим; если текущий токен уже другой и действует,
+            повторный запрос не выполняется
+        :return: str - токен
+        :raises DeadlineExceeded: токен не получен до истечения deadline
+        """
+        with self._lock:
+            if self.token != stale and self.is_fresh():
+                return self.token
+            event = self._refreshing
+            leader = event is None
+            if leader:
+                event = self._refreshing = threading.Event()
+        if not leader:
+            if not event.wait(time_left("access_token")):
+                raise DeadlineExceeded("access_token")
+            return self.token
+        try:
+            token, lifetime = self._obtain(stale)
+            with self._lock:
+                if token:
+                    self.token = token
+                    self.issued = datetime.datetime.now()
+                    self._expires = time.monotonic() + lifetime
+                self._schedule(lifetime - self.refresh_margin if token else self.retry_interval)
+        finally:
+            with self._lock:
+                self._refreshing = None
+            event.set()
+        return self.token
+
+    def _obtain(self, stale: str):
+        """ Новый токен и срок его жизни в секундах"""
+        if self.backend is None:
+            return self.fetch(), self.lifetime
+        owner = None
+        try:
+            try:
+                # токен запрашивает только владелец блокировки, остальные ждут его в хранилище
+                while True:
+                    token, left = self._shared(stale)
+                    if token:
+                        return token, left
+                    if owner:
+                        break
+                    owner = self.backend.lock(self.key + ':lock', self.lock_ttl)
+                    if not owner:
+                        time.sleep(backoff_pause(self.lock_poll, "access_token"))
+            except BACKEND_ERRORS:
+                print("Общее хранилище токенов недоступно, токен запрашивается напрямую")
+            token = self.fetch()
+            if token:
+                self._publish(token)
+            return token, self.lifetime
+        finally:
+            if owner:
+                self._unlock(owner)
+
+    def _shared(self, stale: str):
+        """ Действующий токен из общего хранилища и оставшийся срок его жизни; (None, None) - токена нет"""
+        value = self.backend.get(self.key)
+        if value:
+            entry = json_loads(value)
+            left = entry["expires"] - time.time()
+            if entry["token"] != stale and left > 0:
+                return entry["token"], left
+        return None, None
+
+    def _publish(self, token: str):
+        try:
+            self.backend.set(self.key, json.dumps({"token": token, "expires": time.time() + self.lifetime}),
+                             self.lifetime)
+        except BACKEND_ERRORS:
+            print("Не удалось сохранить токен в общем хранилище")
+
+    def _unlock(self, owner: str):
+        try:
+            self.backend.unlock(self.key + ':lock', owner)
+        except BACKEND_ERRORS:
+            pass  # блокировка освободится сама по истечении lock_ttl
+
+    def invalidate(self, token: str):
+        """ Помечает токен недействительным (например, после ответа 401)"""
+        with self._lock:
+            if self.token == token:
+                self._expires = 0.0
+
+    def close(self):
+        """ Останавливает фоновое обновление; токен по-прежнему можно получить через get"""
+        with self._lock:
+            self.background = False
+            if self._timer:
+                _scheduler.cancel(self._timer)
+                self._timer = None
+
+    def _schedule(self, delay: float):
+        if not self.background:
+            return
+        if self._timer:
+            _scheduler.cancel(self._timer)
+        self._timer = _scheduler.schedule(max(delay, 0), self)
+
+    def _background_refresh(self):
+        if self.background:
+            self.refresh(stale=self.token)
+
+
+class AsyncTokenManager(TokenManager):
+    """ Вариант TokenManager для asyncio: фоновое обновление выполняется задачей в event loop"""
+
+    def __init__(self, fetch, refresh_margin: float = 300, retry_interval: float = 30, background: bool = True,
+                 backend: SharedBackend = None, key: str = 'token', lock_ttl: float = 30):
+        """
+        :param fetch: корутинная функция без аргументов, возвращающая новый токен или None
+        """
+        super().__init__(fetch, refresh_margin, retry_interval, background, backend, key, lock_ttl)
+        self._task = None
+
+    async def get(self) -> str:
+        token = self.token
+        if token and time.monotonic() < self._expires:
+            return token
+        return await self.refresh(stale=token)
+
+    async def refresh(self, stale: str = None) -> str:
+        if self.token != stale and self.is_fresh():
+            return self.token
+        if self._refreshing is not None:
+            try:
+                return await asyncio.wait_for(asyncio.shield(self._refreshing), time_left("access_token"))
+            except asyncio.TimeoutError:
+                raise DeadlineExceeded("access_token") from None
+        self._refreshing = asyncio.get_running_loop().create_future()
+        future = self._refreshing
+        try:
+            token, lifetime = await self._obtain(stale)
+            if token:
+                self.token = token
+                self.issued = datetime.datetime.now()
+                self._expires = time.monotonic() + lifetime
+            self._schedule(lifetime - self.refresh_margin if token else self.retry_interval)
+        finally:
+            self._refreshing = None
+            future.set_result(self.token)
+        return self.token
+
+    async def _obtain(self, stale: str):
+        """ Как TokenManager._obtain; обращения к общему хранилищу выполняются в потоках"""
+        if self.backend is None:
+            return await self.fetch(), self.lifetime
+        owner = None
+        try:
+            try:
+                while True:
+                    token, left = await asyncio.to_thread(self._shared, stale)
+                    if token:
+                        return token, left
+                    if owner:
+                        break
+                    owner = await asyncio.to_thread(self.backend.lock, self.key + ':lock', self.lock_ttl)
+                    if not owner:
+                        await asyncio.sleep(backoff_pause(self.lock_poll, "access_token"))
+            except BACKEND_ERRORS:
+                print("Общее хранилище токенов недоступно, токен запрашивается напрямую")
+            token = await self.fetch()
+            if token:
+                await asyncio.to_thread(self._publish, token)
+            return token, self.lifetime
+        finally:
+            if owner:
+                await asyncio.to_thread(self._unlock, owner)
+
+    def invalidate(self, token: str):
+        if self.token == token:
+            self._expires = 0.0
+
+    def close(self):
+        self.background = False
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+
+    def _schedule(self, delay: float):
+        if not self.background:
+            return
+        if self._timer:
+            self._timer.cancel()
+        loop = asyncio.get_running_loop()
+        self._timer = loop.call_later(max(delay, 0), self._background_refresh)
+
+    def _background_refresh(self):
+        self._task = asyncio.ensure_future(self.refresh(stale=self.token))
+
+
+class CustomerCache:
+    """ Ограниченный по размеру LRU-кэш клиентов со сроком жизни записей.
+    Клиент, полученный по любому ключу, индексируется по всем своим ключам: id, телефону,
+    номерам и трекам карт, поэтому повторный поиск по любому из них не обращается к API.
+    Возвращаемые из кэша ответы общие для всех вызовов, изменять их нельзя.
+    Ответ, запрошенный до сброса клиента (invalidate), не сохраняется: put с номером generation(),
+    полученным перед запросом, пропускает клиента, если его сбросили после этого.
+    """
+    journal_size = 1024  # сколько последних сбросов помнит кэш для проверки ответов в пути
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 300):
+        """
+        :param maxsize (optional): максимальное число клиентов в кэше
+        :param ttl (optional): срок жизни записи в секундах
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()  # (organizationId, id) -> (expires, customer, keys)
+        self._index = {}  # (organizationId, type, value) -> (organizationId, id)
+        self._generation = 0  # номер последнего сброса
+        self._journal = deque(maxlen=self.journal_size)  # (номер сброса, organizationId, type, value)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def customer_keys(customer: dict) -> set:
+        """ Все ключи поиска клиента в виде пар (type, value)"""
+        keys = {("id", customer["id"])}
+        if customer.get("phone"):
+            keys.add(("phone", customer["phone"]))
+        for card in customer.get("cards") or ():
+            if card.get("number"):
+                keys.add(("cardNumber", card["number"]))
+            if card.get("track"):
+                keys.add(("cardTrack", card["track"]))
+        return keys
+
+    def get(self, organizationId: str, type: str, value: str):
+        """ Клиент по ключу поиска или None"""
+        with self._lock:
+            entry_key = self._index.get((organizationId, type, value))
+            entry = self._entries.get(entry_key)
+            if entry is None:
+                return None
+            if entry[0] < time.monotonic():
+                self._drop(entry_key)
+                return None
+            self._entries.move_to_end(entry_key)
+            return entry[1]
+
+    def generation(self) -> int:
+        """ Номер последнего сброса, берётся перед запросом customer/info и передаётся в put"""
+        return self._generation
+
+    def put(self, organizationId: str, customer: dict, generation: int = None):
+        """ Сохраняет ответ customer/info под всеми ключами клиента
+        :param generation (optional): generation() перед запросом; ответ не сохраняется, если клиента
+            сбросили после этого
+        """
+        if not isinstance(customer, dict) or not customer.get("id"):
+            return
+        entry_key = (organizationId, customer["id"])
+        keys = self.customer_keys(customer)
+        with self._lock:
+            if generation is not None and self._invalidated_since(generation, organizationId, keys):
+                return
+            self._drop(entry_key)
+            for type, value in keys:
+                self._drop(self._index.get((organizationId, type, value)))
+                self._index[(organizationId, type, value)] = entry_key
+            self._entries[entry_key] = (time.monotonic() + self.ttl, customer, keys)
+            while len(self._entries) > self.maxsize:
+                self._drop(next(iter(self._entries)))
+
+    def invalidate(self, organizationId: str, **keys):
+        """
+        Удаляет из кэша клиентов, найденных по любому из ключей
+        :param keys: id, phone, cardNumber, cardTrack
+        """
+        with self._lock:
+            self._generation += 1
+            for type, value in keys.items():
+                if value:
+                    self._journal.append((self._generation, organizationId, type, value))
+                    self._drop(self._index.get((organizationId, type, value)))
+                    if type == "id":
+                        self._drop((organizationId, value))
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._journal.append((self._generation, None, None, None))
+            self._entries.clear()
+            self._index.clear()
+
+    def _invalidated_since(self, generation: int, organizationId: str, keys: set) -> bool:
+        """ Клиента сбросили после сброса номер generation; если журнал уже не помнит все сбросы
+        после него, считается, что сбросили"""
+        if generation == self._generation:
+            return False
+        if not self._journal or self._journal[0][0] > generation:
+            return True
+        return any(number > generation and (organization is None
+                                            or (organization == organizationId and (type, value) in keys))
+                   for number, organization, type, value in self._journal)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _drop(self, entry_key):
+        entry = self._entries.pop(entry_key, None)
+        if entry is None:
+            return
+        for type, value in entry[2]:
+            if self._index.get((entry_key[0], type, value)) == entry_key:
+                del self._index[(entry_key[0], type, value)]
+
+
+class CustomerReplica:
+    """ Локальная реплика клиентов в SQLite с индексами по id, телефону, номеру и треку карты.
+    Заполняется ответами customer/info и собственными изменениями через create_or_update_customer.
+    Клиент с replica сначала ищет в реплике (local-first) и обращается к API, только если клиента нет
+    или запись старше max_age. Записи, изменённые через API, помечаются устаревшими;
+    refresh_replica клиента обновляет самые старые записи порциями.
+    """
+    fields = {"name": "name", "middleName": "middleName", "surName": "surname", "birthday": "birthday",
+              "email": "email", "sex": "sex", "phone": "phone", "comment": "comment", "cultureName": "cultureName",
+              "userData": "userData", "consentStatus": "consentStatus"}  # поле create_or_update -> customer/info
+
+    def __init__(self, path: str, max_age: float = 3600):
+        """
+        :param path: путь к файлу базы SQLite, ':memory:' - реплика только в памяти процесса
+        :param max_age (optional): сколько секунд запись реплики отдаётся без обращения к API
+        """
+        self.path = path
+        self.max_age = max_age
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS customers (organization_id TEXT NOT NULL, id TEXT NOT NULL, "
+                         "data TEXT NOT NULL, updated REAL NOT NULL, PRIMARY KEY (organization_id, id))")
+        self._db.execute("CREATE INDEX IF NOT EXISTS customers_updated ON customers (organization_id, updated)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS customer_keys (organization_id TEXT NOT NULL, "
+                         "type TEXT NOT NULL, value TEXT NOT NULL, customer_id TEXT NOT NULL, "
+                         "PRIMARY KEY (organization_id, type, value)) WITHOUT ROWID")
+        self._db.execute("CREATE INDEX IF NOT EXISTS customer_keys_customer "
+                         "ON customer_keys (organization_id, customer_id)")
+        self._lock = threading.Lock()
+
+    def get(self, organizationId: str, type: str, value: str, max_age: float = None):
+        """ Клиент по ключу поиска, если запись не старше max_age, иначе None"""
+        max_age = self.max_age if max_age is None else max_age
+        with self._lock:
+            if type == "id":
+                row = self._db.execute("SELECT data, updated FROM customers WHERE organization_id = ? AND id = ?",
+                                       (organizationId, value)).fetchone()
+            else:
+                row = self._db.execute("SELECT c.data, c.updated FROM customer_keys k JOIN customers c "
+                                       "ON c.organization_id = k.organization_id AND c.id = k.customer_id "
+                                       "WHERE k.organization_id = ? AND k.type = ? AND k.value = ?",
+                                       (organizationId, type, value)).fetchone()
+        if row is None or time.time() - row[1] > max_age:
+            return None
+        return json_loads(row[0])
+
+    def put(self, organizationId: str, customer: dict, updated: float = None):
+        """ Сохраняет ответ customer/info и ключи поиска клиента"""
+        if not isinstance(customer, dict) or not customer.get("id"):
+            return
+        keys = [(organizationId, type, value, customer["id"])
+                for type, value in CustomerCache.customer_keys(customer) if type != "id"]
+        with self._lock, self._db:
+            self._db.execute("BEGIN")
+            self._db.execute("INSERT OR REPLACE INTO customers VALUES (?, ?, ?, ?)",
+                             (organizationId, customer["id"], json.dumps(customer, ensure_ascii=False),
+                              time.time() if updated is None else updated))
+            self._db.execute("DELETE FROM customer_keys WHERE organization_id = ? AND customer_id = ?",
+                             (organizationId, customer["id"]))
+            self._db.executemany("INSERT OR REPLACE INTO customer_keys VALUES (?, ?, ?, ?)", keys)
+
+    def apply(self, organizationId: str, customerId: str, payload: dict):
+        """ Переносит в реплику поля, отправленные через create_or_update_customer.
+        Клиент, которого ещё нет в реплике, не добавляется: полные данные придут при следующем поиске.
+        """
+        customer = self.get(organizationId, "id", customerId, max_age=float('inf'))
+        if customer is None:
+            return
+        for field, name in self.fields.items():
+            if field in payload:
+                customer[name] = payload[field]
+        self.put(organizationId, customer)
+
+    def invalidate(self, organizationId: str, **keys):
+        """
+        Помечает устаревшими клиентов, найденных по любому из ключей
+        :param keys: id, phone, cardNumber, cardTrack
+        """
+        with self._lock:
+            for type, value in keys.items():
+                if not value:
+                    continue
+                if type == "id":
+                    self._db.execute("UPDATE customers SET updated = 0 WHERE organization_id = ? AND id = ?",
+                                     (organizationId, value))
+                else:
+                    self._db.execute("UPDATE customers SET updated = 0 WHERE organization_id = ? AND id = "
+                                     "(SELECT customer_id FROM customer_keys WHERE organization_id = ? "
+                                     "AND type = ? AND value = ?)", (organizationId, organizationId, type, value))
+
+    def stale(self, organizationId: str, limit: int = 100) -> list:
+        """ id самых старых записей, которые старше max_age"""
+        with self._lock:
+            rows = self._db.execute("SELECT id FROM customers WHERE organization_id = ? AND updated < ? "
+                                    "ORDER BY updated LIMIT ?",
+                                    (organizationId, time.time() - self.max_age, limit)).fetchall()
+        return [row[0] for row in rows]
+
+    def delete(self, organizationId: str, customerId: str):
+        with self._lock, self._db:
+            self._db.execute("BEGIN")
+            self._db.execute("DELETE FROM customers WHERE organization_id = ? AND id = ?",
+                             (organizationId, customerId))
+            self._db.execute("DELETE FROM customer_keys WHERE organization_id = ? AND customer_id = ?",
+                             (organizationId, customerId))
+
+    def close(self):
+        self._db.close()
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM customers").fetchone()[0]
+
+
+class ReferenceCache:
+    """ Кэш справочных данных: организаций, программ и категорий лояльности, терминальных групп.
+    Устаревшая запись отдаётся сразу, а обновляется в фоне (stale-while-revalidate).
+    При указании snapshot_path содержимое сохраняется на диск, и новый процесс стартует без запросов к API.
+    Ключ записи содержит отпечаток apiLogin, поэтому один кэш, файл снимка и хранилище можно использовать
+    для разных логинов (например, во всех клиентах IikoClientPool): ответы логинов не смешиваются.
+    С общим хранилищем (backend) процессы делят ответы: запись, которой нет в памяти или которая устарела,
+    читается из хранилища, а фоновое обновление записи выполняет только один процесс.
+    """
+    refresh_lock_ttl = 60
+
+    def __init__(self, ttl: float = 3600, max_stale: float = None, snapshot_path: str = None,
+                 backend: SharedBackend = None, namespace: str = 'reference:'):
+        """
+        :param ttl (optional): через сколько секунд запись считается устаревшей
+        :param max_stale (optional): возраст, после которого устаревшая запись не отдаётся, None - без ограничения
+        :param snapshot_path (optional): путь к файлу снимка на диске
+        :param backend (optional): SharedBackend для общих с другими процессами ответов
+        :param namespace (optional): префикс ключей в общем хранилище
+        """
+        self.backend = backend
+        self.namespace = namespace
+        self._owners = {}  # key -> метка блокировки обновления в общем хранилище
+        self.ttl = ttl
+        self.max_stale = max_stale
+        self.snapshot_path = snapshot_path
+        self._entries = {}  # key -> (stored, value)
+        self._refreshing = set()
+        self._lock = threading.Lock()
+        if snapshot_path:
+            self.load()
+
+    @staticmethod
+    def key(path: str, data: dict, apiLogin: str = None) -> str:
+        """ Ключ записи: логин API, путь и тело запроса"""
+        prefix = _login_digest(apiLogin) + " " if apiLogin else ""
+        return f"{prefix}{path} {json.dumps(data, sort_keys=True)}"
+
+    def lookup(self, key: str):
+        """
+        :return: (value, state), state: 'fresh', 'stale' или None, если записи нет
+        """
+        entry = self._entries.get(key)
+        if self.backend is not None and (entry is None or time.time() - entry[0] >= self.ttl):
+            entry = self._load_shared(key, entry)
+        if entry is None:
+            return None, None
+        age = time.time() - entry[0]
+        if age < self.ttl:
+            return entry[1], 'fresh'
+        if self.max_stale is not None and age > self.max_stale:
+            return None, None
+        return entry[1], 'stale'
+
+    def store(self, key: str, value):
+        """ Сохраняет успешный ответ API и обновляет снимок на диске"""
+        if not isinstance(value, dict) or 'errorDescription' in value:
+            return
+        entry = (time.time(), value)
+        with self._lock:
+            self._entries[key] = entry
+        if self.backend is not None:
+            try:
+                self.backend.set(self.namespace + key, json.dumps(entry, ensure_ascii=False), self.max_stale)
+            except BACKEND_ERRORS:
+                print("Не удалось сохранить справочник в общем хранилище")
+        if self.snapshot_path:
+            self.save()
+
+    def _load_shared(self, key: str, entry):
+        """ Запись из общего хранилища, если она новее entry"""
+        try:
+            value = self.backend.get(self.namespace + key)
+        except BACKEND_ERRORS:
+            return entry
+        if value is None:
+            return entry
+        shared = tuple(json_loads(value))
+        if entry is not None and entry[0] >= shared[0]:
+            return entry
+        with self._lock:
+            self._entries[key] = shared
+        return shared
+
+    def begin_refresh(self, key: str) -> bool:
+        """ Отмечает начало фонового обновления; False - обновление уже выполняется в этом или другом процессе"""
+        with self._lock:
+            if key in self._refreshing:
+                return False
+            self._refreshing.add(key)
+        if self.backend is not None:
+            try:
+                owner = self.backend.lock(self.namespace + key + ':refresh', self.refresh_lock_ttl)
+            except BACKEND_ERRORS:
+                owner = ''  # хранилище недоступно - обновляем сами
+            if owner is None:
+                self.end_refresh(key)
+                return False
+            self._owners[key] = owner
+        return True
+
+    def end_refresh(self, key: str):
+        owner = self._owners.pop(key, None)
+        if owner:
+            try:
+                self.backend.unlock(self.namespace + key + ':refresh', owner)
+            except BACKEND_ERRORS:
+                pass
+        with self._lock:
+            self._refreshing.discard(key)
+
+    def load(self):
+        """ Загружает снимок с диска"""
+        try:
+            with open(self.snapshot_path, encoding='utf-8') as file:
+                snapshot = json.load(file)
+        except (OSError, ValueError):
+            return
+        with self._lock:
+            for key, (stored, value) in snapshot.items():
+                if key not in self._entries or self._entries[key][0] < stored:
+                    self._entries[key] = (stored, value)
+
+    def save(self):
+        """ Атомарно записывает снимок на диск"""
+        with self._lock:
+            try:
+                write_json_atomic(self.snapshot_path, self._entries)
+            except OSError:
+                print(f"Не удалось сохранить снимок справочников в {self.snapshot_path}")
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class WriteBehindQueue:
+    """ Надёжная очередь изменений клиентов (карты, категории, программы, create_or_update) в SQLite.
+    Клиент с write_behind записывает изменение в очередь и сразу возвращает управление,
+    а фоновые потоки отправляют изменения в API. Изменения одного клиента отправляются строго по порядку,
+    при недоступности API повторяются с растущей паузой. Идущие подряд create_or_update одного клиента
+    объединяются в один вызов, одинаковые подряд идущие изменения отправляются один раз.
+    Очередь переживает перезапуск процесса: неотправленные изменения отправляются после start().
+    Изменение отправляет клиент того apiLogin, которым оно записано, поэтому одну очередь
+    могут использовать клиенты разных логинов (например, все клиенты IikoClientPool).
+    """
+    merge_paths = ("loyalty/iiko/customer/create_or_update",)
+
+    def __init__(self, path: str, workers: int = 2, max_attempts: int = None, backoff: float = 1.0,
+                 max_backoff: float = 300.0, poll_interval: float = 1.0):
+        """
+        :param path: путь к файлу базы SQLite
+        :param workers (optional): число фоновых потоков отправки
+        :param max_attempts (optional): после стольких неудачных попыток изменение помечается failed,
+            None - повторять, пока API не станет доступно
+        :param backoff (optional): пауза перед первым повтором в секундах, далее удваивается
+        :param max_backoff (optional): максимальная пауза между повторами
+        :param poll_interval (optional): как часто потоки проверяют очередь без новых записей
+        """
+        self.path = path
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.poll_interval = poll_interval
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS mutations (id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                         "key TEXT NOT NULL, path TEXT NOT NULL, data TEXT NOT NULL, "
+                         "state TEXT NOT NULL DEFAULT 'pending', attempts INTEGER NOT NULL DEFAULT 0, "
+                         "next_at REAL NOT NULL DEFAULT 0, error TEXT)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS mutations_state_key ON mutations (state, key, id)")
+        if "login" not in [column[1] for column in self._db.execute("PRAGMA table_info(mutations)")]:
+            self._db.execute("ALTER TABLE mutations ADD COLUMN login TEXT")  # очередь прежней версии
+        self._lock = threading.Condition()
+        self._busy = set()  # ключи клиентов, изменения которых сейчас отправляются
+        self._threads = []
+        self._senders = {}  # apiLogin -> функция отправки
+        self._closed = False
+
+    @staticmethod
+    def key(data: dict) -> str:
+        """ Ключ порядка: организация и клиент (id, а для нового клиента - телефон или карта).
+        Порядок соблюдается только для изменений с одинаковым ключом: изменение по телефону и следующее
+        изменение того же клиента по id могут отправиться одновременно, поэтому, когда id клиента
+        известен, его нужно передавать и в create_or_update_customer.
+        """
+        customer = (data.get("customerId") or data.get("id") or data.get("phone") or data.get("cardTrack")
+                    or data.get("cardNumber"))
+        return f"{data.get('organizationId')}:{customer}"
+
+    def start(self, sender, login: str = None):
+        """ Задаёт функцию отправки изменений логина и при первом вызове запускает фоновые потоки.
+        Повторный вызов для того же логина заменяет функцию отправки.
+        :param sender: функция (path, data) -> ответ API, при ошибке вызывает IikoError
+        :param login (optional): apiLogin, изменения которого отправляет sender
+        """
+        with self._lock:
+            self._senders[login] = sender
+            self._lock.notify_all()
+            if self._threads:
+                return
+            for _ in range(self.workers):
+                thread = threading.Thread(target=self._work, daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def detach(self, sender, login: str = None):
+        """ Отменяет функцию отправки, заданную start, если её ещё не заменили;
+        изменения логина остаются в очереди до следующего start"""
+        with self._lock:
+            if self._senders.get(login) == sender:
+                del self._senders[login]
+
+    def put(self, path: str, data: dict, login: str = None) -> int:
+        """ Записывает изменение в очередь
+        :param login (optional): apiLogin, клиент которого отправит изменение
+        :return: номер записи в очереди
+        """
+        with self._lock:
+            row = self._db.execute("INSERT INTO mutations (key, path, data, login) VALUES (?, ?, ?, ?)",
+                                   (self.key(data), path, json.dumps(data, ensure_ascii=False), login)).lastrowid
+            self._lock.notify()
+        return row
+
+    def pending(self) -> int:
+        """ Число неотправленных изменений"""
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM mutations WHERE state = 'pending'").fetchone()[0]
+
+    def failed(self) -> list:
+        """ Изменения, отклонённые API или исчерпавшие попытки: [(id, path, data, error)]"""
+        with self._lock:
+            rows = self._db.execute("SELECT id, path, data, error FROM mutations WHERE state = 'failed' "
+                                    "ORDER BY id").fetchall()
+        return [(row, path, json.loads(data), error) for row, path, data, error in rows]
+
+    def drain(self, timeout: float = None) -> bool:
+        """ Ждёт отправки изменений логинов, для которых задана функция отправки (start), включая повторы
+        после паузы. Изменения логинов без функции отправки не ожидаются. Пока API недоступно и max_attempts=None,
+        ожидание без timeout не завершится.
+        :return: True - неотправленных изменений логинов с функцией отправки не осталось
+        """
+        until = time.monotonic() + timeout if timeout is not None else None
+        with self._lock:
+            while any(self._sender(login) is not None for login, in self._db.execute(
+                    "SELECT DISTINCT login FROM mutations WHERE state = 'pending'")):
+                left = until - time.monotonic() if until is not None else self.poll_interval
+                if left <= 0:
+                    return False
+                self._lock.wait(min(left, self.poll_interval))
+            return True
+
+    def close(self):
+        """ Останавливает фоновые потоки; неотправленные изменения остаются в базе"""
+        with self._lock:
+            self._closed = True
+            self._lock.notify_all()
+        for thread in self._threads:
+            thread.join()
+        self._db.close()
+
+    def logins(self) -> list:
+        """ Логины, для которых в очереди есть неотправленные изменения"""
+        with self._lock:
+            return [login for login, in self._db.execute("SELECT DISTINCT login FROM mutations "
+                                                         "WHERE state = 'pending'")]
+
+    def _sender(self, login: str):
+        """ Функция отправки для логина; изменения очереди прежней версии, без логина, отправляет любой клиент"""
+        sender = self._senders.get(login)
+        if sender is None and login is None and self._senders:
+            sender = next(iter(self._senders.values()))
+        return sender
+
+    def _claim(self):
+        """ Первое по порядку изменение свободного клиента и идущие за ним изменения, которые можно объединить"""
+        rows = self._db.execute("SELECT m.id, m.key, m.path, m.data, m.attempts, m.login FROM mutations m "
+                                "WHERE m.state = 'pending' AND m.next_at <= ? AND m.id = "
+                                "(SELECT MIN(id) FROM mutations WHERE key = m.key AND state = 'pending') "
+                                "ORDER BY m.id", (time.time(),)).fetchall()
+        for row, key, path, data, attempts, login in rows:
+            sender = self._sender(login)
+            if key in self._busy or sender is None:
+                continue
+            self._busy.add(key)
+            ids, data = [row], json.loads(data)
+            following = self._db.execute("SELECT id, path, data, login FROM mutations WHERE key = ? "
+                                         "AND state = 'pending' AND id > ? ORDER BY id", (key, row)).fetchall()
+            for next_row, next_path, next_data, next_login in following:
+                next_data = json.loads(next_data)
+                if next_path != path or next_login != login or (next_data != data and path not in self.merge_paths):
+                    break
+                data = {**data, **next_data}
+                ids.append(next_row)
+            return key, ids, path, data, attempts, sender
+        return None
+
+    def _work(self):
+        while True:
+            with self._lock:
+                claimed = None
+                while not self._closed:
+                    claimed = self._claim()
+                    if claimed:
+                        break
+                    self._lock.wait(self.poll_interval)
+                if claimed is None:
+                    return
+            key, ids, path, data, attempts, sender = claimed
+            try:
+                result = sender(path, data)
+            except IikoError as exc:
+                retryable = not isinstance(exc, IikoHTTPError) or exc.status == 429 or exc.status >= 500
+                self._fail(ids, path, attempts, repr(exc), retryable)
+            except Exception as exc:
+                # например, ответ не в формате JSON: изменение могло быть принято, поэтому не повторяется
+                self._fail(ids, path, attempts, repr(exc), False)
+            else:
+                if isinstance(result, dict) and 'errorDescription' in result:
+                    self._fail(ids, path, attempts, result['errorDescription'], False)
+                else:
+                    with self._lock:
+                        self._db.executemany("DELETE FROM mutations WHERE id = ?", [(row,) for row in ids])
+            finally:
+                with self._lock:
+                    self._busy.discard(key)
+                    self._lock.notify_all()
+
+    def _fail(self, ids: list, path: str, attempts: int, error: str, retryable: bool):
+        attempts += 1
+        with self._lock:
+            if retryable and (self.max_attempts is None or attempts < self.max_attempts):
+                delay = min(self.max_backoff, self.backoff * 2 ** (attempts - 1))
+                self._db.execute("UPDATE mutations SET attempts = ?, next_at = ?, error = ? WHERE id = ?",
+                                 (attempts, time.time() + delay, error, ids[0]))
+            else:
+                # запись с ошибкой выходит из очереди, чтобы не задерживать следующие изменения клиента
+                self._db.executemany("UPDATE mutations SET state = 'failed', attempts = ?, error = ? WHERE id = ?",
+                                     [(attempts, error, row) for row in ids])
+                print(f"Не удалось отправить изменение {path}: {error}")
+
+
+class ChangeTracker:
+    """ Отпечатки последних успешно отправленных create_or_update_customer по ключу клиента (id, телефон или
+    трек карты). Запись, совпадающая с последней отправленной, не отправляется повторно.
+    Отпечаток - 12 байт хэша payload, поэтому в памяти помещаются миллионы клиентов.
+    При указании path отпечатки хранятся в SQLite и переживают перезапуск.
+    """
+
+    def __init__(self, path: str = None, flush_every: int = 1000):
+        """
+        :param path (optional): путь к файлу базы SQLite, None - только в памяти
+        :param flush_every (optional): через сколько новых отпечатков записывать их на диск
+        """
+        self.path = path
+        self.flush_every = flush_every
+        self._fingerprints = {}
+        self._dirty = {}
+        self._lock = threading.Lock()
+        self._db = None
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+            self._db.execute("CREATE TABLE IF NOT EXISTS fingerprints (key TEXT PRIMARY KEY, "
+                             "fingerprint BLOB NOT NULL) WITHOUT ROWID")
+            self._fingerprints.update(self._db.execute("SELECT key, fingerprint FROM fingerprints"))
+
+    @staticmethod
+    def key(organizationId: str, payload: dict):
+        """ Ключ клиента или None, если в payload нет ни id, ни телефона, ни трека карты"""
+        for field in ("id", "phone", "cardTrack"):
+            if payload.get(field):
+                return f"{organizationId}:{field}:{payload[field]}"
+        return None
+
+    @staticmethod
+    def fingerprint(payload: dict) -> bytes:
+        return hashlib.blake2b(json.dumps(payload, sort_keys=True, ensure_ascii=False).encode('utf-8'),
+                               digest_size=12).digest()
+
+    def unchanged(self, organizationId: str, payload: dict) -> bool:
+        """ True - такой же payload уже был успешно отправлен"""
+        key = self.key(organizationId, payload)
+        return key is not None and self._fingerprints.get(key) == self.fingerprint(payload)
+
+    def record(self, organizationId: str, payload: dict):
+        """ Запоминает успешно отправленный payload"""
+        key = self.key(organizationId, payload)
+        if key is None:
+            return
+        fingerprint = self.fingerprint(payload)
+        with self._lock:
+            self._fingerprints[key] = fingerprint
+            if self._db is not None:
+                self._dirty[key] = fingerprint
+                if len(self._dirty) >= self.flush_every:
+                    self._flush()
+
+    def forget(self, organizationId: str, payload: dict):
+        """ Удаляет отпечаток: следующий create_or_update клиента будет отправлен"""
+        key = self.key(organizationId, payload)
+        with self._lock:
+            if self._fingerprints.pop(key, None) is not None and self._db is not None:
+                self._dirty.pop(key, None)
+                self._db.execute("DELETE FROM fingerprints WHERE key = ?", (key,))
+
+    def flush(self):
+        """ Записывает новые отпечатки на диск"""
+        with self._lock:
+            self._flush()
+
+    def clear(self):
+        with self._lock:
+            self._fingerprints.clear()
+            self._dirty.clear()
+            if self._db is not None:
+                self._db.execute("DELETE FROM fingerprints")
+
+    def close(self):
+        if self._db is not None:
+            self.flush()
+            self._db.close()
+            self._db = None
+
+    def __len__(self):
+        return len(self._fingerprints)
+
+    def _flush(self):
+        if self._db is None or not self._dirty:
+            return
+        with self._db:
+            self._db.execute("BEGIN")
+            self._db.executemany("INSERT OR REPLACE INTO fingerprints VALUES (?, ?)", self._dirty.items())
+        self._dirty.clear()
+
+
+class _Nested:
+    """ Вложенная коллекция модели: разбирается в кортеж моделей при первом обращении"""
+
+    def __init__(self, model):
+        self.model = model
+
+    def __set_name__(self, owner, name):
+        self.name = name
+        self.slot = '_' + name
+
+    def __get__(self, obj, owner=None):
+        if obj is None:
+            return self
+        value = getattr(obj, self.slot)
+        if isinstance(value, list):
+            value = tuple(self.model.from_json(item) for item in value)
+            setattr(obj, self.slot, value)
+        return value if value is not None else ()
+
+
+class Model:
+    """ Базовый класс компактных моделей ответов API на __slots__.
+    Атрибуты называются так же, как поля JSON; неизвестные поля ответа не сохраняются.
+    """
+    __slots__ = ()
+    fields = ()
+    nested = ()
+
+    @classmethod
+    def from_json(cls, data: dict):
+        obj = cls.__new__(cls)
+        for name in cls.fields:
+            setattr(obj, name, data.get(name))
+        for name in cls.nested:
+            setattr(obj, '_' + name, data.get(name))
+        return obj
+
+    def to_dict(self) -> dict:
+        result = {name: getattr(self, name) for name in self.fields}
+        for name in self.nested:
+            result[name] = [item.to_dict() for item in getattr(self, name)]
+        return result
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.to_dict() == other.to_dict()
+
+    def __repr__(self):
+        return f"{type(self).__name__}(id={getattr(self, 'id', None)!r}, name={getattr(self, 'name', None)!r})"
+
+
+class Card(Model):
+    fields = ('id', 'track', 'number', 'validToDate')
+    __slots__ = fields
+
+
+class Category(Model):
+    fields = ('id', 'name', 'isActive', 'isDefaultForNewGuests')
+    __slots__ = fields
+
+
+class WalletBalance(Model):
+    fields = ('id', 'name', 'type', 'balance')
+    __slots__ = fields
+
+
+class Customer(Model):
+    """ Клиент программы лояльности (ответ customer/info); карты, категории и кошельки разбираются при обращении"""
+    fields = ('id', 'referrerId', 'name', 'surname', 'middleName', 'comment', 'phone', 'cultureName', 'birthday',
+              'email', 'sex', 'consentStatus', 'anonymized', 'userData', 'shouldReceivePromoActionsInfo',
+              'shouldReceiveLoyaltyInfo', 'shouldReceiveOrderStatusInfo', 'personalDataConsentFrom',
+              'personalDataConsentTo', 'personalDataProcessingFrom', 'personalDataProcessingTo', 'isDeleted')
+    nested = ('cards', 'categories', 'walletBalances')
+    __slots__ = fields + ('_cards', '_categories', '_walletBalances')
+    cards = _Nested(Card)
+    categories = _Nested(Category)
+    walletBalances = _Nested(WalletBalance)
+
+
+class Program(Model):
+    """ Программа лояльности"""
+    fields = ('id', 'name', 'description', 'serviceFrom', 'serviceTo', 'notifyAboutBalanceChanges', 'programType',
+              'isActive', 'walletId', 'appliedOrganizations', 'templateType', 'hasWelcomeBonus', 'welcomeBonusSum',
+              'isExchangeRateEnabled', 'refillType', 'marketingCampaigns')
+    __slots__ = fields
+
+
+class Organization(Model):
+    fields = ('id', 'name', 'code', 'responseType', 'country', 'restaurantAddress', 'latitude', 'longitude',
+              'useUaeAddressingSystem', 'version', 'currencyIsoName', 'currencyMinimumDenomination',
+              'countryPhoneCode', 'marketingSourceRequiredInDelivery', 'defaultDeliveryCityId',
+              'deliveryCityIds', 'deliveryServiceType', 'defaultCallCenterPaymentTypeId',
+              'orderItemCommentEnabled', 'inn', 'addressFormatType', 'isConfirmationEnabled',
+              'confirmAllowedIntervalInMinutes', 'isCloud', 'isAnonymousGuestsAllowed', 'addressLookup')
+    __slots__ = fields
+
+
+class TerminalGroup(Model):
+    fields = ('id', 'organizationId', 'name', 'address', 'timeZone')
+    __slots__ = fields
+
+
+def parse_list(model, key: str, result):
+    """ Список моделей из ответа API; ответ с ошибкой возвращается без изменений"""
+    if not isinstance(result, dict) or key not in result:
+        return result
+    return [model.from_json(item) for item in result[key]]
+
+
+def parse_terminal_groups(result):
+    """ Терминальные группы всех организаций одним списком"""
+    if not isinstance(result, dict) or 'terminalGroups' not in result:
+        return result
+    return [TerminalGroup.from_json(item) for group in result['terminalGroups'] for item in group.get('items', ())]
+
+
+def parse_customer(result):
+    if not isinstance(result, dict) or 'id' not in result:
+        return result
+    return Customer.from_json(result)
+
+
+REFERENCE_PARSERS = {
+    "organizations": functools.partial(parse_list, Organization, "organizations"),
+    "loyalty/iiko/program": functools.partial(parse_list, Program, "Programs"),
+    "loyalty/iiko/customer_category": functools.partial(parse_list, Category, "guestCategories"),
+    "reserve/available_organizations": functools.partial(parse_list, Organization, "organizations"),
+    "reserve/available_terminal_groups": parse_terminal_groups,
+}
+
+
+class PooledSession(requests.Session):
+    """ requests.Session для клиентов API с настраиваемым пулом соединений.
+    По умолчанию пул держит до 100 соединений к хосту вместо 10, поэтому при одновременных запросах
+    из многих потоков не открываются новые TLS-соединения. Cookies не сохраняются: после создания
+    сессия не меняется, а общий для потоков пул соединений urllib3 потокобезопасен.
+    Соединения, простаивавшие дольше idle_timeout, закрываются перед следующим запросом,
+    чтобы не отправлять запрос в соединение, уже закрытое сервером или балансировщиком.
+    """
+
+    def __init__(self, pool_maxsize: int = 100, pool_connections: int = 10, pool_block: bool = False,
+                 keepalive: bool = True, idle_timeout: float = 60):
+        """
+        :param pool_maxsize (optional): число соединений на хост
+        :param pool_connections (optional): число хостов, для которых хранятся пулы соединений
+        :param pool_block (optional): True - при занятом пуле ждать свободное соединение, а не открывать новое
+        :param keepalive (optional): False - закрывать соединение после каждого запроса
+        :param idle_timeout (optional): через сколько секунд простоя закрывать соединения, None - не закрывать
+        """
+        super().__init__()
+        self.cookies.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize,
+                                                pool_block=pool_block)
+        self.mount('https://', adapter)
+        self.mount('http://', adapter)
+        if not keepalive:
+            self.headers['Connection'] = 'close'
+        self.idle_timeout = idle_timeout
+        self._last_used = time.monotonic()
+
+    def request(self, *args, **kwargs):
+        if self.idle_timeout is not None:
+            now = time.monotonic()
+            if now - self._last_used > self.idle_timeout:
+                for adapter in self.adapters.values():
+                    adapter.close()
+            self._last_used = now
+        return super().request(*args, **kwargs)
+
+
+class HTTP2Session:
+    """ Сессия HTTP/2 на httpx.Client с тем же интерфейсом, что использует клиент у requests.Session.
+    Запросы к хосту мультиплексируются в одном соединении; ошибки httpx преобразуются в исключения requests.
+    Требует пакет httpx с поддержкой HTTP/2 (pip install httpx[http2]).
+    """
+
+    def __init__(self, pool_maxsize: int = 100, keepalive: bool = True, idle_timeout: float = 60):
+        if httpx is None:
+            raise ImportError("Для HTTP/2 необходимо установить пакет httpx[http2]")
+        limits = httpx.Limits(max_connections=pool_maxsize,
+                              max_keepalive_connections=pool_maxsize if keepalive else 0, keepalive_expiry=idle_timeout)
+        try:
+            self.client = httpx.Client(http2=True, limits=limits)
+        except ImportError as exc:
+            raise ImportError("Для HTTP/2 необходимо установить пакет httpx[http2]") from exc
+
+    def post(self, url: str, data: bytes = None, json: dict = None, headers: dict = None, timeout=None,
+             stream: bool = False):
+        if isinstance(timeout, tuple):
+            timeout = httpx.Timeout(timeout[1], connect=timeout[0])
+        try:
+            if stream:
+                request = self.client.build_request("POST", url, content=data, json=json, headers=headers,
+                                                    timeout=timeout)
+                return _StreamedResponse(self.client.send(request, stream=True))
+            return self.client.post(url, content=data, json=json, headers=headers, timeout=timeout)
+        except httpx.ConnectTimeout as exc:
+            raise requests.exceptions.ConnectTimeout(exc) from exc
+        except httpx.TimeoutException as exc:
+            raise requests.exceptions.Timeout(exc) from exc
+        except httpx.HTTPError as exc:
+            raise requests.exceptions.ConnectionError(exc) from exc
+
+    def close(self):
+        self.client.close()
+
+
+class _StreamedResponse:
+    """ Ответ httpx, читаемый по частям, с теми методами requests.Response, которые использует клиент"""
+
+    def __init__(self, response):
+        self.response = response
+        self.status_code = response.status_code
+        self.headers = response.headers
+
+    @property
+    def text(self) -> str:
+        self.response.read()
+        return self.response.text
+
+    def iter_content(self, chunk_size: int):
+        try:
+            yield from self.response.iter_bytes(chunk_size)
+        except httpx.HTTPError as exc:
+            raise requests.exceptions.ConnectionError(exc) from exc
+
+    def close(self):
+        self.response.close()
+
+
+def json_dumps(data) -> bytes:
+    """ Тело запроса в JSON"""
+    return orjson.dumps(data) if orjson is not None else json.dumps(data, ensure_ascii=False).encode('utf-8')
+
+
+class JSONItemStream:
+    """ Потоковый разбор JSON-ответа вида {..., key: [item, item, ...], ...}
+    или, с nested, {..., key: [{..., nested: [item, ...]}, ...], ...}.
+    Части ответа передаются в feed по мере получения; текст просматривается один раз, и каждый элемент
+    разбирается, как только получен целиком. В памяти хранится только ещё не разобранный остаток ответа.
+    """
+    _structure = re.compile(r'["{}\[\]]')
+    _string_end = re.compile(r'["\\]')
+    _separator = re.compile(r'[\s,]*')
+    _scalar_end = re.compile(r'[\s,\]]')
+
+    def __init__(self, key: str, nested: str = None):
+        """
+        :param key: ключ массива в объекте верхнего уровня
+        :param nested (optional): ключ вложенного массива в каждом элементе массива key;
+            выдаются элементы вложенных массивов
+        """
+        self.keys = (key, nested) if nested else (key,)
+        self.found = False  # начало массива key получено
+        self.done = False  # массив key получен до конца
+        self._utf8 = codecs.getincrementaldecoder('utf-8')()
+        self._text = ''
+        self._pos = 0  # до этой позиции текст уже просмотрен
+        self._stack = []  # открытые объекты и массивы: (символ, номер ключа пути или None вне пути)
+        self._in_string = False
+        self._key_start = None  # начало строки в объекте на пути к массиву - возможного ключа
+        self._last_key = None
+        self._item_start = None  # начало элемента, ещё не полученного целиком
+
+    def feed(self, chunk: bytes) -> list:
+        """ Добавляет часть ответа
+        :return: элементы, полученные целиком
+        """
+        if self.done:
+            return []
+        self._text += self._utf8.decode(chunk)
+        items = []
+        pos = self._scan(items)
+        keep = min(position for position in (pos, self._key_start, self._item_start) if position is not None)
+        self._text = self._text[keep:]
+        self._pos = pos - keep
+        if self._key_start is not None:
+            self._key_start -= keep
+        if self._item_start is not None:
+            self._item_start -= keep
+        return items
+
+    def _in_items(self) -> bool:
+        """ Просмотр находится внутри массива, элементы которого выдаются, между элементами"""
+        return (self._item_start is None and bool(self._stack) and self._stack[-1][0] == '['
+                and self._stack[-1][1] == len(self.keys))
+
+    def _scan(self, items: list) -> int:
+        text, pos = self._text, self._pos
+        while not self.done:
+            if self._in_string:
+                match = self._string_end.search(text, pos)
+                if match is None:
+                    return len(text)
+                pos = match.end()
+                if match.group() == '\\':
+                    if pos == len(text):
+                        return pos - 1  # экранированный символ придёт в следующей части
+                    pos += 1
+                    continue
+                self._in_string = False
+                if self._key_start is not None:
+                    self._last_key = text[self._key_start:pos - 1]
+                    self._key_start = None
+                if self._item_start is not None and len(self._stack) == len(self.keys) * 2:
+                    items.append(json_loads(text[self._item_start:pos]))  # элемент - строка
+                    self._item_start = None
+                continue
+            if self._in_items():
+                pos = self._separator.match(text, pos).end()
+                if pos == len(text):
+                    return pos
+                if text[pos] not in '{["]':
+                    # число, true, false или null: конец виден только по следующему за ним символу
+                    match = self._scalar_end.search(text, pos)
+                    if match is None:
+                        return pos
+                    items.append(json_loads(text[pos:match.start()]))
+                    pos = match.start()
+                    continue
+                if text[pos] != ']':
+                    self._item_start = pos
+            match = self._structure.search(text, pos)
+            if match is None:
+                return len(text)
+            char, pos = match.group(), match.end()
+            if char == '"':
+                self._in_string = True
+                if self._stack and self._stack[-1][0] == '{' and self._stack[-1][1] is not None:
+                    self._key_start = pos
+            elif char in '{[':
+                self._open(char)
+            else:
+                self._close(text, pos, items)
+        return pos
+
+    def _open(self, char: str):
+        parent = self._stack[-1] if self._stack else None
+        level = None
+        if parent is None:
+            level = 0 if char == '{' else None
+        elif parent[1] is not None and self._item_start is None:
+            if parent[0] == '{' and char == '[' and self._last_key == self.keys[parent[1]]:
+                level = parent[1] + 1
+                self.found = True
+            elif parent[0] == '[' and char == '{' and parent[1] < len(self.keys):
+                level = parent[1]
+        self._last_key = None
+        self._stack.append((char, level))
+
+    def _close(self, text: str, pos: int, items: list):
+        char, level = self._stack.pop()
+        self._last_key = None
+        if self._item_start is not None and len(self._stack) == len(self.keys) * 2:
+            items.append(json_loads(text[self._item_start:pos]))
+            self._item_start = None
+        elif char == '[' and level == 1:
+            self.done = True
+
+
+REQUIRED = object()  # у параметра нет значения по умолчанию
+
+
+class Param:
+    """ Параметр метода клиента и поле тела запроса, в которое он попадает"""
+    __slots__ = ('name', 'field', 'default', 'annotation')
+
+    def __init__(self, name: str, field: str = None, default=REQUIRED, annotation=str):
+        """
+        :param name: имя параметра метода
+        :param field (optional): поле тела запроса, по умолчанию совпадает с name;
+            organizationIds - список из одной организации
+        :param default (optional): значение по умолчанию; у organizationId None означает организацию клиента
+        :param annotation (optional): тип параметра для сигнатуры метода
+        """
+        self.name = name
+        self.field = field if field else name
+        self.default = default
+        self.annotation = annotation
+
+
+class Endpoint:
+    """ Описание метода API, по которому создаются методы IikoCardAPI и AsyncIikoCardAPI.
+    kind: 'reference' - справочник, кэшируется в ReferenceCache и повторяется при сбоях;
+    'lookup' - поиск клиента через кэш, реплику и дублирование запросов (lookup_type - тип ключа);
+    'mutation' - изменение клиента, сбрасывает его записи в кэше и реплике (invalidate - ключ кэша: параметр);
+    'stream' - итератор по элементам списка item_key ответа, разбираемого по мере получения
+    (nested - вложенный список каждого элемента, model - модель элементов при models=True).
+    timeout_class - имя группы для таймаутов: timeouts={'mutation': 10} задаёт таймаут всем изменениям.
+    """
+    __slots__ = ('name', 'path', 'kind', 'params', 'doc', 'error_message', 'lookup_type', 'invalidate',
+                 'timeout_class', 'item_key', 'nested', 'model', 'names', 'signature')
+
+    def __init__(self, name: str, path: str, kind: str, params: tuple, doc: str, error_message: str = None,
+                 lookup_type: str = None, invalidate: dict = None, timeout_class: str = None, item_key: str = None,
+                 nested: str = None, model=None):
+        self.name = name
+        self.path = path
+        self.kind = kind
+        self.params = params
+        self.doc = doc
+        self.error_message = error_message
+        self.lookup_type = lookup_type
+        self.invalidate = invalidate if invalidate else {"id": "customerId"}
+        self.timeout_class = timeout_class if timeout_class else kind
+        self.item_key = item_key
+        self.nested = nested
+        self.model = model
+        self.names = frozenset(param.name for param in params)
+        self.signature = inspect.Signature(
+            [inspect.Parameter('self', inspect.Parameter.POSITIONAL_OR_KEYWORD)]
+            + [inspect.Parameter(param.name, inspect.Parameter.POSITIONAL_OR_KEYWORD, annotation=param.annotation,
+                                 default=inspect.Parameter.empty if param.default is REQUIRED else param.default)
+               for param in params])
+
+    @property
+    def idempotent(self) -> bool:
+        return self.kind != 'mutation'
+
+    @property
+    def cacheable(self) -> bool:
+        return self.kind == 'reference'
+
+    def bind(self, args: tuple, kwargs: dict) -> dict:
+        """ Значения параметров вызова метода по именам, с подставленными значениями по умолчанию
+        :raises TypeError: лишние, повторённые или недостающие аргументы, как у обычной функции
+        """
+        if len(args) > len(self.params):
+            raise TypeError(f"{self.name}() takes {len(self.params) + 1} positional arguments "
+                            f"but {len(args) + 1} were given")
+        arguments = {param.name: value for param, value in zip(self.params, args)}
+        for name, value in kwargs.items():
+            if name not in self.names:
+                raise TypeError(f"{self.name}() got an unexpected keyword argument '{name}'")
+            if name in arguments:
+                raise TypeError(f"{self.name}() got multiple values for argument '{name}'")
+            arguments[name] = value
+        for param in self.params[len(args):]:
+            if param.name not in arguments:
+                if param.default is REQUIRED:
+                    raise TypeError(f"{self.name}() missing required argument: '{param.name}'")
+                arguments[param.name] = param.default
+        return arguments
+
+    def data(self, arguments: dict) -> dict:
+        """ Тело запроса из значений параметров"""
+        return {param.field: [arguments[param.name]] if param.field == "organizationIds" else arguments[param.name]
+                for param in self.params}
+
+    def build(self, cls, asynchronous: bool):
+        """ Метод клиента с сигнатурой и документацией из описания. Вызов выполняет _call_endpoint клиента,
+        итераторы - _open_stream; у асинхронного клиента итератор - обычная функция, возвращающая
+        асинхронный генератор"""
+        endpoint = self
+        if self.kind == 'stream':
+            def method(client, *args, **kwargs):
+                return client._open_stream(endpoint, args, kwargs)
+        elif asynchronous:
+            async def method(client, *args, **kwargs):
+                return await client._call_endpoint(endpoint, args, kwargs)
+        else:
+            def method(client, *args, **kwargs):
+                return client._call_endpoint(endpoint, args, kwargs)
+        method.__name__ = self.name
+        method.__qualname__ = f"{cls.__qualname__}.{self.name}"
+        method.__module__ = cls.__module__
+        method.__doc__ = self.doc
+        method.__signature__ = self.signature
+        return method
+
+
+ORGANIZATION = Param("organizationId", default=None)
+CUSTOMER_NOT_FOUND = "There is no user with such"  # начало errorDescription, если клиента нет в iiko
+
+ENDPOINTS = (
+    Endpoint("organizations", "organizations", 'reference', (Param("includeDisabled", default=False, annotation=bool),),
+             """
+         Получение сведений об организациях
+        :param includeDisabled (optional): False - включать в ответ отключенные организации
+        :return: iiko .json response
+        """, "Не удалось получить список организаций."),
+    Endpoint("loyalty_programs", "loyalty/iiko/program", 'reference', (ORGANIZATION,),
+             """ Получение сведений о программах лояльности по ID организации
+            :return: iiko .json response""", "Не удалось получить список действующих программ"),
+    Endpoint("get_customer_by_id", "loyalty/iiko/customer/info", 'lookup', (Param("userId"), ORGANIZATION), """
+        Получить информацию о пользователе по ID
+        :param userId: ID пользователя
+        :param organizationId: ID организации (необязательно)
+        :return: iiko .json response
+        """, lookup_type="id"),
+    Endpoint("get_customer_by_phone", "loyalty/iiko/customer/info", 'lookup', (Param("userPhone"), ORGANIZATION), """
+        Получить информацию о пользователе по номеру телефона
+        :param userPhone: Телефон пользователя
+        :param organizationId: ID организации (необязательно)
+        :return: iiko .json response
+        """, lookup_type="phone"),
+    Endpoint("get_customer_by_card", "loyalty/iiko/customer/info", 'lookup', (Param("cardNumber"), ORGANIZATION), """
+        Получить информацию о пользователе по номеру карточки
+        :param cardNumber: Номер карточки
+        :param organizationId: ID организации (необязательно)
+        :return: iiko .json response
+        """, lookup_type="cardNumber"),
+    Endpoint("get_customer_by_cardTrack", "loyalty/iiko/customer/info", 'lookup', (Param("cardTrack"), ORGANIZATION),
+             """
+        Получить информацию о пользователе по номеру Трека карточки
+        :param cardTrack: Трек карточки пользователя
+        :param organizationId: ID организации (необязательно)
+        :return: iiko .json response
+        """, lookup_type="cardTrack"),
+    Endpoint("loyalty_add_card", "loyalty/iiko/customer/card/add", 'mutation',
+             (Param("customerId"), Param("cardTrack"), Param("cardNumber"), ORGANIZATION), """
+        Добавить карту пользователя
+        :param customerId:
+        :param cardTrack:
+        :param cardNumber:
+        :param organizationId: (optional)
+        :return:
+        """, "Не удалось получить информацию о пользователе",
+             invalidate={"id": "customerId", "cardTrack": "cardTrack", "cardNumber": "cardNumber"}),
+    Endpoint("loyalty_delete_card", "loyalty/iiko/customer/card/remove", 'mutation',
+             (Param("customerId"), Param("cardTrack"), ORGANIZATION), """
+        Удалить карту пользователя
+        :param customerId:
+        :param cardTrack:
+        :param organizationId: (optional)
+        :return:
+        """, "Не удалось получить информацию о пользователе",
+             invalidate={"id": "customerId", "cardTrack": "cardTrack"}),
+    Endpoint("loyalty_categories", "loyalty/iiko/customer_category", 'reference', (ORGANIZATION,),
+             """ Получение сведений о категориях лояльности, доступных для организации.
+            :return: iiko .json response""", "Не удалось получить список доступных категорий"),
+    Endpoint("loyalty_select_category", "loyalty/iiko/customer_category/add", 'mutation',
+             (Param("customerId"), Param("categoryId"), ORGANIZATION), """ Добавить категорию пользователю
+        :param customerId: ID пользователя
+        :param categoryId: ID категории
+        :param organizationId: (optional)""", "Не удалось добавить категорию пользователю"),
+    Endpoint("loyalty_remove_category", "loyalty/iiko/customer_category/remove", 'mutation',
+             (Param("customerId"), Param("categoryId"), ORGANIZATION), """ Удалить категорию пользователю
+        :param customerId: ID пользователя
+        :param categoryId: ID категории
+        :param organizationId: (optional)""", "Не удалось удалить категорию пользователю"),
+    Endpoint("loyalty_select_program", "loyalty/iiko/customer/program/add", 'mutation',
+             (Param("customerId"), Param("programId"), ORGANIZATION), """ Добавить пользователя в программу лояльности
+        :param customerId: ID пользователя
+        :param programId: ID программы
+        :param organizationId: (optional)""", "Не удалось добавить пользователя в программу лояльности"),
+    Endpoint("get_service_organization", "reserve/available_organizations", 'reference',
+             (Param("organizationId", "organizationIds", None),), """ Получение сведений об обслуживаемых организациях
+            :return: iiko .json response""", "Не удалось получить список доступных к обслуживанию организаций"),
+    Endpoint("get_terminal_groups", "reserve/available_terminal_groups", 'reference',
+             (Param("organizationId", "organizationIds", None),
+              Param("includeDisabled", default=False, annotation=bool)),
+             """
+        Получение сведений о терминалах организации
+        :param organizationId(optional): None - если не установлено, используется по умолчанию
+        :param includeDisabled(optional): False - включая отключенные
+        :return: iiko .json response
+        """, "Не удалось получить список доступных к обслуживанию организаций"),
+    Endpoint("iter_organizations", "organizations", 'stream',
+             (Param("includeDisabled", default=False, annotation=bool),), """
+        Сведения об организациях по одной, по мере получения ответа: для сетей с большим числом организаций
+        :param includeDisabled (optional): True - включать отключенные организации
+        :return: итератор dict организаций (Organization при models=True), у AsyncIikoCardAPI - асинхронный
+        :raises IikoError: API недоступно, ответило ошибкой или ответ оборван
+        """, item_key="organizations", model=Organization, timeout_class='reference'),
+    Endpoint("iter_loyalty_programs", "loyalty/iiko/program", 'stream', (ORGANIZATION,), """
+        Программы лояльности организации по одной, по мере получения ответа
+        :param organizationId: ID организации (необязательно)
+        :return: итератор dict программ (Program при models=True), у AsyncIikoCardAPI - асинхронный
+        :raises IikoError: API недоступно, ответило ошибкой или ответ оборван
+        """, item_key="Programs", model=Program, timeout_class='reference'),
+    Endpoint("iter_terminal_groups", "reserve/available_terminal_groups", 'stream',
+             (Param("organizationId", "organizationIds", None),
+              Param("includeDisabled", default=False, annotation=bool)), """
+        Терминальные группы организации по одной, по мере получения ответа
+        :param organizationId(optional): None - если не установлено, используется по умолчанию
+        :param includeDisabled(optional): True - включая отключенные
+        :return: итератор dict терминальных групп (TerminalGroup при models=True), у AsyncIikoCardAPI - асинхронный
+        :raises IikoError: API недоступно, ответило ошибкой или ответ оборван
+        """, item_key="terminalGroups", nested="items", model=TerminalGroup, timeout_class='reference'),
+)
+
+# пути всех методов API, которые вызывает клиент; адреса для них вычисляются при установке apiURL
+ENDPOINT_PATHS = tuple(dict.fromkeys([endpoint.path for endpoint in ENDPOINTS]
+                                     + ["access_token", "loyalty/iiko/customer/create_or_update"]))
+
+
+def with_endpoints(asynchronous: bool):
+    """ Декоратор класса клиента: добавляет методы API из ENDPOINTS"""
+    def install(cls):
+        for endpoint in ENDPOINTS:
+            setattr(cls, endpoint.name, endpoint.build(cls, asynchronous))
+        return cls
+    return install
+
+
+def endpoint_timeouts(timeouts: dict) -> dict:
+    """ Таймауты по путям API: группы ('reference', 'lookup', 'mutation') раскрываются в пути методов группы,
+    явно указанный путь важнее группы"""
+    result = {}
+    for endpoint in ENDPOINTS:
+        if endpoint.timeout_class in timeouts:
+            result[endpoint.path] = timeouts[endpoint.timeout_class]
+    if "mutation" in timeouts:
+        result["loyalty/iiko/customer/create_or_update"] = timeouts["mutation"]
+    result.update(timeouts)
+    return result
+
+
+def _not_sent(exc: Exception) -> bool:
+    """ Ошибка соединения возникла до отправки запроса: соединение не установлено, повтор безопасен для любых методов"""
+    if httpx is not None and isinstance(exc, (httpx.ConnectTimeout, httpx.ConnectError)):
+        return True
+    if isinstance(exc, requests.exceptions.ConnectTimeout):
+        return True
+    if isinstance(exc, requests.exceptions.ConnectionError):
+        reason = getattr(exc.args[0], 'reason', None) if exc.args else None
+        return (isinstance(reason, urllib3.exceptions.NewConnectionError)
+                or httpx is not None and isinstance(exc.__cause__, (httpx.ConnectTimeout, httpx.ConnectError)))
+    return False
+
+
+class _ClientBase:
+    """ Общая часть IikoCardAPI и AsyncIikoCardAPI, не зависящая от транспорта: настройки, кэши и реплика,
+    правила повторов и размыкателя цепи, разбор аргументов методов из ENDPOINTS.
+    Подклассы отправляют запросы и ждут: IikoCardAPI - в потоках через requests, AsyncIikoCardAPI - в event loop.
+    """
+    hedge_default = 1.0  # задержка дублирования для hedge_after='p95', пока не накоплена статистика
+
+    def __init__(self, apiLogin, timeout, customer_cache: CustomerCache, reference_cache: ReferenceCache,
+                 retry: RetryPolicy, rate_limiter: RateLimiter, circuit_breaker: CircuitBreaker, timeouts: dict,
+                 hedge_after, metrics: Metrics, models: bool, write_behind: WriteBehindQueue,
+                 replica: CustomerReplica, change_tracker: ChangeTracker, compress: int):
         self.apiLogin = apiLogin
         self.timeout = timeout
+        self.customer_cache = customer_cache
+        self.reference_cache = reference_cache
+        self.retry = retry if retry else RetryPolicy()
+        self.rate_limiter = rate_limiter
+        self.circuit_breaker = circuit_breaker if circuit_breaker else CircuitBreaker()
+        self.timeouts = endpoint_timeouts(timeouts) if timeouts else {}
+        self.hedge_after = hedge_after
+        self.latency = LatencyTracker()
+        self.metrics = metrics
+        self.models = models
+        self.write_behind = write_behind
+        self.replica = replica
+        self.change_tracker = change_tracker
+        self.compress = compress
         self.apiURL = "https://api-ru.iiko.services/api/1/"
-        self.session = requests.Session()
         self.organization_id = None
-        self.__token_date = datetime.timedelta(days=1)  # The standard token lifetime is 1 hour.
-        self.token = self.set_token()
 
-    def __check_token(self) -> bool:
-        ...
+    @property
+    def token(self) -> str:
+        return self.tokens.token
+
+    @property
+    def apiURL(self) -> str:
+        return self._apiURL
+
+    @apiURL.setter
+    def apiURL(self, value: str):
+        self._apiURL = value
+        self.urls = {path: value + path for path in ENDPOINT_PATHS}
+
+    def set_organization(self, organizationId: str):
+        self.organization_id = organizationId
+
+    def _token_received(self, result: dict):
+        """ Токен из ответа access_token
+        :return: str - токен или None
+        """
+        token = result.get('token') if isinstance(result, dict) else None
+        if not token:
+            print("Не корректный запрос(логин API?).")
+        else:
+            print('Токен установлен!')
+        if self.metrics:
+            self.metrics.token_refresh(bool(token))
+        return token
+
+    def _token_failed(self):
+        """ :raises DeadlineExceeded: запрос токена прерван истечением deadline"""
+        print(f"Не удалось получить токен для \n{self.apiLogin}")
+        if self.metrics:
+            self.metrics.token_refresh(False)
+        time_left("access_token")
+
+    def _token_timeout(self):
+        """ Таймаут запроса токена: не дольше fetch_timeout и оставшегося до deadline времени
+        :raises DeadlineExceeded: время истекло
+        """
+        return limit_timeout(limit_timeout(self.timeout, self.tokens.fetch_timeout), time_left("access_token"))
+
+    def _body(self, data: dict):
+        """ Тело запроса и заголовок Content-Encoding, если тело сжато"""
+        body = json_dumps(data)
+        if self.compress is not None and len(body) >= self.compress:
+            return gzip.compress(body, 5), {'Content-Encoding': 'gzip'}
+        return body, {}
+
+    def _url(self, path: str) -> str:
+        return self.urls.get(path) or self.apiURL + path
+
+    @staticmethod
+    def _headers(token: str, encoding: dict) -> dict:
+        return {'Authorization': f'Bearer {token}', 'Content-Type': 'application/json', **encoding}
+
+    def _timeout(self, path: str):
+        """ Таймаут метода, ограниченный оставшимся до deadline временем
+        :raises DeadlineExceeded: время истекло
+        """
+        return limit_timeout(self.timeouts.get(path, self.timeout), time_left(path))
+
+    def _connection_failed(self, path: str, exc: Exception, retryable: bool, attempt: int, started: float) -> float:
+        """ Учитывает ошибку соединения
+        :param retryable: запрос можно повторить
+        :return: пауза перед повтором
+        :raises IikoConnectionError: запрос нельзя или больше не нужно повторять
+        """
+        self.circuit_breaker.record_failure()
+        if self.metrics:
+            self.metrics.request(path, 'error', time.monotonic() - started)
+        if not retryable or attempt + 1 >= self.retry.attempts:
+            raise IikoConnectionError(path) from exc
+        if self.metrics:
+            self.metrics.retry(path, type(exc).__name__)
+        return backoff_pause(self.retry.delay(attempt), path)
+
+    def _unauthorized(self, path: str, token: str, replayed: bool) -> bool:
+        """ Ответ 401: токен помечается недействительным для одного повтора запроса
+        :return: True - запрос нужно повторить с новым токеном
+        :raises NotAuthorizedError: новый токен тоже не принят
+        """
+        if replayed:
+            self.circuit_breaker.record_success()
+            raise NotAuthorizedError(path)
+        if self.metrics:
+            self.metrics.retry(path, 401)
+        self.tokens.invalidate(token)
+        return True
+
+    def _check_response(self, path: str, response, attempt: int, idempotent: bool):
+        """ Проверяет код ответа, кроме 401
+        :return: None - ответ принят; число - пауза перед повтором
+        :raises IikoHTTPError: ответ 429 или 5xx, который нельзя или больше не нужно повторять
+        """
+        status = response.status_code
+        if status not in self.retry.statuses and status < 500:
+            self.circuit_breaker.record_success()
+            return None
+        if status >= 500:
+            self.circuit_breaker.record_failure()
+        retryable = status == 429 or idempotent
+        if not retryable or status not in self.retry.statuses or attempt + 1 >= self.retry.attempts:
+            raise IikoHTTPError(path, status, response.text)
+        if self.metrics:
+            self.metrics.retry(path, status)
+        return backoff_pause(self.retry.delay(attempt, response.headers.get('Retry-After')), path)
+
+    def _stream_failed(self, path: str, status: int, text: str):
+        """ Ответ с ошибкой на потоковый запрос
+        :raises NotAuthorizedError: ответ 401 после обновления токена
+        :raises IikoHTTPError: любой другой ответ с ошибкой
+        """
+        if status == 401:
+            self.circuit_breaker.record_success()
+            raise NotAuthorizedError(path)
+        if status >= 500:
+            self.circuit_breaker.record_failure()
+        raise IikoHTTPError(path, status, text)
+
+    def _stream_finished(self, path: str, parser):
+        """ :raises IikoConnectionError: ответ оборван до конца массива"""
+        if parser.found and not parser.done:
+            raise IikoConnectionError(path)
+        self.circuit_breaker.record_success()
+
+    def _fresh_items(self, path: str, data: dict, key: str, nested: str = None):
+        """ Элементы списка key (или вложенных списков nested) из свежего ответа в ReferenceCache или None"""
+        if self.reference_cache is not None:
+            value, state = self.reference_cache.lookup(self.reference_cache.key(path, data, self.apiLogin))
+            if state == 'fresh':
+                items = value.get(key) or ()
+                return [element for item in items for element in item.get(nested) or ()] if nested else items
+        return None
+
+    def _element(self, item, model=None):
+        """ Элемент, выдаваемый итератором: dict или модель при models=True"""
+        return model.from_json(item) if self.models and model else item
+
+    def _reference_entry(self, path: str, data: dict):
+        """ Запись ReferenceCache для запроса
+        :return: (key, value, state, refresh) - refresh: устаревшую запись нужно обновить в фоне
+        """
+        cache = self.reference_cache
+        key = cache.key(path, data, self.apiLogin)
+        value, state = cache.lookup(key)
+        if self.metrics:
+            self.metrics.cache('reference', state is not None)
+        return key, value, state, state == 'stale' and cache.begin_refresh(key)
+
+    def _parse_reference(self, path: str, result):
+        return REFERENCE_PARSERS[path](result) if self.models else result
+
+    def _parse_customer(self, result):
+        return parse_customer(result) if self.models else result
+
+    def _hedge_delay(self, path: str):
+        if self.hedge_after == 'p95':
+            delay = self.latency.percentile(path, 0.95)
+            return delay if delay is not None else self.hedge_default
+        return self.hedge_after
+
+    def _known_customer(self, organizationId: str, type: str, value: str):
+        """ Клиент из кэша или реплики, None - нужен запрос к API"""
+        if self.customer_cache is not None:
+            customer = self.customer_cache.get(organizationId, type, value)
+            if self.metrics:
+                self.metrics.cache('customer', customer is not None)
+            if customer is not None:
+                return customer
+        if self.replica is not None:
+            customer = self.replica.get(organizationId, type, value)
+            if self.metrics:
+                self.metrics.cache('replica', customer is not None)
+            if customer is not None:
+                return customer
+        return None
+
+    def _customer_generation(self):
+        """ Номер сброса кэша клиентов перед запросом customer/info, см. CustomerCache.put"""
+        return self.customer_cache.generation() if self.customer_cache is not None else None
+
+    def _remember_customer(self, organizationId: str, result, generation: int = None):
+        if self.customer_cache is not None:
+            self.customer_cache.put(organizationId, result, generation)
+        if self.replica is not None:
+            self.replica.put(organizationId, result)
+
+    def _invalidate_customer(self, organizationId: str, **keys):
+        """ Сбрасывает записи клиента в кэше и реплике и отпечатки change_tracker: после изменения клиента
+        (или неудачного create_or_update) такой же payload нужно отправить снова"""
+        if self.customer_cache is not None:
+            self.customer_cache.invalidate(organizationId, **keys)
+        if self.replica is not None:
+            self.replica.invalidate(organizationId, **keys)
+        if self.change_tracker is not None:
+            for field in ("id", "phone", "cardTrack"):
+                if keys.get(field):
+                    self.change_tracker.forget(organizationId, {field: keys[field]})
+
+    def _delivered(self, data: dict):
+        """ Сбрасывает записи клиента после отправки изменения из очереди write_behind"""
+        self._invalidate_customer(data.get("organizationId") or self.organization_id,
+                                  id=data.get("customerId") or data.get("id"), phone=data.get("phone"),
+                                  cardTrack=data.get("cardTrack"), cardNumber=data.get("cardNumber"))
+
+    def _stale_customers(self, organizationId: str, limit: int) -> list:
+        """ Самые старые записи реплики; их записи в кэше клиентов сбрасываются
+        :raises ValueError: клиент создан без реплики
+        """
+        if self.replica is None:
+            raise ValueError("refresh_replica требует клиента, созданного с replica=CustomerReplica(...)")
+        customerIds = self.replica.stale(organizationId, limit)
+        if self.customer_cache is not None:
+            for customerId in customerIds:
+                self.customer_cache.invalidate(organizationId, id=customerId)
+        return customerIds
+
+    def _refreshed(self, organizationId: str, customerId: str, result) -> bool:
+        """ Учитывает ответ API для записи реплики
+        :return: True - запись обновлена
+        """
+        if isinstance(result, dict) and 'errorDescription' in result:
+            # из реплики удаляется только клиент, которого нет в iiko, при других ошибках запись остаётся
+            if CUSTOMER_NOT_FOUND in str(result['errorDescription']):
+                self.replica.delete(organizationId, customerId)
+            return False
+        return not isinstance(result, IikoError)
+
+    def _unchanged(self, organizationId: str, payload: dict) -> bool:
+        return self.change_tracker is not None and self.change_tracker.unchanged(organizationId, payload)
+
+    def _customer_updated(self, organizationId: str, payload: dict, result):
+        """ Сбрасывает кэш, обновляет реплику и отпечаток change_tracker после create_or_update;
+        после ошибки отпечаток остаётся сброшенным"""
+        customerId = payload.get("id") or (result or {}).get("id")
+        self._invalidate_customer(organizationId, id=customerId, phone=payload.get("phone"),
+                                  cardTrack=payload.get("cardTrack"), cardNumber=payload.get("cardNumber"))
+        if self.replica is not None and customerId and result and 'errorDescription' not in result:
+            self.replica.apply(organizationId, customerId, payload)
+        if self.change_tracker is not None and isinstance(result, dict) and result.get("id"):
+            self.change_tracker.record(organizationId, payload)
+
+    def _prepare(self, endpoint: Endpoint, args: tuple, kwargs: dict):
+        """ Аргументы вызова метода из ENDPOINTS и тело запроса
+        :return: (arguments, data) или None, если не указан обязательный параметр
+        """
+        arguments = endpoint.bind(args, kwargs)
+        if "organizationId" in arguments and not arguments["organizationId"]:
+            arguments["organizationId"] = self.organization_id
+        for param in endpoint.params:
+            if param.default is REQUIRED and not arguments[param.name]:
+                print(f'Не указан параметр {param.name}')
+                return None
+        return arguments, endpoint.data(arguments)
+
+    def _mutated(self, endpoint: Endpoint, arguments: dict):
+        self._invalidate_customer(arguments["organizationId"],
+                                  **{key: arguments[name] for key, name in endpoint.invalidate.items()})
+
+    def _open_stream(self, endpoint: Endpoint, args: tuple, kwargs: dict):
+        """ Итератор метода из ENDPOINTS с kind='stream'"""
+        prepared = self._prepare(endpoint, args, kwargs)
+        if prepared is None:
+            return None
+        return self._iterate(endpoint.path, prepared[1], endpoint.item_key, endpoint.nested, endpoint.model)
+
+
+@with_endpoints(asynchronous=False)
+class IikoCardAPI(_ClientBase):
+    """ Класс для работы с API iiko.
+    Методы API (organizations, get_customer_by_phone, loyalty_add_card и другие) создаются по описаниям из ENDPOINTS.
+    """
+
+    def __init__(self, apiLogin, timeout=180, customer_cache: CustomerCache = None,
+                 reference_cache: ReferenceCache = None, retry: RetryPolicy = None,
+                 rate_limiter: RateLimiter = None, circuit_breaker: CircuitBreaker = None,
+                 timeouts: dict = None, hedge_after=None, session: requests.Session = None,
+                 metrics: Metrics = None, coalesce: bool = True, models: bool = False,
+                 write_behind: WriteBehindQueue = None, replica: CustomerReplica = None,
+                 backend: SharedBackend = None, change_tracker: ChangeTracker = None, pool_maxsize: int = 100,
+                 keepalive: bool = True, idle_timeout: float = 60, http2: bool = False, compress: int = None):
+        """
+        :param apiLogin: логин API
+        :param timeout (optional): таймаут запросов в секундах
+        :param customer_cache (optional): CustomerCache для кэширования поиска клиентов
+        :param reference_cache (optional): ReferenceCache для справочных данных
+        :param retry (optional): RetryPolicy, по умолчанию 3 попытки
+        :param rate_limiter (optional): RateLimiter, общий для всех клиентов одного логина
+        :param circuit_breaker (optional): CircuitBreaker, по умолчанию размыкается после 5 отказов подряд
+        :param timeouts (optional): таймауты по методам API, {путь или группа: секунды или (connect, read)},
+            группы - 'reference', 'lookup', 'mutation'; для остальных методов используется timeout
+        :param hedge_after (optional): дублирование поиска клиента (customer/info), если ответ не пришёл
+            за hedge_after секунд; 'p95' - по 95-му перцентилю наблюдаемых задержек; None - не дублировать
+        :param session (optional): общий requests.Session, например из IikoClientPool
+        :param metrics (optional): Metrics для сбора метрик запросов
+        :param coalesce (optional): True - одинаковые одновременные запросы на чтение выполняются один раз,
+            остальные вызовы получают тот же объект ответа
+        :param models (optional): True - методы поиска клиентов и справочников возвращают модели
+            (Customer, Organization, Program, Category, TerminalGroup) вместо dict; ответы с ошибкой остаются dict
+        :param write_behind (optional): WriteBehindQueue - изменения клиентов (карты, категории, программы,
+            create_or_update) записываются в очередь и отправляются в фоне, методы сразу возвращают
+            {"queued": номер записи}; без очереди изменение отправляется сразу
+        :param replica (optional): CustomerReplica - поиск клиентов сначала в локальной реплике (local-first),
+            API запрашивается, только если клиента нет в реплике или запись старше replica.max_age
+        :param backend (optional): SharedBackend (SQLiteBackend, RedisBackend) - общий для процессов токен;
+            новый токен запрашивает только один процесс, остальные берут его из хранилища
+        :param change_tracker (optional): ChangeTracker - create_or_update_customer не отправляет payload,
+            совпадающий с последним успешно отправленным для того же клиента
+        :param pool_maxsize (optional): число соединений к API в пуле, общем для всех потоков
+        :param keepalive (optional): False - не держать соединения открытыми между запросами
+        :param idle_timeout (optional): через сколько секунд простоя закрывать соединения пула, None - не закрывать
+        :param http2 (optional): True - HTTP/2 через httpx, все запросы в одном соединении (нужен httpx[http2])
+        :param compress (optional): сжимать gzip тела запросов от compress байт, None - не сжимать.
+            Параметры пула не действуют, если передан session
+        """
+        super().__init__(apiLogin, timeout, customer_cache=customer_cache, reference_cache=reference_cache,
+                         retry=retry, rate_limiter=rate_limiter, circuit_breaker=circuit_breaker, timeouts=timeouts,
+                         hedge_after=hedge_after, metrics=metrics, models=models, write_behind=write_behind,
+                         replica=replica, change_tracker=change_tracker, compress=compress)
+        self._own_session = session is None
+        if session is None:
+            session = (HTTP2Session(pool_maxsize, keepalive, idle_timeout) if http2
+                       else PooledSession(pool_maxsize, keepalive=keepalive, idle_timeout=idle_timeout))
+        self.session = session
+        self.single_flight = SingleFlight() if coalesce else None
+        self.tokens = TokenManager(self._fetch_token, backend=backend, key=token_key(apiLogin))
+        self._hedge_executor = None
+        if write_behind is not None:
+            write_behind.start(self._deliver, apiLogin)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """ Останавливает обновление токена и потоки дублирования запросов, закрывает пул соединений,
+        если он создан клиентом, а не передан в session. Очередь write_behind перестаёт отправлять
+        изменения через этот клиент.
+        """
+        self.tokens.close()
+        if self._hedge_executor is not None:
+            self._hedge_executor.shutdown(wait=False)
+        if self.write_behind is not None:
+            self.write_behind.detach(self._deliver, self.apiLogin)
+        if self._own_session:
+            self.session.close()
+
+    def _fetch_token(self):
+        """ Запрос нового токена у API
+        :return: str - токен или None
+        """
+        try:
+            response = self.session.post(self.urls["access_token"], json={"apiLogin": self.apiLogin},
+                                         timeout=self._token_timeout())
+            return self._token_received(response.json())
+        except requests.exceptions.RequestException:
+            self._token_failed()
 
     def set_token(self) -> str:
-        """Запрашивает и устанавливает сессию с токеном для класса
+        """Возвращает действующий токен, запрашивая новый при необходимости
         :return: str - токен
         """
-        time_delta = (datetime.datetime.now() - self.__token_date)
-        if not hasattr(self, 'token') or not self.token or (time_delta > datetime.timedelta(hours=1)):
-            try:
-                self.token = \
-                    self.session.post(f"{self.apiURL}access_token", json={"apiLogin": self.apiLogin},
-                                      timeout=self.timeout).json()[
-                        'token']
-                self.session.headers['Authorization'] = f'Bearer {self.token}'
-                self.__token_date = datetime.datetime.now()
-                print('Токен установлен! ', time_delta)
-            except requests.exceptions.ConnectTimeout:
-                print(f"Не удалось получить токен для \n{self.apiLogin}")
-            except KeyError:
-                print("Не корректный запрос(логин API?).")
-        return self.token
+        return self.tokens.get()
 
-    def organizations(self, includeDisabled: bool = False):
+    def _request(self, path: str, data: dict, idempotent: bool = False):
+        """ Выполняет запрос к API; одинаковые одновременные идемпотентные запросы объединяются в один
+        :param path: путь метода API относительно apiURL
+        :param data: тело запроса
+        :param idempotent (optional): True - запрос только читает данные и его можно повторить
+        :return: iiko .json response
+        :raises IikoError: API недоступно, ответило ошибкой или токен не принят
         """
-         Получение сведений об организациях
-        :param includeDisabled (optional): False - включать в ответ отключенные организации
+        if not idempotent or self.single_flight is None:
+            return self._send(path, data, idempotent)
+        return self._coalesce(path, data, self._send, path, data, True)
+
+    def _coalesce(self, path: str, data: dict, function, *args):
+        key = flight_key(path, data)
+        if self.metrics and key in self.single_flight:
+            self.metrics.coalesced(path)
+        return self.single_flight.do(key, function, *args)
+
+    def _send(self, path: str, data: dict, idempotent: bool = False):
+        """ Выполняет запрос к API через ограничитель частоты и размыкатель цепи.
+        Ответ 429, ошибки соединения и 5xx повторяются согласно self.retry,
+        при ответе 401 токен обновляется и запрос повторяется один раз.
+        :param path: путь метода API относительно apiURL
+        :param data: тело запроса
+        :param idempotent (optional): True - запрос можно безопасно повторить после 5xx и обрыва соединения
         :return: iiko .json response
+        :raises IikoError: API недоступно, ответило ошибкой или токен не принят
         """
-        self.set_token()
-        result = None
+        attempt = 0
+        replayed = False
+        body, encoding = self._body(data)
+        url = self._url(path)
+        probe = None
         try:
-            result = self.session.post(f"{self.apiURL}organizations", json={"includeDisabled": includeDisabled},
-                                       timeout=self.timeout)
-            if result.status_code == 401:
-                raise ZeroDivisionError
-            result = result.json()
-        except requests.exceptions.ConnectTimeout:
-            print("Не удалось получить список организаций.")
-        except ZeroDivisionError:
-            self.token = None
-            print("Not authorized")
+            while True:
+                probe = self.circuit_breaker.before_request(path, probe)
+                if self.rate_limiter:
+                    time.sleep(backoff_pause(self.rate_limiter.reserve(), path))
+                token = self.tokens.get()
+                timeout = self._timeout(path)
+                started = time.monotonic()
+                try:
+                    response = self.session.post(url, data=body, timeout=timeout,
+                                                 headers=self._headers(token, encoding))
+                except requests.exceptions.RequestException as exc:
+                    time.sleep(self._connection_failed(path, exc, idempotent or _not_sent(exc), attempt, started))
+                    attempt += 1
+                    continue
+                if self.metrics:
+                    self.metrics.request(path, response.status_code, time.monotonic() - started, len(body),
+                                         len(response.content))
+                if response.status_code == 401:
+                    replayed = self._unauthorized(path, token, replayed)
+                    continue
+                pause = self._check_response(path, response, attempt, idempotent)
+                if pause is not None:
+                    time.sleep(pause)
+                    attempt += 1
+                    continue
+                self.latency.add(path, time.monotonic() - started)
+                return json_loads(response.content)
+        finally:
+            self.circuit_breaker.release(probe)
+
+    def _post(self, path: str, data: dict, error_message: str, idempotent: bool = False):
+        """ Выполняет запрос к API, выводя сообщение об ошибке вместо исключения
+        :param path: путь метода API относительно apiURL
+        :param data: тело запроса
+        :param error_message: сообщение при недоступности API
+        :param idempotent (optional): True - запрос можно безопасно повторить
+        :return: iiko .json response или None
+        """
+        try:
+            return self._request(path, data, idempotent)
+        except IikoError as exc:
+            report_error(exc, error_message)
+            return None
+
+    def _call_endpoint(self, endpoint: Endpoint, args: tuple, kwargs: dict):
+        """ Вызов метода API из ENDPOINTS"""
+        prepared = self._prepare(endpoint, args, kwargs)
+        if prepared is None:
+            return None
+        arguments, data = prepared
+        if endpoint.kind == 'lookup':
+            return self._get_customer(endpoint.lookup_type, arguments[endpoint.params[0].name],
+                                      arguments.get("organizationId"))
+        if endpoint.kind == 'reference':
+            return self._reference(endpoint.path, data, endpoint.error_message)
+        result = self._mutate(endpoint.path, data, endpoint.error_message)
+        self._mutated(endpoint, arguments)
         return result
 
-    def set_organization(self, organizationId: str):
-        self.organization_id = organizationId
+    def _mutate(self, path: str, data: dict, error_message: str):
+        """ Отправляет изменение клиента в API или, при write_behind, записывает его в очередь
+        :return: iiko .json response или None; {"queued": номер записи} при write_behind
+        """
+        if self.write_behind is not None:
+            return {"queued": self.write_behind.put(path, data, self.apiLogin)}
+        return self._post(path, data, error_message)
 
-    def loyalty_programs(self, organizationId: str = None):
-        """ Получение сведений о программах лояльности по ID организации
-            :return: iiko .json response"""
-        self.set_token()
-        result = None
-        data = {"organizationId": organizationId if organizationId else self.organization_id}
-        try:
-            result = self.session.post(f"{self.apiURL}loyalty/iiko/program", json=data, timeout=self.timeout, )
-            if result.status_code == 401:
-                raise ZeroDivisionError
-            result = result.json()
-        except requests.exceptions.ConnectTimeout:
-            print("Не удалось получить список действующих программ")
-        except ZeroDivisionError:
-            self.token = None
-            print("Not authorized")
+    def _deliver(self, path: str, data: dict):
+        """ Отправка изменения из очереди write_behind"""
+        result = self._request(path, data)
+        self._delivered(data)
         return result
 
-    def get_customer_by_id(self, userId: str, organizationId: str = None):
+    def _iterate(self, path: str, data: dict, key: str, nested: str = None, model=None):
+        """ Элементы списка key ответа API по одному; свежий ответ из ReferenceCache используется без запроса
+        :param nested (optional): выдавать элементы вложенного списка nested каждого элемента
+        :param model (optional): модель элементов при models=True
         """
-        Получить информацию о пользователе по ID
-        :param userId: ID пользователя
-        :param organizationId: ID организации (необязательно)
-        :return: iiko .json response
+        items = self._fresh_items(path, data, key, nested)
+        for item in items if items is not None else self._stream(path, data, key, nested):
+            yield self._element(item, model)
+
+    def _stream(self, path: str, data: dict, key: str, nested: str = None):
+        """ Запрос к API через ограничитель частоты и размыкатель цепи с разбором ответа по мере получения:
+        элементы массива key (или вложенных массивов nested его элементов) выдаются по одному,
+        весь ответ в памяти не хранится. При ответе 401 токен
+        обновляется и запрос повторяется один раз, остальные ошибки не повторяются: часть элементов уже могла
+        быть выдана.
+        :raises IikoError: API недоступно, ответило ошибкой или ответ оборван
         """
-        self.set_token()
-        result = None
-        data = {
-            "id": userId,
-            "type": "id",
-            "organizationId": organizationId if organizationId else self.organization_id
-        }
+        body, encoding = self._body(data)
+        url = self._url(path)
+        replayed = False
+        probe = None
         try:
-            result = self.session.post(f"{self.apiURL}loyalty/iiko/customer/info", json=data, timeout=self.timeout, )
-            if result.status_code == 401:
-                raise ZeroDivisionError
-            result = result.json()
-        except requests.exceptions.ConnectTimeout:
-            print("Не удалось получить информацию о пользователе")
-        except ZeroDivisionError:
-            self.token = None
-            print("Not authorized")
-        return result
+            while True:
+                probe = self.circuit_breaker.before_request(path, probe)
+                if self.rate_limiter:
+                    time.sleep(backoff_pause(self.rate_limiter.reserve(), path))
+                token = self.tokens.get()
+                timeout = self._timeout(path)
+                started = time.monotonic()
+                try:
+                    response = self.session.post(url, data=body, timeout=timeout, stream=True,
+                                                 headers=self._headers(token, encoding))
+                except requests.exceptions.RequestException as exc:
+                    self._connection_failed(path, exc, False, 0, started)  # без повтора: всегда исключение
+                if response.status_code != 401 or replayed:
+                    break
+                response.close()
+                if self.metrics:
+                    self.metrics.request(path, 401, time.monotonic() - started, len(body))
+                replayed = self._unauthorized(path, token, replayed)
+            status = response.status_code
+            received = 0
+            try:
+                if status >= 400:
+                    self._stream_failed(path, status, response.text)
+                parser = JSONItemStream(key, nested)
+                try:
+                    for chunk in response.iter_content(65536):
+                        received += len(chunk)
+                        yield from parser.feed(chunk)
+                        if parser.done:
+                            break
+                except requests.exceptions.RequestException as exc:
+                    self.circuit_breaker.record_failure()
+                    raise IikoConnectionError(path) from exc
+                self._stream_finished(path, parser)
+            finally:
+                response.close()
+                if self.metrics:
+                    self.metrics.request(path, status, time.monotonic() - started, len(body), received)
+        finally:
+            self.circuit_breaker.release(probe)
 
-    def get_customer_by_phone(self, userPhone: str, organizationId: str = None):
+    def _reference(self, path: str, data: dict, error_message: str):
+        """ Запрос справочных данных через ReferenceCache
+        :return: iiko .json response или список моделей при models=True
         """
-        Получить информацию о пользователе по номеру телефона
-        :param userPhone: Телефон пользователя
+        return self._parse_reference(path, self._cached_reference(path, data, error_message))
+
+    def _cached_reference(self, path: str, data: dict, error_message: str):
+        if self.reference_cache is None:
+            return self._post(path, data, error_message, idempotent=True)
+        key, value, state, refresh = self._reference_entry(path, data)
+        if refresh:
+            threading.Thread(target=self._refresh_reference, args=(key, path, data, error_message), daemon=True).start()
+        if state is not None:
+            return value
+        value = self._post(path, data, error_message, idempotent=True)
+        self.reference_cache.store(key, value)
+        return value
+
+    def _refresh_reference(self, key: str, path: str, data: dict, error_message: str):
+        try:
+            self.reference_cache.store(key, self._post(path, data, error_message, idempotent=True))
+        finally:
+            self.reference_cache.end_refresh(key)
+
+    def _lookup(self, path: str, data: dict):
+        """ Идемпотентный поиск с дублированием запроса (hedging): если первый запрос не ответил
+        за hedge_after секунд, отправляется второй и используется ответ, пришедший первым.
+        :return: iiko .json response
+        :raises IikoError: обе попытки завершились ошибкой
+        """
+        if self.hedge_after is None:
+            return self._request(path, data, idempotent=True)
+        if self.single_flight is not None:
+            return self._coalesce(path, data, self._hedged, path, data)
+        return self._hedged(path, data)
+
+    def _hedged(self, path: str, data: dict):
+        if self._hedge_executor is None:
+            self._hedge_executor = ThreadPoolExecutor(max_workers=32, thread_name_prefix='iiko-hedge')
+        first = self._hedge_executor.submit(contextvars.copy_context().run, self._send, path, data, True)
+        done, _ = wait([first], timeout=self._hedge_delay(path))
+        if done:
+            return first.result()
+        second = self._hedge_executor.submit(contextvars.copy_context().run, self._send, path, data, True)
+        for future in as_completed([first, second]):
+            if future.exception() is None:
+                return future.result()
+        return first.result()
+
+    def _customer_info(self, type: str, value: str, organizationId: str = None):
+        """ Запрос customer/info с использованием кэша клиентов
+        :param type: тип ключа поиска: id, phone, cardNumber, cardTrack
+        :param value: значение ключа
         :param organizationId: ID организации (необязательно)
         :return: iiko .json response
+        :raises IikoError: API недоступно или токен не принят
         """
-        self.set_token()
-        result = None
-        data = {
-            "phone": userPhone,
-            "type": "phone",
-            "organizationId": organizationId if organizationId else self.organization_id
-        }
-        try:
-            result = self.session.post(f"{self.apiURL}loyalty/iiko/customer/info", json=data, timeout=self.timeout, )
-            if result.status_code == 401:
-                raise ZeroDivisionError
-            result = result.json()
-        except requests.exceptions.ConnectTimeout:
-            print("Не удалось получить информацию о пользователе")
-        except ZeroDivisionError:
-            self.token = None
-            print("Not authorized")
+        organizationId = organizationId if organizationId else self.organization_id
+        customer = self._known_customer(organizationId, type, value)
+        if customer is not None:
+            return customer
+        generation = self._customer_generation()
+        result = self._lookup("loyalty/iiko/customer/info", {type: value, "type": type,
+                                                              "organizationId": organizationId})
+        self._remember_customer(organizationId, result, generation)
         return result
 
-    def get_customer_by_card(self, cardNumber: str, organizationId: str = None):
+    def _get_customer(self, type: str, value: str, organizationId: str = None):
+        try:
+            result = self._customer_info(type, value, organizationId)
+        except IikoError as exc:
+            report_error(exc, "Не удалось получить информацию о пользователе")
+            return None
+        return self._parse_customer(result)
+
+    def iter_customers(self, type: str, keys, organizationId: str = None, concurrency: int = 16):
         """
-        Получить информацию о пользователе по номеру карточки
-        :param cardNumber: Номер карточки
+        Одновременный поиск клиентов по множеству ключей, результаты выдаются по мере готовности.
+        Повторяющиеся ключи запрашиваются один раз.
+        :param type: тип ключа поиска: id, phone, cardNumber, cardTrack
+        :param keys: итерируемый набор значений ключа
         :param organizationId: ID организации (необязательно)
-        :return: iiko .json response
+        :param concurrency (optional): число одновременных запросов
+        :return: генератор пар (ключ, iiko .json response, Customer или исключение)
         """
-        self.set_token()
-        result = None
-        data = {
-            "cardNumber": cardNumber,
-            "type": "cardNumber",
-            "organizationId": organizationId if organizationId else self.organization_id
-        }
-        try:
-            result = self.session.post(f"{self.apiURL}loyalty/iiko/customer/info", json=data, timeout=self.timeout, )
-            if result.status_code == 401:
-                raise ZeroDivisionError
-            result = result.json()
-        except requests.exceptions.ConnectTimeout:
-            print("Не удалось получить информацию о пользователе")
-        except ZeroDivisionError:
-            self.token = None
-            print("Not authorized")
-        return result
+        unique = list(dict.fromkeys(keys))
+        with ThreadPoolExecutor(max_workers=max(1, min(concurrency, len(unique)))) as executor:
+            futures = {executor.submit(contextvars.copy_context().run, self._customer_info,
+                                       type, key, organizationId): key for key in unique}
+            for future in as_completed(futures):
+                try:
+                    result = future.result()
+                except IikoError as exc:
+                    yield futures[future], exc
+                else:
+                    yield futures[future], self._parse_customer(result)
 
-    def get_customer_by_cardTrack(self, cardTrack: str, organizationId: str = None):
+    def get_customers(self, type: str, keys, organizationId: str = None, concurrency: int = 16) -> list:
         """
-        Получить информацию о пользователе по номеру Трека карточки
-        :param cardTrack: Трек карточки пользователя
+        Одновременный поиск клиентов по множеству ключей
+        :param type: тип ключа поиска: id, phone, cardNumber, cardTrack
+        :param keys: итерируемый набор значений ключа
         :param organizationId: ID организации (необязательно)
-        :return: iiko .json response
+        :param concurrency (optional): число одновременных запросов
+        :return: список результатов в порядке ключей; ошибка по ключу возвращается как исключение
         """
-        self.set_token()
-        result = None
-        data = {
-            "cardTrack": cardTrack,
-            "type": "cardTrack",
-            "organizationId": organizationId if organizationId else self.organization_id
-        }
-        try:
-            result = self.session.post(f"{self.apiURL}loyalty/iiko/customer/info", json=data, timeout=self.timeout, )
-            if result.status_code == 401:
-                raise ZeroDivisionError
-            result = result.json()
-        except requests.exceptions.ConnectTimeout:
-            print("Не удалось получить информацию о пользователе")
-        except ZeroDivisionError:
-            self.token = None
-            print("Not authorized")
-        return result
+        keys = list(keys)
+        results = dict(self.iter_customers(type, keys, organizationId, concurrency))
+        return [results[key] for key in keys]
+
+    def get_customers_by_ids(self, userIds, organizationId: str = None, concurrency: int = 16) -> list:
+        """ Пакетный вариант get_customer_by_id, см. get_customers"""
+        return self.get_customers("id", userIds, organizationId, concurrency)
+
+    def get_customers_by_phones(self, userPhones, organizationId: str = None, concurrency: int = 16) -> list:
+        """ Пакетный вариант get_customer_by_phone, см. get_customers"""
+        return self.get_customers("phone", userPhones, organizationId, concurrency)
+
+    def get_customers_by_cards(self, cardNumbers, organizationId: str = None, concurrency: int = 16) -> list:
+        """ Пакетный вариант get_customer_by_card, см. get_customers"""
+        return self.get_customers("cardNumber", cardNumbers, organizationId, concurrency)
+
+    def refresh_replica(self, organizationId: str = None, limit: int = 100, concurrency: int = 16) -> int:
+        """
+        Обновляет из API самые старые записи реплики клиентов (старше replica.max_age).
+        Клиенты, которых больше нет в iiko, удаляются из реплики.
+        :param organizationId: ID организации (необязательно)
+        :param limit (optional): сколько записей обновить за вызов
+        :param concurrency (optional): число одновременных запросов
+        :return: число обновлённых записей
+        """
+        organizationId = organizationId if organizationId else self.organization_id
+        customerIds = self._stale_customers(organizationId, limit)
+        return sum(self._refreshed(organizationId, customerId, result)
+                   for customerId, result in self.iter_customers("id", customerIds, organizationId, concurrency))
 
     def create_or_update_customer(self, payload: dict):
         """
         Изменить или создать пользователя
         :param payload: json dict
-        :return: iiko .json response
+        :return: iiko .json response; {"unchanged": True}, если change_tracker помнит такой же payload
         """
-        self.set_token()
-        result = None
-        data = payload
-        try:
-            result = self.session.post(f"{self.apiURL}loyalty/iiko/customer/create_or_update", json=data, timeout=self.timeout, )
-            if result.status_code == 401:
-                raise ZeroDivisionError
-            result = result.json()
-        except requests.exceptions.ConnectTimeout:
-            print("Не удалось получить информацию о пользователе")
-        except ZeroDivisionError:
-            self.token = None
-            print("Not authorized")
+        organizationId = payload.get("organizationId") or self.organization_id
+        if self._unchanged(organizationId, payload):
+            return {"unchanged": True}
+        result = self._mutate("loyalty/iiko/customer/create_or_update", payload,
+                              "Не удалось получить информацию о пользователе")
+        self._customer_updated(organizationId, payload, result)
         return result
 
-    def loyalty_add_card(self, customerId: str, cardTrack: str, cardNumber: str, organizationId: str = None):
+
+@with_endpoints(asynchronous=True)
+class AsyncIikoCardAPI(_ClientBase):
+    """ Асинхронный клиент для работы с API iiko.
+    Все запросы выполняются через один пул keep-alive соединений httpx.AsyncClient,
+    поэтому десятки запросов могут выполняться одновременно в одном event loop.
+    Требует установленный пакет httpx. Методы API создаются по описаниям из ENDPOINTS.
+    """
+
+    def __init__(self, apiLogin, timeout=180, max_connections: int = 100, customer_cache: CustomerCache = None,
+                 reference_cache: ReferenceCache = None, retry: RetryPolicy = None,
+                 rate_limiter: RateLimiter = None, circuit_breaker: CircuitBreaker = None,
+                 timeouts: dict = None, hedge_after=None, metrics: Metrics = None, coalesce: bool = True,
+                 models: bool = False, write_behind: WriteBehindQueue = None, replica: CustomerReplica = None,
+                 backend: SharedBackend = None, change_tracker: ChangeTracker = None, keepalive: bool = True,
+                 idle_timeout: float = 60, http2: bool = False, compress: int = None):
+        """ Параметры совпадают с IikoCardAPI
+        :param max_connections (optional): размер пула соединений
+        :param write_behind (optional): WriteBehindQueue; очередь отправляет изменения через event loop,
+            в котором было сделано последнее изменение, пока клиент не закрыт
         """
-        Добавить карту пользователя
-        :param customerId:
-        :param cardTrack:
-        :param cardNumber:
-        :param organizationId: (optional)
-        :return:
+        if httpx is None:
+            raise ImportError("Для AsyncIikoCardAPI необходимо установить пакет httpx")
+        super().__init__(apiLogin, timeout, customer_cache=customer_cache, reference_cache=reference_cache,
+                         retry=retry, rate_limiter=rate_limiter, circuit_breaker=circuit_breaker, timeouts=timeouts,
+                         hedge_after=hedge_after, metrics=metrics, models=models, write_behind=write_behind,
+                         replica=replica, change_tracker=change_tracker, compress=compress)
+        limits = httpx.Limits(max_connections=max_connections,
+                              max_keepalive_connections=max_connections if keepalive else 0,
+                              keepalive_expiry=idle_timeout)
+        try:
+            self.session = httpx.AsyncClient(timeout=timeout, limits=limits, http2=http2)
+        except ImportError as exc:
+            raise ImportError("Для http2=True необходимо установить пакет httpx[http2]") from exc
+        self.single_flight = AsyncSingleFlight() if coalesce else None
+        self.tokens = AsyncTokenManager(self._fetch_token, backend=backend, key=token_key(apiLogin))
+        self._background = set()
+        self._delivery = None  # функция отправки, заданная очереди write_behind
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.aclose()
+
+    async def aclose(self):
+        """ Останавливает обновление токена и закрывает пул соединений"""
+        self.tokens.close()
+        if self._delivery is not None:
+            self.write_behind.detach(self._delivery, self.apiLogin)
+        await self.session.aclose()
+
+    async def _fetch_token(self):
+        """ Запрос нового токена у API
+        :return: str - токен или None
         """
-        self.set_token()
-        result = None
-        data = {
-            "customerId": customerId,
-            "cardTrack": cardTrack,
-            "cardNumber": cardNumber,
-            "organizationId": organizationId if organizationId else self.organization_id
-        }
         try:
-            result = self.session.post(f"{self.apiURL}loyalty/iiko/customer/card/add", json=data, timeout=self.timeout, )
-            if result.status_code == 401:
-                raise ZeroDivisionError
-            result = result.json()
-        except requests.exceptions.ConnectTimeout:
-            print("Не удалось получить информацию о пользователе")
-        except ZeroDivisionError:
-            self.token = None
-            print("Not authorized")
-        return result
+            response = await self.session.post(self.urls["access_token"], json={"apiLogin": self.apiLogin},
+                                               timeout=self._token_timeout())
+            return self._token_received(response.json())
+        except httpx.HTTPError:
+            self._token_failed()
 
-    def loyalty_delete_card(self, customerId: str, cardTrack: str, organizationId: str = None):
+    async def set_token(self) -> str:
+        """Возвращает действующий токен, запрашивая новый при необходимости.
+        Одновременные вызовы ожидают одного запроса токена.
+        :return: str - токен
         """
-        Удалить карту пользователя
-        :param customerId:
-        :param cardTrack:
-        :param organizationId: (optional)
-        :return:
+        return await self.tokens.get()
+
+    async def _request(self, path: str, data: dict, idempotent: bool = False):
+        """ Выполняет запрос к API; одинаковые одновременные идемпотентные запросы объединяются в один
+        :param path: путь метода API относительно apiURL
+        :param data: тело запроса
+        :param idempotent (optional): True - запрос только читает данные и его можно повторить
+        :return: iiko .json response
+        :raises IikoError: API недоступно, ответило ошибкой или токен не принят
         """
-        self.set_token()
-        result = None
-        data = {
-            "customerId": customerId,
-            "cardTrack": cardTrack,
-            "organizationId": organizationId if organizationId else self.organization_id
-        }
+        if not idempotent or self.single_flight is None:
+            return await self._send(path, data, idempotent)
+        return await self._coalesce(path, data, self._send, path, data, True)
+
+    async def _coalesce(self, path: str, data: dict, function, *args):
+        key = flight_key(path, data)
+        if self.metrics and key in self.single_flight:
+            self.metrics.coalesced(path)
+        return await self.single_flight.do(key, function, *args)
+
+    def _timeout(self, path: str):
+        timeout = super()._timeout(path)
+        return httpx.Timeout(timeout[1], connect=timeout[0]) if isinstance(timeout, tuple) else timeout
+
+    async def _send(self, path: str, data: dict, idempotent: bool = False):
+        """ Как IikoCardAPI._send; запрос дополнительно прерывается по истечении deadline"""
+        attempt = 0
+        replayed = False
+        body, encoding = self._body(data)
+        url = self._url(path)
+        probe = None
         try:
-            result = self.session.post(f"{self.apiURL}loyalty/iiko/customer/card/remove", json=data, timeout=self.timeout, )
-            if result.status_code == 401:
-                raise ZeroDivisionError
-            result = result.json()
-        except requests.exceptions.ConnectTimeout:
-            print("Не удалось получить информацию о пользователе")
-        except ZeroDivisionError:
-            self.token = None
-            print("Not authorized")
-        return result
+            while True:
+                probe = self.circuit_breaker.before_request(path, probe)
+                if self.rate_limiter:
+                    await asyncio.sleep(backoff_pause(self.rate_limiter.reserve(), path))
+                token = await self.tokens.get()
+                timeout = self._timeout(path)
+                started = time.monotonic()
+                try:
+                    response = await asyncio.wait_for(self.session.post(
+                        url, content=body, timeout=timeout, headers=self._headers(token, encoding)), time_left(path))
+                except asyncio.TimeoutError as exc:
+                    raise DeadlineExceeded(path) from exc
+                except httpx.HTTPError as exc:
+                    pause = self._connection_failed(path, exc, idempotent or _not_sent(exc), attempt, started)
+                    await asyncio.sleep(pause)
+                    attempt += 1
+                    continue
+                if self.metrics:
+                    self.metrics.request(path, response.status_code, time.monotonic() - started, len(body),
+                                         len(response.content))
+                if response.status_code == 401:
+                    replayed = self._unauthorized(path, token, replayed)
+                    continue
+                pause = self._check_response(path, response, attempt, idempotent)
+                if pause is not None:
+                    await asyncio.sleep(pause)
+                    attempt += 1
+                    continue
+                self.latency.add(path, time.monotonic() - started)
+                return json_loads(response.content)
+        finally:
+            self.circuit_breaker.release(probe)
 
-    def loyalty_categories(self, organizationId: str = None):
-        """ Получение сведений о категориях лояльности, доступных для организации.
-            :return: iiko .json response"""
-        self.set_token()
-        result = None
-        data = {"organizationId": organizationId if organizationId else self.organization_id}
+    async def _post(self, path: str, data: dict, error_message: str, idempotent: bool = False):
+        """ Как IikoCardAPI._post"""
         try:
-            result = self.session.post(f"{self.apiURL}loyalty/iiko/customer_category", json=data, timeout=self.timeout, )
-            if result.status_code == 401:
-                raise ZeroDivisionError
-            result = result.json()
-        except requests.exceptions.ConnectTimeout:
-            print("Не удалось получить список доступных категорий")
-        except ZeroDivisionError:
-            self.token = None
-            print("Not authorized")
+            return await self._request(path, data, idempotent)
+        except IikoError as exc:
+            report_error(exc, error_message)
+            return None
+
+    async def _call_endpoint(self, endpoint: Endpoint, args: tuple, kwargs: dict):
+        """ Вызов метода API из ENDPOINTS"""
+        prepared = self._prepare(endpoint, args, kwargs)
+        if prepared is None:
+            return None
+        arguments, data = prepared
+        if endpoint.kind == 'lookup':
+            return await self._get_customer(endpoint.lookup_type, arguments[endpoint.params[0].name],
+                                            arguments.get("organizationId"))
+        if endpoint.kind == 'reference':
+            return await self._reference(endpoint.path, data, endpoint.error_message)
+        result = await self._mutate(endpoint.path, data, endpoint.error_message)
+        self._mutated(endpoint, arguments)
         return result
 
-    def loyalty_select_category(self, customerId: str, categoryId: str, organizationId: str = None):
-        """ Добавить категорию пользователю
-        :param customerId: ID пользователя
-        :param categoryId: ID категории
-        :param organizationId: (optional)"""
-        self.set_token()
-        result = None
-        data = {
-            "customerId": customerId,
-            "categoryId": categoryId,
-            "organizationId": organizationId if organizationId else self.organization_id
-        }
-        try:
-            result = self.session.post(f"{self.apiURL}loyalty/iiko/customer_category/add", json=data, timeout=self.timeout, )
-            if result.status_code == 401:
-                raise ZeroDivisionError
-            result = result.json()
-        except requests.exceptions.ConnectTimeout:
-            print("Не удалось добавить категорию пользователю")
-        except ZeroDivisionError:
-            self.token = None
-            print("Not authorized")
+    async def _mutate(self, path: str, data: dict, error_message: str):
+        """ Отправляет изменение клиента в API или, при write_behind, записывает его в очередь
+        :return: iiko .json response или None; {"queued": номер записи} при write_behind
+        """
+        if self.write_behind is not None:
+            self._delivery = functools.partial(self._deliver_threadsafe, asyncio.get_running_loop())
+            self.write_behind.start(self._delivery, self.apiLogin)
+            return {"queued": self.write_behind.put(path, data, self.apiLogin)}
+        return await self._post(path, data, error_message)
+
+    async def _deliver(self, path: str, data: dict):
+        result = await self._request(path, data)
+        self._delivered(data)
         return result
 
-    def loyalty_remove_category(self, customerId: str, categoryId: str, organizationId: str = None):
-        """ Удалить категорию пользователю
-        :param customerId: ID пользователя
-        :param categoryId: ID категории
-        :param organizationId: (optional)"""
-        self.set_token()
-        result = None
-        data = {
-            "customerId": customerId,
-            "categoryId": categoryId,
-            "organizationId": organizationId if organizationId else self.organization_id
-        }
+    def _deliver_threadsafe(self, loop, path: str, data: dict):
+        """ Отправка изменения из очереди write_behind: потоки очереди выполняют запрос в event loop клиента"""
         try:
-            result = self.session.post(f"{self.apiURL}loyalty/iiko/customer_category/remove", json=data, timeout=self.timeout, )
-            if result.status_code == 401:
-                raise ZeroDivisionError
-            result = result.json()
-        except requests.exceptions.ConnectTimeout:
-            print("Не удалось удалить категорию пользователю")
-        except ZeroDivisionError:
-            self.token = None
-            print("Not authorized")
-        return result
+            return asyncio.run_coroutine_threadsafe(self._deliver(path, data), loop).result(self.timeout)
+        except (RuntimeError, FutureTimeoutError, FutureCancelledError) as exc:
+            raise IikoConnectionError(path) from exc
 
-    def loyalty_select_program(self, customerId: str, programId: str, organizationId: str = None):
-        """ Добавить категорию пользователю
-        :param customerId: ID пользователя
-        :param programId: ID программы
-        :param organizationId: (optional)"""
-        self.set_token()
-        result = None
-        data = {
-            "customerId": customerId,
-            "programId": programId,
-            "organizationId": organizationId if organizationId else self.organization_id
-        }
+    async def gather(self, *aws, limit: int = None, return_exceptions: bool = True) -> list:
+        """
+        Одновременное выполнение нескольких запросов
+        :param aws: корутины методов клиента
+        :param limit (optional): максимальное число одновременных запросов
+        :param return_exceptions (optional): True - возвращать исключения в списке результатов
+        :return: список результатов в порядке передачи
+        """
+        if limit:
+            semaphore = asyncio.Semaphore(limit)
+
+            async def bounded(aw):
+                async with semaphore:
+                    return await aw
+
+            aws = [bounded(aw) for aw in aws]
+        return await asyncio.gather(*aws, return_exceptions=return_exceptions)
+
+    async def map(self, method, keys, *args, limit: int = None, **kwargs) -> list:
+        """
+        Вызов метода клиента для каждого ключа с одновременным выполнением
+        :param method: метод клиента, например api.get_customer_by_phone
+        :param keys: значения первого аргумента метода
+        :param limit (optional): максимальное число одновременных запросов
+        :return: список результатов в порядке ключей
+        """
+        return await self.gather(*(method(key, *args, **kwargs) for key in keys), limit=limit)
+
+    async def _iterate(self, path: str, data: dict, key: str, nested: str = None, model=None):
+        """ Как IikoCardAPI._iterate, асинхронный генератор"""
+        items = self._fresh_items(path, data, key, nested)
+        async for item in _aiter(items) if items is not None else self._stream(path, data, key, nested):
+            yield self._element(item, model)
+
+    async def _stream(self, path: str, data: dict, key: str, nested: str = None):
+        """ Как IikoCardAPI._stream, асинхронный генератор"""
+        body, encoding = self._body(data)
+        url = self._url(path)
+        replayed = False
+        probe = None
         try:
-            result = self.session.post(f"{self.apiURL}loyalty/iiko/customer/program/add", json=data, timeout=self.timeout, )
-            if result.status_code == 401:
-                raise ZeroDivisionError
-            result = result.json()
-        except requests.exceptions.ConnectTimeout:
-            print("Не удалось добавить пользователя в программу лояльности")
-        except ZeroDivisionError:
-            self.token = None
-            print("Not authorized")
-        return result
+            while True:
+                probe = self.circuit_breaker.before_request(path, probe)
+                if self.rate_limiter:
+                    await asyncio.sleep(backoff_pause(self.rate_limiter.reserve(), path))
+                token = await self.tokens.get()
+                timeout = self._timeout(path)
+                started = time.monotonic()
+                request = self.session.build_request("POST", url, content=body, timeout=timeout,
+                                                     headers=self._headers(token, encoding))
+                try:
+                    response = await self.session.send(request, stream=True)
+                except httpx.HTTPError as exc:
+                    self._connection_failed(path, exc, False, 0, started)  # без повтора: всегда исключение
+                if response.status_code != 401 or replayed:
+                    break
+                await response.aclose()
+                if self.metrics:
+                    self.metrics.request(path, 401, time.monotonic() - started, len(body))
+                replayed = self._unauthorized(path, token, replayed)
+            status = response.status_code
+            received = 0
+            try:
+                if status >= 400:
+                    await response.aread()
+                    self._stream_failed(path, status, response.text)
+                parser = JSONItemStream(key, nested)
+                try:
+                    async for chunk in response.aiter_bytes(65536):
+                        received += len(chunk)
+                        for item in parser.feed(chunk):
+                            yield item
+                        if parser.done:
+                            break
+                except httpx.HTTPError as exc:
+                    self.circuit_breaker.record_failure()
+                    raise IikoConnectionError(path) from exc
+                self._stream_finished(path, parser)
+            finally:
+                await response.aclose()
+                if self.metrics:
+                    self.metrics.request(path, status, time.monotonic() - started, len(body), received)
+        finally:
+            self.circuit_breaker.release(probe)
+
+    async def _reference(self, path: str, data: dict, error_message: str):
+        """ Как IikoCardAPI._reference"""
+        return self._parse_reference(path, await self._cached_reference(path, data, error_message))
+
+    async def _cached_reference(self, path: str, data: dict, error_message: str):
+        if self.reference_cache is None:
+            return await self._post(path, data, error_message, idempotent=True)
+        key, value, state, refresh = self._reference_entry(path, data)
+        if refresh:
+            task = asyncio.ensure_future(self._refresh_reference(key, path, data, error_message))
+            self._background.add(task)
+            task.add_done_callback(self._background.discard)
+        if state is not None:
+            return value
+        value = await self._post(path, data, error_message, idempotent=True)
+        self.reference_cache.store(key, value)
+        return value
+
+    async def _refresh_reference(self, key: str, path: str, data: dict, error_message: str):
+        try:
+            self.reference_cache.store(key, await self._post(path, data, error_message, idempotent=True))
+        finally:
+            self.reference_cache.end_refresh(key)
+
+    async def _lookup(self, path: str, data: dict):
+        """ Идемпотентный поиск с дублированием запроса (hedging): если первый запрос не ответил
+        за hedge_after секунд, отправляется второй и используется ответ, пришедший первым,
+        а оставшийся запрос отменяется.
+        :return: iiko .json response
+        :raises IikoError: обе попытки завершились ошибкой
+        """
+        if self.hedge_after is None:
+            return await self._request(path, data, idempotent=True)
+        if self.single_flight is not None:
+            return await self._coalesce(path, data, self._hedged, path, data)
+        return await self._hedged(path, data)
 
-    def get_service_organization(self, organizationId: str = None):
-        """ Получение сведений об обслуживаемых организациях
-            :return: iiko .json response"""
-        self.set_token()
-        result = None
-        data = {"organizationIds": [organizationId if organizationId else self.organization_id]}
+    async def _hedged(self, path: str, data: dict):
+        first = asyncio.ensure_future(self._send(path, data, True))
+        done, _ = await asyncio.wait([first], timeout=self._hedge_delay(path))
+        if done:
+            return first.result()
+        second = asyncio.ensure_future(self._send(path, data, True))
+        pending = {first, second}
         try:
-            result = self.session.post(f"{self.apiURL}reserve/available_organizations", json=data, timeout=self.timeout, )
-            if result.status_code == 401:
-                raise ZeroDivisionError
-            result = result.json()
-        except requests.exceptions.ConnectTimeout:
-            print("Не удалось получить список доступных к обслуживанию организаций")
-        except ZeroDivisionError:
-            self.token = None
-            print("Not authorized")
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+            return first.result()
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def _customer_info(self, type: str, value: str, organizationId: str = None):
+        """ Как IikoCardAPI._customer_info"""
+        organizationId = organizationId if organizationId else self.organization_id
+        customer = self._known_customer(organizationId, type, value)
+        if customer is not None:
+            return customer
+        generation = self._customer_generation()
+        result = await self._lookup("loyalty/iiko/customer/info", {type: value, "type": type,
+                                                                    "organizationId": organizationId})
+        self._remember_customer(organizationId, result, generation)
         return result
 
-    def get_terminal_groups(self, organizationId: str = None, includeDisabled: bool = False):
+    async def _get_customer(self, type: str, value: str, organizationId: str = None):
+        try:
+            result = await self._customer_info(type, value, organizationId)
+        except IikoError as exc:
+            report_error(exc, "Не удалось получить информацию о пользователе")
+            return None
+        return self._parse_customer(result)
+
+    async def iter_customers(self, type: str, keys, organizationId: str = None, concurrency: int = 16):
         """
-        Получение сведений о терминалах организации
-        :param organizationId(optional): None - если не установлено, используется по умолчанию
-        :param includeDisabled(optional): False - включая отключенные
-        :return: iiko .json response
+        Одновременный поиск клиентов по множеству ключей, результаты выдаются по мере готовности.
+        Повторяющиеся ключи запрашиваются один раз.
+        :param type: тип ключа поиска: id, phone, cardNumber, cardTrack
+        :param keys: итерируемый набор значений ключа
+        :param organizationId: ID организации (необязательно)
+        :param concurrency (optional): число одновременных запросов
+        :return: асинхронный генератор пар (ключ, iiko .json response, Customer или исключение)
         """
-        self.set_token()
-        result = None
-        data = {"organizationIds": [organizationId if organizationId else self.organization_id],
-                "includeDisabled": includeDisabled
-                }
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def lookup(key):
+            async with semaphore:
+                try:
+                    result = await self._customer_info(type, key, organizationId)
+                except IikoError as exc:
+                    return key, exc
+                return key, self._parse_customer(result)
+
+        tasks = [asyncio.ensure_future(lookup(key)) for key in dict.fromkeys(keys)]
         try:
-            result = self.session.post(f"{self.apiURL}reserve/available_terminal_groups", json=data, timeout=self.timeout, )
-            if result.status_code == 401:
-                raise ZeroDivisionError
-            result = result.json()
-        except requests.exceptions.ConnectTimeout:
-            print("Не удалось получить список доступных к обслуживанию организаций")
-        except ZeroDivisionError:
-            self.token = None
-            print("Not authorized")
+            for task in asyncio.as_completed(tasks):
+                yield await task
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def get_customers(self, type: str, keys, organizationId: str = None, concurrency: int = 16) -> list:
+        """ Как IikoCardAPI.get_customers"""
+        keys = list(keys)
+        results = {key: result async for key, result in self.iter_customers(type, keys, organizationId, concurrency)}
+        return [results[key] for key in keys]
+
+    async def get_customers_by_ids(self, userIds, organizationId: str = None, concurrency: int = 16) -> list:
+        """ Пакетный вариант get_customer_by_id, см. get_customers"""
+        return await self.get_customers("id", userIds, organizationId, concurrency)
+
+    async def get_customers_by_phones(self, userPhones, organizationId: str = None, concurrency: int = 16) -> list:
+        """ Пакетный вариант get_customer_by_phone, см. get_customers"""
+        return await self.get_customers("phone", userPhones, organizationId, concurrency)
+
+    async def get_customers_by_cards(self, cardNumbers, organizationId: str = None, concurrency: int = 16) -> list:
+        """ Пакетный вариант get_customer_by_card, см. get_customers"""
+        return await self.get_customers("cardNumber", cardNumbers, organizationId, concurrency)
+
+    async def refresh_replica(self, organizationId: str = None, limit: int = 100, concurrency: int = 16) -> int:
+        """ Как IikoCardAPI.refresh_replica"""
+        organizationId = organizationId if organizationId else self.organization_id
+        customerIds = self._stale_customers(organizationId, limit)
+        refreshed = 0
+        async for customerId, result in self.iter_customers("id", customerIds, organizationId, concurrency):
+            refreshed += self._refreshed(organizationId, customerId, result)
+        return refreshed
+
+    async def create_or_update_customer(self, payload: dict):
+        """ Как IikoCardAPI.create_or_update_customer"""
+        organizationId = payload.get("organizationId") or self.organization_id
+        if self._unchanged(organizationId, payload):
+            return {"unchanged": True}
+        result = await self._mutate("loyalty/iiko/customer/create_or_update", payload,
+                                    "Не удалось получить информацию о пользователе")
+        self._customer_updated(organizationId, payload, result)
         return result
 
+
+async def _aiter(items):
+    for item in items:
+        yield item
+
+
+def read_records(path: str):
+    """
+    Построчное чтение записей из CSV или JSONL без загрузки всего файла в память
+    :param path: путь к файлу .csv или .jsonl
+    :return: генератор dict; пустые поля CSV пропускаются
+    """
+    with open(path, encoding='utf-8', newline='') as file:
+        if path.lower().endswith('.csv'):
+            for row in csv.DictReader(file):
+                yield {key: value for key, value in row.items() if value not in (None, '')}
+        else:
+            for line in file:
+                if line.strip():
+                    yield json.loads(line)
+
+
+class BulkPipeline:
+    """ Массовая загрузка клиентов и карт через IikoCardAPI.
+    Записи обрабатываются потоково с ограниченной параллельностью и частотой запросов,
+    результат каждой записи пишется в выходной поток строкой JSON,
+    а прогресс сохраняется в файл контрольной точки, чтобы прерванный запуск продолжился с места остановки.
+    """
+
+    def __init__(self, api: IikoCardAPI, operation: str = 'create_or_update_customer', concurrency: int = 8,
+                 rate: float = None, checkpoint_path: str = None, checkpoint_every: int = 100):
+        """
+        :param api: клиент IikoCardAPI
+        :param operation (optional): метод клиента; create_or_update_customer получает запись как payload,
+            остальные методы (например, loyalty_add_card) - как именованные аргументы
+        :param concurrency (optional): число одновременных запросов
+        :param rate (optional): ограничение запросов в секунду
+        :param checkpoint_path (optional): файл контрольной точки
+        :param checkpoint_every (optional): как часто (в записях) сохранять контрольную точку
+        """
+        self.api = api
+        self.operation = operation
+        self.concurrency = concurrency
+        self.limiter = RateLimiter(rate) if rate else None
+        self.checkpoint_path = checkpoint_path
+        self.checkpoint_every = checkpoint_every
+        self.done = 0  # все записи с меньшим номером обработаны
+        self.completed = set()  # обработанные записи с номером не меньше done
+        if checkpoint_path and os.path.exists(checkpoint_path):
+            with open(checkpoint_path, encoding='utf-8') as file:
+                checkpoint = json.load(file)
+            self.done = checkpoint['done']
+            self.completed = set(checkpoint['completed'])
+
+    def _call(self, record: dict):
+        if self.limiter:
+            self.limiter.acquire()
+        method = getattr(self.api, self.operation)
+        if self.operation == 'create_or_update_customer':
+            return method(record)
+        return method(**record)
+
+    def _unchanged(self, record: dict) -> bool:
+        tracker = self.api.change_tracker
+        return (tracker is not None and self.operation == 'create_or_update_customer'
+                and tracker.unchanged(record.get("organizationId") or self.api.organization_id, record))
+
+    def _mark(self, index: int):
+        self.completed.add(index)
+        while self.done in self.completed:
+            self.completed.discard(self.done)
+            self.done += 1
+
+    def save_checkpoint(self):
+        if self.checkpoint_path:
+            write_json_atomic(self.checkpoint_path, {'done': self.done, 'completed': sorted(self.completed)})
+
+    def run(self, records, output=None) -> dict:
+        """
+        Обработка записей
+        :param records: итерируемый источник dict, например read_records(path)
+        :param output (optional): текстовый поток для результатов в формате JSONL
+        :return: dict - число отправленных (sent), ошибочных (failed) и пропущенных (skipped) записей;
+            пропускаются записи, обработанные до возобновления, и записи, не изменившиеся с последней отправки
+            (при api.change_tracker)
+        """
+        stats = {'sent': 0, 'failed': 0, 'skipped': 0}
+        pending = {}
+        processed = 0
+
+        def collect(futures):
+            nonlocal processed
+            for future in futures:
+                index, record = pending.pop(future)
+                try:
+                    result, error = future.result(), None
+                except Exception as exc:
+                    result, error = None, repr(exc)
+                if error is None and not isinstance(result, dict):
+                    error = 'no response'
+                elif error is None and 'errorDescription' in result:
+                    error = result['errorDescription']
+                stats['failed' if error else 'sent'] += 1
+                if output is not None:
+                    output.write(json.dumps({'index': index, 'record': record, 'result': result, 'error': error},
+                                            ensure_ascii=False) + '\n')
+                self._mark(index)
+                processed += 1
+                if processed % self.checkpoint_every == 0:
+                    self.save_checkpoint()
+
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            for index, record in enumerate(records):
+                if index < self.done or index in self.completed:
+                    stats['skipped'] += 1
+                    continue
+                if self._unchanged(record):
+                    stats['skipped'] += 1
+                    self._mark(index)
+                    continue
+                pending[executor.submit(self._call, record)] = (index, record)
+                if len(pending) >= self.concurrency * 2:
+                    finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    collect(finished)
+            collect(wait(pending)[0])
+        self.save_checkpoint()
+        if self.api.change_tracker is not None:
+            self.api.change_tracker.flush()
+        return stats
+
+
+@functools.lru_cache(maxsize=None)
+def _with_organization(method, organizationId: str):
+    """ Метод, которому передаётся organizationId, если вызов не передал его сам (по имени или по позиции).
+    None - метод не принимает organizationId
+    """
+    signature = inspect.signature(method)
+    if 'organizationId' not in signature.parameters:
+        return None
+
+    @functools.wraps(method)
+    def call(*args, **kwargs):
+        if 'organizationId' not in signature.bind_partial(*args, **kwargs).arguments:
+            kwargs['organizationId'] = organizationId
+        return method(*args, **kwargs)
+    return call
+
+
+class TenantClient:
+    """ Клиент пула IikoClientPool, привязанный к паре (apiLogin, organizationId).
+    Методы клиента вызываются с явно переданным organizationId, общий organization_id не используется.
+    """
+
+    def __init__(self, pool, apiLogin: str, organizationId: str = None):
+        self.pool = pool
+        self.apiLogin = apiLogin
+        self.organizationId = organizationId
+
+    def __getattr__(self, name):
+        method = getattr(self.pool.client(self.apiLogin), name)
+        if self.organizationId is None or not callable(method):
+            return method
+        if name == 'create_or_update_customer':
+            return lambda payload: method({"organizationId": self.organizationId, **payload})
+        if name == 'set_organization':
+            return method
+        return _with_organization(method, self.organizationId) or method
+
+
+class IikoClientPool:
+    """ Пул клиентов для множества apiLogin в одном процессе.
+    Все клиенты используют один настроенный пул соединений, у каждого логина свой токен,
+    который запрашивается при первом обращении. Клиенты, не использовавшиеся idle_timeout секунд,
+    удаляются из пула.
+        pool = IikoClientPool()
+        pool.tenant(apiLogin, organizationId).get_customer_by_phone(phone)
+    """
+
+    def __init__(self, idle_timeout: float = 900, pool_connections: int = 10, pool_maxsize: int = 100,
+                 http2: bool = False, **client_options):
+        """
+        :param idle_timeout (optional): через сколько секунд без обращений клиент удаляется из пула
+        :param pool_connections (optional): число хостов, для которых хранятся пулы соединений
+        :param pool_maxsize (optional): число соединений на хост
+        :param http2 (optional): True - общая сессия HTTP/2 (нужен httpx[http2])
+        :param client_options (optional): параметры IikoCardAPI для всех клиентов, кроме apiLogin и session.
+            Общую очередь write_behind клиенты используют вместе: изменения каждого логина отправляет
+            клиент этого логина, при необходимости созданный заново; ответы логинов в общем reference_cache
+            хранятся под разными ключами
+        """
+        self.idle_timeout = idle_timeout
+        self.client_options = client_options
+        self.session = (HTTP2Session(pool_maxsize) if http2
+                        else PooledSession(pool_maxsize, pool_connections))
+        self._clients = OrderedDict()  # apiLogin -> (IikoCardAPI, last used)
+        self._lock = threading.Lock()
+        self._closed = False
+        self.write_behind = client_options.get('write_behind')
+        if self.write_behind is not None:
+            for login in self.write_behind.logins():
+                if login is not None:
+                    self._route(login)
+
+    def client(self, apiLogin: str) -> IikoCardAPI:
+        """ Клиент для apiLogin, создаётся при первом обращении"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._clients.pop(apiLogin, None)
+            api = entry[0] if entry else IikoCardAPI(apiLogin, session=self.session, **self.client_options)
+            if entry is None and self.write_behind is not None:
+                self._route(apiLogin)
+            self._clients[apiLogin] = (api, now)
+            evicted = []
+            while self._clients:
+                login, (idle_api, used) = next(iter(self._clients.items()))
+                if now - used < self.idle_timeout:
+                    break
+                del self._clients[login]
+                evicted.append(idle_api)
+        for idle_api in evicted:
+            idle_api.close()
+        return api
+
+    def _route(self, apiLogin: str):
+        """ Изменения логина из очереди write_behind отправляет пул, а не конкретный клиент,
+        чтобы очередь не удерживала клиентов, удалённых из пула"""
+        self.write_behind.start(functools.partial(self._deliver, apiLogin), apiLogin)
+
+    def _deliver(self, apiLogin: str, path: str, data: dict):
+        if self._closed:
+            raise IikoConnectionError(path)  # изменение останется в очереди
+        return self.client(apiLogin)._deliver(path, data)
+
+    def tenant(self, apiLogin: str, organizationId: str = None) -> TenantClient:
+        """ Клиент, привязанный к логину и организации"""
+        return TenantClient(self, apiLogin, organizationId)
+
+    def call(self, apiLogin: str, organizationId: str, method: str, *args, **kwargs):
+        """ Вызов метода клиента для пары (apiLogin, organizationId)"""
+        return getattr(self.tenant(apiLogin, organizationId), method)(*args, **kwargs)
+
+    def evict(self, apiLogin: str):
+        with self._lock:
+            entry = self._clients.pop(apiLogin, None)
+        if entry:
+            entry[0].close()
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            clients = [api for api, used in self._clients.values()]
+            self._clients.clear()
+        for api in clients:
+            api.close()
+        self.session.close()
+
+    def __len__(self):
+        return len(self._clients)
@@ -0,0 +1,451 @@
+""" Локальная замена API iiko для тестов и замеров производительности IikoCardAPI без облака.
+Поддерживает методы, которые использует клиент: access_token, organizations, loyalty/iiko/*, reserve/*.
+Задержка ответов, доля ошибок и срок жизни токена настраиваются.
+
+    with IikoMockServer(latency=0.02) as server:
+        api = IikoCardAPI(server.apiLogin)
+        api.apiURL = server.url
+
+RespMockServer - минимальная замена Redis для проверки RedisBackend.
+
+Запуск из командной строки: python iiko_mock.py --port 8080 --latency 0.05
+"""
+import argparse, gzip, json, random, socket, socketserver, threading, time, uuid
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server_version = 'IikoMock/1.0'
+
+    def setup(self):
+        super().setup()
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        with self.server.mock._lock:
+            self.server.mock.connections += 1
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        mock = self.server.mock
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        if self.headers.get('Content-Encoding') == 'gzip':
+            body = gzip.decompress(body)
+            mock.compressed += 1
+        try:
+            data = json.loads(body or b'{}')
+        except ValueError:
+            return self._send(400, {"errorDescription": "Invalid JSON"})
+        path = self.path.split('/api/1/', 1)[-1]
+        status, payload, headers = mock.handle(path, data, self.headers.get('Authorization', ''))
+        self._send(status, payload, headers)
+
+    def _send(self, status: int, payload, headers: dict = None):
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8') if payload is not None else b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 256
+
+
+class IikoMockServer:
+    """ HTTP-сервер с поведением API iiko, хранит данные в памяти"""
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0, latency: float = 0.0, jitter: float = 0.0,
+                 error_rate: float = 0.0, error_status: int = 500, token_ttl: float = 3600,
+                 organizations: int = 1, programs: int = 2, terminal_groups: int = 2, seed: int = None):
+        """
+        :param host (optional): адрес сервера
+        :param port (optional): порт, 0 - любой свободный
+        :param latency (optional): задержка каждого ответа в секундах
+        :param jitter (optional): случайная добавка к задержке, от 0 до jitter секунд
+        :param error_rate (optional): доля запросов (кроме access_token), завершающихся ошибкой error_status
+        :param error_status (optional): код ответа для ошибок, для 429 добавляется заголовок Retry-After
+        :param token_ttl (optional): срок жизни токена в секундах, после него API отвечает 401
+        :param organizations (optional): число организаций
+        :param programs (optional): число программ лояльности в каждой организации
+        :param terminal_groups (optional): число терминальных групп в каждой организации
+        :param seed (optional): начальное значение генератора случайных чисел
+        """
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.retry_after = '0'  # заголовок Retry-After ответов 429
+        self.delays = []  # дополнительные задержки очередных запросов (кроме access_token), по одной на запрос
+        self.token_ttl = token_ttl
+        self.apiLogin = 'mock-api-login'
+        self.random = random.Random(seed)
+        self.calls = {}  # path -> число запросов
+        self.compressed = 0  # число запросов со сжатым телом (Content-Encoding: gzip)
+        self.connections = 0  # число принятых соединений
+        self.tokens = {}  # token -> момент истечения
+        self.customers = {}  # id -> customer
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+        self.organizations = [{"id": str(uuid.UUID(int=index + 1)), "name": f"Организация {index + 1}",
+                               "code": str(index + 1), "responseType": "Simple"}
+                              for index in range(organizations)]
+        self.programs = [{"id": str(uuid.UUID(int=1000 + index)), "name": f"Программа {index + 1}",
+                          "description": "", "serviceFrom": "2023-01-01 00:00:00.000", "serviceTo": None,
+                          "notifyAboutBalanceChanges": False, "programType": 0, "isActive": True,
+                          "walletId": str(uuid.UUID(int=2000 + index)), "appliedOrganizations": [],
+                          "marketingCampaigns": []}
+                         for index in range(programs)]
+        self.categories = [{"id": str(uuid.UUID(int=3000 + index)), "name": f"Категория {index + 1}",
+                            "isActive": True, "isDefaultForNewGuests": False}
+                           for index in range(2)]
+        self.terminal_groups = terminal_groups
+
+    @property
+    def url(self) -> str:
+        """ Адрес для IikoCardAPI.apiURL"""
+        return f"http://{self.host}:{self.port}/api/1/"
+
+    def start(self) -> str:
+        """ Запускает сервер в фоновом потоке
+        :return: адрес для IikoCardAPI.apiURL
+        """
+        self._server = _Server((self.host, self.port), _Handler)
+        self._server.mock = self
+        self.port = self._server.server_port
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self.url
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def expire_tokens(self):
+        """ Делает все выданные токены недействительными"""
+        with self._lock:
+            self.tokens.clear()
+
+    def add_customer(self, phone: str = None, name: str = None, cards: list = (), **fields) -> dict:
+        """ Создаёт клиента напрямую, без запроса
+        :param cards: список пар (track, number)
+        :return: dict - клиент в формате customer/info
+        """
+        with self._lock:
+            return self._create_customer({"phone": phone, "name": name, **fields}, cards)
+
+    def handle(self, path: str, data: dict, authorization: str):
+        """ Обработка запроса
+        :return: (status, payload, headers)
+        """
+        with self._lock:
+            self.calls[path] = self.calls.get(path, 0) + 1
+            delay = self.delays.pop(0) if self.delays and path != 'access_token' else 0.0
+        delay += self.latency + (self.random.uniform(0, self.jitter) if self.jitter else 0)
+        if delay:
+            time.sleep(delay)
+        if path == 'access_token':
+            return self._access_token(data)
+        token = authorization[len('Bearer '):] if authorization.startswith('Bearer ') else ''
+        with self._lock:
+            expires = self.tokens.get(token)
+            if expires is None or expires < time.monotonic():
+                return 401, {"errorDescription": "Unauthorized"}, None
+            if self.error_rate and self.random.random() < self.error_rate:
+                headers = {'Retry-After': self.retry_after} if self.error_status == 429 else None
+                return self.error_status, {"errorDescription": "Mock error"}, headers
+            handler = self._routes.get(path)
+            if handler is None:
+                return 404, {"errorDescription": f"Unknown method {path}"}, None
+            return handler(self, data)
+
+    def _access_token(self, data: dict):
+        if data.get('apiLogin') != self.apiLogin:
+            return 401, {"errorDescription": "Login is not authorized"}, None
+        token = uuid.uuid4().hex
+        with self._lock:
+            self.tokens[token] = time.monotonic() + self.token_ttl
+        return 200, {"correlationId": str(uuid.uuid4()), "token": token}, None
+
+    @staticmethod
+    def _ok(payload: dict):
+        return 200, {"correlationId": str(uuid.uuid4()), **payload}, None
+
+    @staticmethod
+    def _error(description: str):
+        return 400, {"correlationId": str(uuid.uuid4()), "errorDescription": description, "error": description}, None
+
+    def _organizations(self, data: dict):
+        return self._ok({"organizations": self.organizations})
+
+    def _programs(self, data: dict):
+        return self._ok({"Programs": self.programs})
+
+    def _categories(self, data: dict):
+        return self._ok({"guestCategories": self.categories})
+
+    def _available_organizations(self, data: dict):
+        ids = set(data.get("organizationIds") or ())
+        return self._ok({"organizations": [organization for organization in self.organizations
+                                           if not ids or organization["id"] in ids]})
+
+    def _terminal_groups(self, data: dict):
+        ids = data.get("organizationIds") or [organization["id"] for organization in self.organizations]
+        return self._ok({"terminalGroups": [
+            {"organizationId": organizationId,
+             "items": [{"id": str(uuid.uuid5(uuid.NAMESPACE_OID, f"{organizationId}/{index}")),
+                        "organizationId": organizationId, "name": f"Терминал {index + 1}",
+                        "address": f"Адрес {index + 1}", "timeZone": "Russian Standard Time"}
+                       for index in range(self.terminal_groups)]}
+            for organizationId in ids]})
+
+    def _find_customer(self, type: str, value: str):
+        for customer in self.customers.values():
+            if type == "id" and customer["id"] == value or type == "phone" and customer["phone"] == value:
+                return customer
+            for card in customer["cards"]:
+                if type == "cardNumber" and card["number"] == value or type == "cardTrack" and card["track"] == value:
+                    return customer
+        return None
+
+    def _create_customer(self, data: dict, cards=()) -> dict:
+        customer = {"id": str(uuid.uuid4()), "referrerId": None, "name": data.get("name"),
+                    "surname": data.get("surName"), "middleName": data.get("middleName"), "comment": None,
+                    "phone": data.get("phone"), "cultureName": "ru-RU", "birthday": data.get("birthday"),
+                    "email": data.get("email"), "sex": data.get("sex", 0), "consentStatus": 0, "anonymized": False,
+                    "cards": [], "categories": [], "walletBalances": [
+                        {"id": program["walletId"], "name": program["name"], "type": 1, "balance": 0}
+                        for program in self.programs[:1]],
+                    "userData": None, "shouldReceivePromoActionsInfo": None, "shouldReceiveLoyaltyInfo": None,
+                    "shouldReceiveOrderStatusInfo": None, "personalDataConsentFrom": None,
+                    "personalDataConsentTo": None, "personalDataProcessingFrom": None,
+                    "personalDataProcessingTo": None, "isDeleted": False}
+        for track, number in cards:
+            customer["cards"].append({"id": str(uuid.uuid4()), "track": track, "number": number,
+                                      "validToDate": None})
+        self.customers[customer["id"]] = customer
+        return customer
+
+    def _customer_info(self, data: dict):
+        type = data.get("type")
+        customer = self._find_customer(type, data.get(type))
+        if customer is None:
+            return self._error("There is no user with such phone/card/id")
+        return self._ok(customer)
+
+    def _create_or_update(self, data: dict):
+        customer = None
+        if data.get("id"):
+            customer = self.customers.get(data["id"])
+        if customer is None and data.get("phone"):
+            customer = self._find_customer("phone", data["phone"])
+        if customer is None and data.get("cardTrack"):
+            customer = self._find_customer("cardTrack", data["cardTrack"])
+        if customer is None:
+            cards = [(data["cardTrack"], data.get("cardNumber") or data["cardTrack"])] if data.get("cardTrack") else ()
+            customer = self._create_customer(data, cards)
+        for field in ("name", "middleName", "birthday", "email", "sex", "phone"):
+            if field in data:
+                customer[field] = data[field]
+        if "surName" in data:
+            customer["surname"] = data["surName"]
+        return self._ok({"id": customer["id"]})
+
+    def _card_add(self, data: dict):
+        customer = self.customers.get(data.get("customerId"))
+        if customer is None:
+            return self._error("Customer not found")
+        customer["cards"].append({"id": str(uuid.uuid4()), "track": data.get("cardTrack"),
+                                  "number": data.get("cardNumber"), "validToDate": None})
+        return self._ok({})
+
+    def _card_remove(self, data: dict):
+        customer = self.customers.get(data.get("customerId"))
+        if customer is None:
+            return self._error("Customer not found")
+        customer["cards"] = [card for card in customer["cards"]
+                             if data.get("cardTrack") not in (card["track"], card["number"])]
+        return self._ok({})
+
+    def _category_add(self, data: dict):
+        customer = self.customers.get(data.get("customerId"))
+        category = next((item for item in self.categories if item["id"] == data.get("categoryId")), None)
+        if customer is None or category is None:
+            return self._error("Customer or category not found")
+        if category not in customer["categories"]:
+            customer["categories"].append(category)
+        return self._ok({})
+
+    def _category_remove(self, data: dict):
+        customer = self.customers.get(data.get("customerId"))
+        if customer is None:
+            return self._error("Customer not found")
+        customer["categories"] = [item for item in customer["categories"] if item["id"] != data.get("categoryId")]
+        return self._ok({})
+
+    def _program_add(self, data: dict):
+        customer = self.customers.get(data.get("customerId"))
+        program = next((item for item in self.programs if item["id"] == data.get("programId")), None)
+        if customer is None or program is None:
+            return self._error("Customer or program not found")
+        if all(wallet["id"] != program["walletId"] for wallet in customer["walletBalances"]):
+            customer["walletBalances"].append({"id": program["walletId"], "name": program["name"], "type": 1,
+                                               "balance": 0})
+        return self._ok({"userWalletId": program["walletId"]})
+
+    _routes = {
+        "organizations": _organizations,
+        "loyalty/iiko/program": _programs,
+        "loyalty/iiko/customer_category": _categories,
+        "loyalty/iiko/customer/info": _customer_info,
+        "loyalty/iiko/customer/create_or_update": _create_or_update,
+        "loyalty/iiko/customer/card/add": _card_add,
+        "loyalty/iiko/customer/card/remove": _card_remove,
+        "loyalty/iiko/customer_category/add": _category_add,
+        "loyalty/iiko/customer_category/remove": _category_remove,
+        "loyalty/iiko/customer/program/add": _program_add,
+        "reserve/available_organizations": _available_organizations,
+        "reserve/available_terminal_groups": _terminal_groups,
+    }
+
+class _RespHandler(socketserver.StreamRequestHandler):
+    def setup(self):
+        super().setup()
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def handle(self):
+        while True:
+            line = self.rfile.readline()
+            if not line.startswith(b'*'):
+                return
+            args = []
+            for _ in range(int(line[1:])):
+                length = int(self.rfile.readline()[1:])
+                args.append(self.rfile.read(length + 2)[:-2])
+            self.wfile.write(self.server.mock.execute(args))
+
+
+class _RespServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class RespMockServer:
+    """ Минимальная замена Redis для тестов RedisBackend: GET, SET (NX, PX, EX), DEL, PING, AUTH, SELECT
+    и EVAL со скриптом RedisBackend.unlock"""
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0):
+        self.host = host
+        self.port = port
+        self.data = {}  # key -> (value, expires или None)
+        self.commands = {}  # имя команды -> число вызовов
+        self._lock = threading.Lock()
+        self._server = None
+
+    def start(self) -> int:
+        """ Запускает сервер в фоновом потоке
+        :return: порт
+        """
+        self._server = _RespServer((self.host, self.port), _RespHandler)
+        self._server.mock = self
+        self.port = self._server.server_address[1]
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self.port
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def execute(self, args: list) -> bytes:
+        """ Выполняет команду и возвращает ответ в формате RESP"""
+        name = args[0].decode().upper()
+        with self._lock:
+            self.commands[name] = self.commands.get(name, 0) + 1
+            if name in ('PING', 'AUTH', 'SELECT'):
+                return b'+PONG\r\n' if name == 'PING' else b'+OK\r\n'
+            if name == 'GET':
+                value = self._get(args[1])
+                return b'$-1\r\n' if value is None else b'$%d\r\n%s\r\n' % (len(value), value)
+            if name == 'EVAL':
+                # выполняется только скрипт RedisBackend.unlock: удалить ключ, если в нём указанное значение
+                if self._get(args[3]) != args[4]:
+                    return b':0\r\n'
+                del self.data[args[3]]
+                return b':1\r\n'
+            if name == 'DEL':
+                removed = sum(self.data.pop(key, None) is not None for key in args[1:])
+                return b':%d\r\n' % removed
+            if name == 'SET':
+                options = [arg.decode().upper() for arg in args[3:]]
+                expires = None
+                if 'PX' in options:
+                    expires = time.monotonic() + int(options[options.index('PX') + 1]) / 1000
+                elif 'EX' in options:
+                    expires = time.monotonic() + int(options[options.index('EX') + 1])
+                if 'NX' in options and self._get(args[1]) is not None:
+                    return b'$-1\r\n'
+                self.data[args[1]] = (args[2], expires)
+                return b'+OK\r\n'
+        return b"-ERR unknown command '%s'\r\n" % name.encode()
+
+    def _get(self, key: bytes):
+        entry = self.data.get(key)
+        if entry is None:
+            return None
+        if entry[1] is not None and entry[1] < time.monotonic():
+            del self.data[key]
+            return None
+        return entry[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Локальная замена API iiko")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--latency', type=float, default=0.0, help="задержка ответа, с")
+    parser.add_argument('--jitter', type=float, default=0.0, help="случайная добавка к задержке, с")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="доля ответов с ошибкой")
+    parser.add_argument('--error-status', type=int, default=500)
+    parser.add_argument('--token-ttl', type=float, default=3600, help="срок жизни токена, с")
+    parser.add_argument('--customers', type=int, default=0, help="число клиентов с телефонами +7000000NNNN")
+    args = parser.parse_args()
+    server = IikoMockServer(args.host, args.port, args.latency, args.jitter, args.error_rate, args.error_status,
+                            args.token_ttl)
+    for index in range(args.customers):
+        server.add_customer(phone=f"+7000000{index:04d}", name=f"Гость {index}")
+    server.start()
+    print(f"apiURL: {server.url}\napiLogin: {server.apiLogin}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,6 @@
+import asyncio
 import unittest
-from iiko import IikoCardAPI
+from iiko import IikoCardAPI, AsyncIikoCardAPI, CustomerCache
 from config import apiLogin
 from icecream import ic
 
@@ -77,6 +78,13 @@ class TestIikoAPI_1(unittest.TestCase):
         ic(info)
         self.assertIsNotNone(info)
 
+    def test_get_customers_by_phones(self) -> None:
+        """ Пакетный поиск клиентов по номерам телефонов, результаты в порядке запроса"""
+        info = self.api1.get_customers_by_phones(["+70001112233", "+70003332211", "+70001112233"])
+        ic(info)
+        self.assertEqual(info[0]['name'], 'Виктор')
+        self.assertIs(info[0], info[2])
+
     def test_get_categories(self) -> None:
         """ Проверка выдачи категорий программы лояльности"""
         lc = self.api1.loyalty_categories()
@@ -116,3 +124,44 @@ class TestIikoAPI_1(unittest.TestCase):
         info = self.api1.get_customer_by_cardTrack("80=3333")
         ic(info)
         self.assertEqual(info['phone'], '+70000000005')
+
+
+class TestCustomerCache(unittest.TestCase):
+    api1 = IikoCardAPI(apiLogin, customer_cache=CustomerCache(maxsize=100, ttl=60))
+    api1.set_organization('1131645e-f44f-4766-8ce5-df84300c15a1')
+
+    def test_cached_by_any_key(self) -> None:
+        """ Клиент, полученный по телефону, находится в кэше по id"""
+        info = self.api1.get_customer_by_phone("+70001112233")
+        cached = self.api1.customer_cache.get(self.api1.organization_id, "id", info['id'])
+        self.assertIs(cached, info)
+
+    def test_invalidate_on_update(self) -> None:
+        """ Изменение клиента удаляет его из кэша"""
+        info = self.api1.get_customer_by_phone("+70001112233")
+        self.api1.loyalty_remove_category(info['id'], "4ddc84ca-3efb-4fea-8efd-f45b4afb4e29")
+        self.assertIsNone(self.api1.customer_cache.get(self.api1.organization_id, "phone", "+70001112233"))
+
+
+class TestAsyncIikoAPI(unittest.TestCase):
+    organizationid = '1131645e-f44f-4766-8ce5-df84300c15a1'
+
+    def test_async_organizations(self) -> None:
+        """ Проверка выдачи организации асинхронным клиентом"""
+        async def run():
+            async with AsyncIikoCardAPI(apiLogin) as api:
+                return await api.organizations()
+
+        info = asyncio.run(run())
+        self.assertEqual(info['organizations'][0]['id'], self.organizationid)
+
+    def test_async_map_customers(self) -> None:
+        """ Одновременный запрос нескольких клиентов по номеру телефона"""
+        async def run():
+            async with AsyncIikoCardAPI(apiLogin) as api:
+                api.set_organization(self.organizationid)
+                return await api.map(api.get_customer_by_phone, ["+70001112233", "+70001112233"], limit=2)
+
+        info = asyncio.run(run())
+        ic(info)
+        self.assertEqual([i['name'] for i in info], ['Виктор', 'Виктор'])
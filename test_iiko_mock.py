@@ -0,0 +1,778 @@
+import asyncio
+import gc
+import datetime
+import email.utils
+import inspect
+import io
+import os
+import socket
+import tempfile
+import threading
+import time
+import unittest
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from iiko import (IikoCardAPI, AsyncIikoCardAPI, CustomerCache, ReferenceCache, BulkPipeline, IikoClientPool,
+                  Metrics, RetryPolicy, CircuitBreaker, IikoHTTPError, Customer, Program, TerminalGroup,
+                  WriteBehindQueue, CustomerReplica, SharedBackend, SQLiteBackend, RedisBackend, ChangeTracker,
+                  PooledSession, JSONItemStream, RateLimiter, DeadlineExceeded, TokenManager, deadline)
+from iiko_mock import IikoMockServer, RespMockServer
+
+
+class TestIikoMock(unittest.TestCase):
+    """ Тесты клиента на локальной замене API iiko, без обращения к облаку"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = IikoMockServer(seed=0)
+        cls.server.start()
+        cls.organizationid = cls.server.organizations[0]['id']
+        cls.customer = cls.server.add_customer(phone="+70001112233", name="Виктор",
+                                               cards=[("44=333222111", "444333222111")])
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+
+    def make_api(self, **options) -> IikoCardAPI:
+        api = IikoCardAPI(self.server.apiLogin, **options)
+        api.apiURL = self.server.url
+        api.set_organization(self.organizationid)
+        self.addCleanup(api.close)
+        return api
+
+    def test_get_customer_by_keys(self) -> None:
+        """ Поиск клиента по телефону, id, карте и треку"""
+        api = self.make_api()
+        self.assertEqual(api.get_customer_by_phone("+70001112233")['name'], 'Виктор')
+        self.assertEqual(api.get_customer_by_id(self.customer['id'])['phone'], '+70001112233')
+        self.assertEqual(api.get_customer_by_card("444333222111")['id'], self.customer['id'])
+        self.assertEqual(api.get_customer_by_cardTrack("44=333222111")['id'], self.customer['id'])
+
+    def test_endpoint_methods(self) -> None:
+        """ Методы из ENDPOINTS сохраняют сигнатуры, группы таймаутов раскрываются в пути,
+        вызов без обязательного параметра не отправляется"""
+        self.assertEqual(list(inspect.signature(AsyncIikoCardAPI.loyalty_add_card).parameters),
+                         ['self', 'customerId', 'cardTrack', 'cardNumber', 'organizationId'])
+        self.assertTrue(inspect.iscoroutinefunction(AsyncIikoCardAPI.get_customer_by_phone))
+        self.assertEqual(IikoCardAPI.get_terminal_groups.__qualname__, 'IikoCardAPI.get_terminal_groups')
+        self.assertIn('includeDisabled', IikoCardAPI.get_terminal_groups.__doc__)
+        api = self.make_api(timeouts={'reference': 5, 'organizations': 7})
+        self.assertEqual((api.timeouts['loyalty/iiko/program'], api.timeouts['organizations']), (5, 7))
+        calls = dict(self.server.calls)
+        self.assertIsNone(api.loyalty_add_card("", "44=1", "441"))
+        self.assertEqual(self.server.calls, calls)
+        with self.assertRaises(TypeError):
+            api.loyalty_add_card("id", "44=1", "441", self.organizationid, "лишний")
+        self.assertEqual(api.get_terminal_groups()['terminalGroups'][0]['organizationId'], self.organizationid)
+
+    def test_reauthorize_after_401(self) -> None:
+        """ После истечения токена запрос повторяется с новым токеном"""
+        api = self.make_api()
+        token = api.set_token()
+        self.server.expire_tokens()
+        self.assertIsNotNone(api.loyalty_programs()['Programs'])
+        self.assertNotEqual(api.token, token)
+
+    def test_token_refresh(self) -> None:
+        """ Токен обновляется в фоне до истечения, одновременные обновления выполняют один запрос,
+        закрытые и брошенные клиенты не оставляют фоновых потоков"""
+        fetched = []
+
+        def fetch():
+            time.sleep(0.05)
+            fetched.append(time.monotonic())
+            return f"token-{len(fetched)}"
+
+        tokens = TokenManager(fetch, refresh_margin=0.1)
+        tokens.lifetime = 0.2
+        self.addCleanup(tokens.close)
+        with ThreadPoolExecutor(max_workers=10) as executor:
+            self.assertEqual(set(executor.map(lambda _: tokens.get(), range(10))), {"token-1"})
+        time.sleep(0.3)
+        self.assertGreaterEqual(len(fetched), 2)
+        self.assertTrue(tokens.is_fresh())
+        threads = threading.active_count()
+        clients = weakref.WeakSet()
+        for _ in range(20):
+            with IikoCardAPI(self.server.apiLogin) as api:
+                api.apiURL = self.server.url
+                api.set_token()
+            api = IikoCardAPI(self.server.apiLogin)
+            api.tokens._schedule(60)
+            clients.add(api)
+        del api
+        gc.collect()
+        self.assertEqual(len(clients), 0)
+        self.assertLessEqual(threading.active_count(), threads + 1)
+
+    def test_customer_cache(self) -> None:
+        """ Клиент, найденный по телефону, берётся из кэша по карте; изменение сбрасывает кэш"""
+        api = self.make_api(customer_cache=CustomerCache())
+        api.get_customer_by_phone("+70001112233")
+        calls = self.server.calls["loyalty/iiko/customer/info"]
+        api.get_customer_by_card("444333222111")
+        self.assertEqual(self.server.calls["loyalty/iiko/customer/info"], calls)
+        api.loyalty_select_category(self.customer['id'], self.server.categories[0]['id'])
+        api.get_customer_by_card("444333222111")
+        self.assertEqual(self.server.calls["loyalty/iiko/customer/info"], calls + 1)
+        cache, customer = api.customer_cache, api.get_customer_by_card("444333222111")
+        generation = cache.generation()
+        cache.invalidate(self.organizationid, phone="+79990000000")
+        cache.put(self.organizationid, customer, generation)
+        self.assertIs(cache.get(self.organizationid, "id", self.customer['id']), customer)
+        generation = cache.generation()
+        cache.invalidate(self.organizationid, id=self.customer['id'])
+        cache.put(self.organizationid, customer, generation)
+        self.assertIsNone(cache.get(self.organizationid, "phone", "+70001112233"))
+
+    def test_reference_snapshot(self) -> None:
+        """ Справочники из снимка на диске не требуют запросов"""
+        path = os.path.join(tempfile.mkdtemp(), 'snapshot.json')
+        self.make_api(reference_cache=ReferenceCache(snapshot_path=path)).organizations()
+        calls = dict(self.server.calls)
+        result = self.make_api(reference_cache=ReferenceCache(snapshot_path=path)).organizations()
+        self.assertEqual(result['organizations'][0]['id'], self.organizationid)
+        self.assertEqual(self.server.calls, calls)
+
+    def test_batch_lookup(self) -> None:
+        """ Пакетный поиск возвращает результаты в порядке ключей, ошибки - на месте ключа"""
+        api = self.make_api()
+        info = api.get_customers_by_phones(["+70001112233", "+79999999999", "+70001112233"])
+        self.assertEqual(info[0]['id'], self.customer['id'])
+        self.assertIn('errorDescription', info[1])
+        self.assertIs(info[0], info[2])
+
+    def test_retry_and_circuit_breaker(self) -> None:
+        """ Ошибки 5xx повторяются для поиска, а после серии отказов цепь размыкается"""
+        api = self.make_api(retry=RetryPolicy(attempts=2, backoff=0.001), circuit_breaker=CircuitBreaker(2, 60))
+        api.set_token()
+        self.server.error_rate = 1.0
+        try:
+            with self.assertRaises(IikoHTTPError):
+                api._request("loyalty/iiko/customer/info", {"type": "phone", "phone": "+70001112233"}, True)
+            self.assertEqual(api.circuit_breaker.state, 'open')
+            self.assertIsNone(api.get_customer_by_phone("+70001112233"))
+        finally:
+            self.server.error_rate = 0.0
+
+    def test_rate_limited_429(self) -> None:
+        """ Ответ 429 повторяется и для изменений после паузы из Retry-After и не размыкает цепь"""
+        api = self.make_api(retry=RetryPolicy(attempts=3, backoff=10))
+        api.set_token()
+        self.server.error_status, self.server.error_rate, self.server.retry_after = 429, 1.0, '0.05'
+        try:
+            started = time.monotonic()
+            with self.assertRaises(IikoHTTPError) as error:
+                api._request("loyalty/iiko/customer_category/add", {"customerId": self.customer['id']})
+            self.assertEqual(error.exception.status, 429)
+            self.assertGreaterEqual(time.monotonic() - started, 0.1)
+            self.assertEqual(api.circuit_breaker.state, 'closed')
+        finally:
+            self.server.error_status, self.server.error_rate, self.server.retry_after = 500, 0.0, '0'
+
+    def test_half_open_probe_released(self) -> None:
+        """ Пробный запрос, прерванный ответом 429 или deadline, не оставляет цепь разомкнутой навсегда"""
+        data = {"organizationId": self.organizationid}
+        api = self.make_api(retry=RetryPolicy(attempts=1), circuit_breaker=CircuitBreaker(1, 0.05),
+                            rate_limiter=RateLimiter(1))
+        api.set_token()
+        api._request("loyalty/iiko/program", data, True)
+        api.circuit_breaker.record_failure()
+        time.sleep(0.06)
+        with deadline(0.2), self.assertRaises(DeadlineExceeded):
+            api._request("loyalty/iiko/program", data, True)
+        api.rate_limiter = None
+        self.server.error_status, self.server.error_rate = 429, 1.0
+        try:
+            with self.assertRaises(IikoHTTPError):
+                api._request("loyalty/iiko/program", data, True)
+        finally:
+            self.server.error_status, self.server.error_rate = 500, 0.0
+        self.assertEqual(api.circuit_breaker.state, 'half-open')
+        self.assertIsNotNone(api._request("loyalty/iiko/program", data, True))
+        self.assertEqual(api.circuit_breaker.state, 'closed')
+
+        async def run():
+            async with AsyncIikoCardAPI(self.server.apiLogin, retry=RetryPolicy(attempts=1),
+                                        circuit_breaker=CircuitBreaker(1, 0.05)) as client:
+                client.apiURL = self.server.url
+                client.circuit_breaker.record_failure()
+                await asyncio.sleep(0.06)
+                self.server.error_status, self.server.error_rate = 429, 1.0
+                try:
+                    with self.assertRaises(IikoHTTPError):
+                        await client._request("loyalty/iiko/program", data, True)
+                finally:
+                    self.server.error_status, self.server.error_rate = 500, 0.0
+                await client._request("loyalty/iiko/program", data, True)
+                return client.circuit_breaker.state
+
+        self.assertEqual(asyncio.run(run()), 'closed')
+
+    def test_retry_after_and_rate_limiter(self) -> None:
+        """ Retry-After в секундах и в виде HTTP-даты, равномерная отправка запросов через RateLimiter"""
+        retry = RetryPolicy(max_retry_after=60)
+        self.assertEqual(retry.delay(0, '2'), 2.0)
+        self.assertEqual(retry.delay(0, '120'), 60)
+        moment = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=30)
+        self.assertAlmostEqual(retry.delay(0, email.utils.format_datetime(moment, usegmt=True)), 30, delta=2)
+        self.assertEqual(retry.delay(0, 'Mon, 01 Jan 2001 00:00:00 GMT'), 0)
+        limiter = RateLimiter(20, burst=1)
+        self.assertEqual(limiter.reserve(), 0.0)
+        self.assertAlmostEqual(limiter.reserve(), 0.05, delta=0.01)
+        started = time.monotonic()
+        for _ in range(3):
+            limiter.acquire()
+        self.assertGreaterEqual(time.monotonic() - started, 0.14)
+        api = self.make_api(rate_limiter=RateLimiter(20, burst=1))
+        api.set_token()
+        started = time.monotonic()
+        for _ in range(4):
+            self.assertTrue(list(api.iter_loyalty_programs()))
+        self.assertGreaterEqual(time.monotonic() - started, 0.14)
+
+        async def run():
+            async with AsyncIikoCardAPI(self.server.apiLogin, rate_limiter=RateLimiter(20, burst=1)) as client:
+                client.apiURL = self.server.url
+                client.set_organization(self.organizationid)
+                await client.set_token()
+                started = time.monotonic()
+                for _ in range(4):
+                    self.assertTrue([program async for program in client.iter_loyalty_programs()])
+                return time.monotonic() - started
+
+        self.assertGreaterEqual(asyncio.run(run()), 0.14)
+
+    def test_mutation_retry_before_send(self) -> None:
+        """ Изменение повторяется, если соединение не установлено, одинаково в обоих клиентах"""
+        probe = socket.socket()
+        probe.bind(('127.0.0.1', 0))
+        refused = f"http://127.0.0.1:{probe.getsockname()[1]}/"
+        probe.close()
+        metrics = Metrics()
+        api = self.make_api(retry=RetryPolicy(attempts=3, backoff=0.001), metrics=metrics)
+        api.set_token()
+        api.apiURL = refused
+        self.assertIsNone(api.loyalty_select_category(self.customer['id'], self.server.categories[0]['id']))
+
+        async def run():
+            async with AsyncIikoCardAPI(self.server.apiLogin, retry=RetryPolicy(attempts=3, backoff=0.001),
+                                        metrics=metrics) as client:
+                client.apiURL = self.server.url
+                await client.set_token()
+                client.apiURL = refused
+                return await client.loyalty_select_category(self.customer['id'], self.server.categories[0]['id'],
+                                                             self.organizationid)
+
+        self.assertIsNone(asyncio.run(run()))
+        retries = {reason: count for (path, reason), count in metrics.retries.items()}
+        self.assertEqual(retries, {'ConnectionError': 2, 'ConnectError': 2})
+
+    def test_deadline(self) -> None:
+        """ Вызов прерывается по истечении deadline, в том числе пока запрашивается токен"""
+        api = self.make_api()
+        api.set_token()
+        self.server.latency = 0.5
+        try:
+            with deadline(0.1):
+                self.assertIsNone(api.get_customer_by_phone("+70001112233"))
+            api.tokens.invalidate(api.tokens.token)
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                refresh = executor.submit(api.set_token)
+                time.sleep(0.05)
+                for _ in range(2):
+                    started = time.monotonic()
+                    with deadline(0.1):
+                        self.assertIsNone(api.get_customer_by_phone("+70001112233"))
+                    self.assertLess(time.monotonic() - started, 0.3)
+                refresh.result()
+            api.tokens.invalidate(api.tokens.token)
+            started = time.monotonic()
+            with deadline(0.1):
+                self.assertRaises(DeadlineExceeded, api.set_token)
+            self.assertLess(time.monotonic() - started, 0.3)
+        finally:
+            self.server.latency = 0.0
+
+    def test_async_deadline(self) -> None:
+        """ Асинхронный вызов прерывается по истечении deadline"""
+        async def run():
+            async with AsyncIikoCardAPI(self.server.apiLogin) as api:
+                api.apiURL = self.server.url
+                await api.set_token()
+                self.server.latency = 0.5
+                started = time.monotonic()
+                with deadline(0.1):
+                    info = await api.get_customer_by_phone("+70001112233", self.organizationid)
+                return info, time.monotonic() - started
+
+        try:
+            info, elapsed = asyncio.run(run())
+        finally:
+            self.server.latency = 0.0
+        self.assertIsNone(info)
+        self.assertLess(elapsed, 0.4)
+
+    def test_endpoint_timeouts(self) -> None:
+        """ Таймаут (connect, read) группы методов не действует на остальные методы"""
+        path = "loyalty/iiko/customer/info"
+        api = self.make_api(timeouts={'lookup': (1, 0.1)}, retry=RetryPolicy(attempts=1))
+        api.set_token()
+        self.assertEqual(api._timeout(path), (1, 0.1))
+        with deadline(0.05):
+            self.assertLessEqual(max(api._timeout(path)), 0.05)
+        self.server.latency = 0.3
+        try:
+            self.assertIsNone(api.get_customer_by_phone("+70001112233"))
+            self.assertTrue(api.loyalty_programs()['Programs'])
+        finally:
+            self.server.latency = 0.0
+
+        async def run():
+            async with AsyncIikoCardAPI(self.server.apiLogin, timeouts={'lookup': (1, 0.1)}) as client:
+                timeout = client._timeout(path)
+                return timeout.connect, timeout.read
+
+        self.assertEqual(asyncio.run(run()), (1, 0.1))
+
+    def test_hedged_lookup(self) -> None:
+        """ Если поиск клиента не ответил за hedge_after, отправляется второй запрос,
+        результат - ответ, пришедший первым"""
+        path = "loyalty/iiko/customer/info"
+        for hedge_after in (0.05, 'p95'):
+            api = self.make_api(hedge_after=hedge_after)
+            api.set_token()
+            if hedge_after == 'p95':
+                self.assertEqual(api._hedge_delay(path), api.hedge_default)
+                for _ in range(20):
+                    api.get_customer_by_phone("+70001112233")
+                self.assertLess(api._hedge_delay(path), 0.4)
+            calls = self.server.calls[path]
+            self.server.delays = [0.5]
+            started = time.monotonic()
+            self.assertEqual(api.get_customer_by_phone("+70001112233")['id'], self.customer['id'])
+            self.assertLess(time.monotonic() - started, 0.4)
+            self.assertEqual(self.server.calls[path], calls + 2)
+            self.server.delays = []
+
+    def test_async_hedged_lookup(self) -> None:
+        """ Асинхронный поиск с дублированием отменяет запрос, не успевший ответить первым"""
+        async def run():
+            async with AsyncIikoCardAPI(self.server.apiLogin, hedge_after=0.05) as api:
+                api.apiURL = self.server.url
+                await api.set_token()
+                self.server.delays = [0.5]
+                info = await api.get_customer_by_phone("+70001112233", self.organizationid)
+                others = asyncio.all_tasks() - {asyncio.current_task()}
+                await asyncio.sleep(0.05)
+                return info, [task.cancelled() for task in others]
+
+        calls = self.server.calls.get("loyalty/iiko/customer/info", 0)
+        try:
+            info, cancelled = asyncio.run(run())
+        finally:
+            self.server.delays = []
+        self.assertEqual(info['id'], self.customer['id'])
+        self.assertEqual(self.server.calls["loyalty/iiko/customer/info"], calls + 2)
+        self.assertEqual(cancelled, [True])
+
+    def test_metrics(self) -> None:
+        """ Метрики запросов в формате Prometheus; исключение обработчика событий не прерывает запрос"""
+        events = []
+
+        def on_event(event):
+            events.append(event)
+            raise RuntimeError("log handler failed")
+
+        metrics = Metrics(on_event=on_event)
+        info = self.make_api(metrics=metrics).get_customer_by_phone("+70001112233")
+        self.assertEqual(info['id'], self.customer['id'])
+        self.assertTrue(events)
+        text = metrics.render_prometheus()
+        self.assertIn('iiko_responses_total{path="loyalty/iiko/customer/info",status="200"} 1', text)
+        self.assertIn('iiko_token_refreshes_total{result="success"} 1', text)
+
+    def test_bulk_pipeline(self) -> None:
+        """ Массовая загрузка с продолжением по контрольной точке"""
+        checkpoint = os.path.join(tempfile.mkdtemp(), 'checkpoint.json')
+        records = [{"phone": f"+7100000{index:04d}", "organizationId": self.organizationid} for index in range(20)]
+        output = io.StringIO()
+        stats = BulkPipeline(self.make_api(), concurrency=4, checkpoint_path=checkpoint).run(records[:10], output)
+        self.assertEqual(stats, {'sent': 10, 'failed': 0, 'skipped': 0})
+        stats = BulkPipeline(self.make_api(), concurrency=4, checkpoint_path=checkpoint).run(records, output)
+        self.assertEqual(stats, {'sent': 10, 'failed': 0, 'skipped': 10})
+        self.assertEqual(len(output.getvalue().splitlines()), 20)
+
+    def test_change_tracker(self) -> None:
+        """ Записи, не изменившиеся с прошлой синхронизации, не отправляются; после ошибки
+        или другого изменения клиента запись отправляется снова"""
+        path = os.path.join(tempfile.mkdtemp(), 'fingerprints.db')
+        records = [{"phone": f"+7200000{index:04d}", "name": f"Гость {index}", "organizationId": self.organizationid}
+                   for index in range(10)]
+        tracker = ChangeTracker(path)
+        stats = BulkPipeline(self.make_api(change_tracker=tracker), concurrency=4).run(records)
+        self.assertEqual(stats, {'sent': 10, 'failed': 0, 'skipped': 0})
+        tracker.close()
+        records[3] = {**records[3], "email": "guest3@example.com"}
+        calls = self.server.calls["loyalty/iiko/customer/create_or_update"]
+        tracker = ChangeTracker(path)
+        self.addCleanup(tracker.close)
+        api = self.make_api(change_tracker=tracker)
+        self.assertEqual(BulkPipeline(api, concurrency=4).run(records), {'sent': 1, 'failed': 0, 'skipped': 9})
+        self.assertEqual(api.create_or_update_customer(records[3]), {"unchanged": True})
+        self.assertEqual(self.server.calls["loyalty/iiko/customer/create_or_update"], calls + 1)
+        self.server.error_status, self.server.error_rate = 400, 1.0
+        try:
+            self.assertIn('errorDescription', api.create_or_update_customer({**records[5], "name": "Гость"}))
+        finally:
+            self.server.error_status, self.server.error_rate = 500, 0.0
+        self.assertNotIn('unchanged', api.create_or_update_customer(records[5]))
+        update = {"id": self.customer['id'], "organizationId": self.organizationid, "name": "Виктор"}
+        api.create_or_update_customer(update)
+        self.assertEqual(api.create_or_update_customer(update), {"unchanged": True})
+        api.loyalty_select_category(self.customer['id'], self.server.categories[0]['id'])
+        self.assertNotIn('unchanged', api.create_or_update_customer(update))
+
+    def test_client_pool(self) -> None:
+        """ Клиенты пула используют общую сессию и передают организацию в каждом вызове"""
+        pool = IikoClientPool()
+        self.addCleanup(pool.close)
+        pool.client(self.server.apiLogin).apiURL = self.server.url
+        tenant = pool.tenant(self.server.apiLogin, self.organizationid)
+        info = tenant.get_customer_by_phone("+70001112233")
+        self.assertEqual(info['id'], self.customer['id'])
+        self.assertIsNone(pool.client(self.server.apiLogin).organization_id)
+        self.assertEqual(tenant.get_customer_by_phone("+70001112233", self.organizationid)['id'], info['id'])
+        self.assertEqual(tenant.get_customers_by_phones(["+70001112233"], self.organizationid)[0]['id'], info['id'])
+        tenant.set_organization(self.organizationid)
+        self.assertEqual(pool.client(self.server.apiLogin).organization_id, self.organizationid)
+
+    def test_pool_reference_cache(self) -> None:
+        """ Общий кэш справочников пула не отдаёт ответы одного логина клиенту другого"""
+        pool = IikoClientPool(reference_cache=ReferenceCache())
+        self.addCleanup(pool.close)
+        for login in (self.server.apiLogin, 'other-login'):
+            pool.client(login).apiURL = self.server.url
+        self.assertTrue(pool.tenant(self.server.apiLogin).organizations()['organizations'])
+        self.assertIsNone(pool.tenant('other-login').organizations())
+
+    def test_connection_pool(self) -> None:
+        """ Потоки используют соединения общего пула, простаивавшие соединения закрываются"""
+        api = self.make_api(session=PooledSession(pool_maxsize=4, pool_block=True), coalesce=False)
+        api.set_token()
+        connections = self.server.connections
+        with ThreadPoolExecutor(max_workers=16) as executor:
+            list(executor.map(lambda _: api.get_customer_by_phone("+70001112233"), range(256)))
+        self.assertLessEqual(self.server.connections - connections, 4)
+        connections = self.server.connections
+        api.session.idle_timeout = 0
+        api.get_customer_by_phone("+70001112233")
+        self.assertEqual(self.server.connections, connections + 1)
+
+    def test_compress(self) -> None:
+        """ Тела запросов больше порога сжимаются gzip"""
+        compressed = self.server.compressed
+        self.assertEqual(self.make_api(compress=0).get_customer_by_phone("+70001112233")['id'], self.customer['id'])
+        self.assertEqual(self.server.compressed, compressed + 1)
+
+    def test_coalesce_identical_requests(self) -> None:
+        """ Одинаковые одновременные запросы из разных потоков отправляются один раз"""
+        api = self.make_api()
+        api.set_token()
+        calls = self.server.calls.get("loyalty/iiko/program", 0)
+        self.server.latency = 0.2
+        try:
+            with ThreadPoolExecutor(max_workers=10) as executor:
+                results = list(executor.map(lambda _: api.loyalty_programs(), range(10)))
+        finally:
+            self.server.latency = 0.0
+        self.assertEqual(self.server.calls["loyalty/iiko/program"], calls + 1)
+        self.assertTrue(all(result is results[0] for result in results))
+
+    def test_coalesce_mixed_deadlines(self) -> None:
+        """ Вызов без deadline, ожидавший объединённый запрос, повторяет его, если истёк deadline первого вызова;
+        вызовы с deadline не оставляют после себя выполняющихся запросов"""
+        api = self.make_api()
+        api.set_token()
+        calls = self.server.calls.get("loyalty/iiko/program", 0)
+
+        def limited():
+            with deadline(0.2):
+                return api.loyalty_programs()
+
+        self.server.latency = 0.5
+        try:
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                first = executor.submit(limited)
+                time.sleep(0.05)
+                second = executor.submit(api.loyalty_programs)
+                self.assertIsNone(first.result())
+                self.assertTrue(second.result()['Programs'])
+        finally:
+            self.server.latency = 0.0
+        self.assertEqual(self.server.calls["loyalty/iiko/program"], calls + 2)
+
+        def client_threads():
+            return sum('process_request_thread' not in thread.name for thread in threading.enumerate())
+
+        threads = client_threads()
+        self.server.latency = 1.0
+        try:
+            for _ in range(10):
+                with deadline(0.05):
+                    self.assertIsNone(api.loyalty_programs())
+            self.assertLessEqual(client_threads(), threads)
+        finally:
+            self.server.latency = 0.0
+
+        async def run():
+            async with AsyncIikoCardAPI(self.server.apiLogin) as client:
+                client.apiURL = self.server.url
+                client.set_organization(self.organizationid)
+                await client.set_token()
+                self.server.latency = 0.5
+
+                async def async_limited():
+                    with deadline(0.2):
+                        return await client.loyalty_programs()
+
+                first = asyncio.ensure_future(async_limited())
+                await asyncio.sleep(0.05)
+                results = await asyncio.gather(first, client.loyalty_programs())
+                for _ in range(10):
+                    with deadline(0.05):
+                        await client.loyalty_programs()
+                await asyncio.sleep(0.05)
+                return results, len(asyncio.all_tasks())
+
+        try:
+            (limited_result, result), tasks = asyncio.run(run())
+        finally:
+            self.server.latency = 0.0
+        self.assertIsNone(limited_result)
+        self.assertTrue(result['Programs'])
+        self.assertEqual(tasks, 1)
+
+    def test_async_coalesce(self) -> None:
+        """ Одинаковые одновременные запросы в event loop отправляются один раз"""
+        async def run():
+            async with AsyncIikoCardAPI(self.server.apiLogin) as api:
+                api.apiURL = self.server.url
+                return await asyncio.gather(*(api.get_customer_by_card("444333222111", self.organizationid)
+                                              for _ in range(10)))
+
+        calls = self.server.calls.get("loyalty/iiko/customer/info", 0)
+        info = asyncio.run(run())
+        self.assertEqual(self.server.calls["loyalty/iiko/customer/info"], calls + 1)
+        self.assertEqual(info[9]['id'], self.customer['id'])
+
+    def test_models(self) -> None:
+        """ В режиме моделей поиск и справочники возвращают объекты, ошибки - как прежде dict"""
+        api = self.make_api(models=True)
+        customer = api.get_customer_by_phone("+70001112233")
+        self.assertIsInstance(customer, Customer)
+        self.assertFalse(hasattr(customer, '__dict__'))
+        self.assertIsInstance(customer._cards, list)
+        self.assertEqual(customer.cards[0].number, "444333222111")
+        self.assertIsInstance(customer._cards, tuple)
+        self.assertIn('errorDescription', api.get_customer_by_phone("+79999999999"))
+        self.assertIsInstance(api.loyalty_programs()[0], Program)
+        groups = api.get_terminal_groups()
+        self.assertTrue(all(isinstance(group, TerminalGroup) for group in groups))
+
+    def test_write_behind(self) -> None:
+        """ Изменения при недоступном API сохраняются в очереди и отправляются по порядку, подряд идущие
+        create_or_update одного клиента объединяются в один вызов"""
+        path = os.path.join(tempfile.mkdtemp(), 'mutations.db')
+        customer = self.server.add_customer(phone="+70005556677", name="Анна")
+        update = {"id": customer['id'], "organizationId": self.organizationid}
+        self.server.error_rate = 1.0
+        try:
+            queue = WriteBehindQueue(path, backoff=0.01)
+            api = self.make_api(write_behind=queue)
+            self.assertIn('queued', api.create_or_update_customer({**update, "name": "Мария"}))
+            api.create_or_update_customer({**update, "email": "maria@example.com"})
+            api.loyalty_select_category(customer['id'], self.server.categories[0]['id'])
+            queue.close()
+            queue = WriteBehindQueue(path, backoff=0.01)
+            self.addCleanup(queue.close)
+            self.assertEqual(queue.pending(), 3)
+            calls = self.server.calls.get("loyalty/iiko/customer/create_or_update", 0)
+        finally:
+            self.server.error_rate = 0.0
+        self.make_api(write_behind=queue)
+        self.assertTrue(queue.drain(timeout=5))
+        self.assertEqual(self.server.calls["loyalty/iiko/customer/create_or_update"], calls + 1)
+        self.assertEqual((customer['name'], customer['email']), ("Мария", "maria@example.com"))
+        self.assertEqual(queue.failed(), [])
+
+    def test_write_behind_sender_errors(self) -> None:
+        """ Исключение функции отправки помечает изменение failed и не останавливает поток очереди;
+        drain не ждёт изменений логина без функции отправки"""
+        queue = WriteBehindQueue(os.path.join(tempfile.mkdtemp(), 'mutations.db'), workers=1, backoff=0.01)
+        self.addCleanup(queue.close)
+        sent = []
+
+        def sender(path, data):
+            if not sent:
+                sent.append(None)
+                raise ValueError("not JSON")
+            sent.append(data['customerId'])
+            return {}
+
+        queue.put("loyalty/iiko/customer_category/add", {"customerId": "1"})
+        queue.put("loyalty/iiko/customer_category/add", {"customerId": "2"})
+        queue.put("loyalty/iiko/customer_category/add", {"customerId": "3"}, login='other-login')
+        queue.start(sender)
+        self.assertTrue(queue.drain(timeout=2))
+        self.assertEqual(sent, [None, "2"])
+        self.assertEqual([(data, error) for row, path, data, error in queue.failed()],
+                         [({"customerId": "1"}, "ValueError('not JSON')")])
+        self.assertEqual(queue.pending(), 1)
+
+    def test_pool_write_behind(self) -> None:
+        """ Изменения из общей очереди пула отправляет клиент того логина, которым они записаны"""
+        queue = WriteBehindQueue(os.path.join(tempfile.mkdtemp(), 'mutations.db'), backoff=0.01, max_attempts=1)
+        self.addCleanup(queue.close)
+        pool = IikoClientPool(write_behind=queue)
+        self.addCleanup(pool.close)
+        for login in (self.server.apiLogin, 'other-login'):
+            pool.client(login).apiURL = self.server.url
+        customer = self.server.add_customer(phone="+70009998877", name="Олег")
+        first, second = (category['id'] for category in self.server.categories[:2])
+        pool.tenant('other-login', self.organizationid).loyalty_select_category(customer['id'], first)
+        pool.tenant(self.server.apiLogin, self.organizationid).loyalty_select_category(customer['id'], second)
+        self.assertTrue(queue.drain(timeout=5))
+        self.assertEqual([data['categoryId'] for row, path, data, error in queue.failed()], [first])
+        self.assertEqual([category['id'] for category in customer['categories']], [second])
+
+    def test_customer_replica(self) -> None:
+        """ Клиент из реплики на диске находится по любому ключу без запроса к API,
+        собственные изменения попадают в реплику, устаревшие записи обновляются"""
+        path = os.path.join(tempfile.mkdtemp(), 'replica.db')
+        customer = self.server.add_customer(phone="+70007778899", name="Олег", cards=[("77=1", "771")])
+        self.make_api(replica=CustomerReplica(path)).get_customer_by_phone("+70007778899")
+        replica = CustomerReplica(path)
+        self.addCleanup(replica.close)
+        api = self.make_api(replica=replica)
+        calls = self.server.calls["loyalty/iiko/customer/info"]
+        self.assertEqual(api.get_customer_by_cardTrack("77=1")['id'], customer['id'])
+        api.create_or_update_customer({"id": customer['id'], "organizationId": self.organizationid, "name": "Олег П."})
+        self.assertEqual(api.get_customer_by_card("771")['name'], "Олег П.")
+        self.assertEqual(self.server.calls["loyalty/iiko/customer/info"], calls)
+        replica.max_age = 0
+        self.assertEqual(api.refresh_replica(), 1)
+        self.assertEqual(self.server.calls["loyalty/iiko/customer/info"], calls + 1)
+        self.server.error_status, self.server.error_rate = 400, 1.0
+        try:
+            self.assertEqual(api.refresh_replica(), 0)
+        finally:
+            self.server.error_status, self.server.error_rate = 500, 0.0
+        self.assertEqual(replica.stale(self.organizationid, 10), [customer['id']])
+        del self.server.customers[customer['id']]
+        self.assertEqual(api.refresh_replica(), 0)
+        self.assertEqual(replica.stale(self.organizationid, 10), [])
+        self.assertRaises(ValueError, self.make_api().refresh_replica)
+
+    def shared_token_calls(self, make_backend) -> int:
+        """ Сколько раз запрошен токен, когда восемь клиентов со своими соединениями к хранилищу
+        одновременно получают токен"""
+        calls = self.server.calls.get("access_token", 0)
+        apis = [self.make_api(backend=make_backend()) for _ in range(8)]
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            tokens = set(executor.map(lambda api: api.set_token(), apis))
+        self.assertEqual(len(tokens), 1)
+        return self.server.calls["access_token"] - calls
+
+    def test_sqlite_backend(self) -> None:
+        """ Процессы одного хоста делят токен через файл SQLite; хранилище без блокировок создать нельзя"""
+        path = os.path.join(tempfile.mkdtemp(), 'shared.db')
+        self.assertEqual(self.shared_token_calls(lambda: SQLiteBackend(path)), 1)
+
+        class Incomplete(SharedBackend):
+            def get(self, key: str):
+                return None
+
+        self.assertRaises(TypeError, Incomplete)
+
+    def test_redis_backend(self) -> None:
+        """ Токен и справочники общие для процессов через Redis"""
+        with RespMockServer() as redis:
+            self.assertEqual(self.shared_token_calls(lambda: RedisBackend(port=redis.port)), 1)
+            self.make_api(reference_cache=ReferenceCache(backend=RedisBackend(port=redis.port))).organizations()
+            calls = self.server.calls["organizations"]
+            api = self.make_api(reference_cache=ReferenceCache(backend=RedisBackend(port=redis.port)))
+            result = api.organizations()
+            self.assertEqual(result['organizations'][0]['id'], self.organizationid)
+            self.assertEqual(self.server.calls["organizations"], calls)
+            backend = RedisBackend(port=redis.port)
+            expired = backend.lock('refresh', 0.05)
+            time.sleep(0.06)
+            owner = backend.lock('refresh', 10)
+            backend.unlock('refresh', expired)
+            self.assertIsNone(backend.lock('refresh', 10))
+            backend.unlock('refresh', owner)
+            self.assertIsNotNone(backend.lock('refresh', 10))
+
+    def test_token_fetch_within_lock(self) -> None:
+        """ Запрос токена при общем хранилище завершается раньше, чем истечёт блокировка обновления"""
+        api = self.make_api(backend=SQLiteBackend(os.path.join(tempfile.mkdtemp(), 'shared.db')))
+        api.tokens.lock_ttl = 0.4
+        self.server.latency = 0.5
+        try:
+            started = time.monotonic()
+            self.assertIsNone(api.set_token())
+            self.assertLess(time.monotonic() - started, 0.4)
+        finally:
+            self.server.latency = 0.0
+
+    def test_streaming_iterators(self) -> None:
+        """ Итераторы выдают те же элементы, что и списочные методы, разбирая ответ по частям"""
+        api = self.make_api()
+        self.assertTrue(inspect.isgenerator(api.iter_organizations()))
+        self.assertEqual(list(api.iter_organizations()), api.organizations()['organizations'])
+        self.assertEqual(list(api.iter_loyalty_programs()), api.loyalty_programs()['Programs'])
+        groups = api.get_terminal_groups()['terminalGroups']
+        self.assertEqual(list(api.iter_terminal_groups()), [item for group in groups for item in group['items']])
+        models = self.make_api(models=True)
+        self.assertTrue(all(isinstance(item, TerminalGroup) for item in models.iter_terminal_groups()))
+        parser = JSONItemStream("items")
+        payload = '{"skip": {"items": [0]}, "items": [{"name": "Ё"}, [1, "]"], 2]}'.encode('utf-8')
+        items = [item for index in range(len(payload)) for item in parser.feed(payload[index:index + 1])]
+        self.assertEqual(items, [{"name": "Ё"}, [1, "]"], 2])
+        self.assertTrue(parser.done)
+        parser = JSONItemStream("a")
+        self.assertEqual(parser.feed(b'{"a": [12'), [])
+        self.assertEqual(parser.feed(b'34, "5\\"", true]}'), [1234, '5"', True])
+        parser = JSONItemStream("terminalGroups", "items")
+        self.assertEqual(parser.feed(b'{"terminalGroups": [{"items": [{"id": 1}, {"id"'), [{"id": 1}])
+        self.assertEqual(parser.feed(b': 2}], "skip": {"items": [0]}}, {"organizationId": "x", "items": [3]}]'),
+                         [{"id": 2}, 3])
+        self.assertTrue(parser.done)
+
+    def test_async_client(self) -> None:
+        """ Асинхронный клиент выполняет запросы одновременно"""
+        async def run():
+            async with AsyncIikoCardAPI(self.server.apiLogin) as api:
+                api.apiURL = self.server.url
+                api.set_organization(self.organizationid)
+                return await api.get_customers_by_phones(["+70001112233"] * 3 + ["+79999999999"])
+
+        info = asyncio.run(run())
+        self.assertEqual([item.get('id') for item in info[:3]], [self.customer['id']] * 3)
+
+    def test_async_streaming_iterator(self) -> None:
+        """ Асинхронный итератор по программам лояльности"""
+        async def run():
+            async with AsyncIikoCardAPI(self.server.apiLogin, models=True) as api:
+                api.apiURL = self.server.url
+                api.set_organization(self.organizationid)
+                return [program async for program in api.iter_loyalty_programs()]
+
+        programs = asyncio.run(run())
+        self.assertTrue(programs and all(isinstance(program, Program) for program in programs))
+
+
+if __name__ == '__main__':
+    unittest.main()